@@ -0,0 +1,82 @@
+import argparse
+import os
+import time
+import pandas as pd
+
+import bjorn_support as bs
+import mutations as bm
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Add the samples of a GISAID feed drop to the persistent mutation aggregates, and save the updated aggregates"
+    )
+
+    parser.add_argument(
+        "-i",
+        "--alignment",
+        type=str,
+        required=True,
+        help="Path to the multiple sequence alignment (FASTA) of the newly submitted samples, including the reference sequence",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--metadata",
+        type=str,
+        required=True,
+        help="Path to the metadata of the feed (compressed TSV)",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--store",
+        type=str,
+        required=True,
+        help="Path to the aggregate store (created if it does not exist), with a folder for substitutions and one for deletions",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--out-dir",
+        type=str,
+        required=True,
+        help="Output directory of the aggregated substitutions and deletions (CSV)",
+    )
+
+    parser.add_argument(
+        "--date",
+        type=str,
+        default=pd.Timestamp.now().strftime("%Y-%m-%d"),
+        help="Only samples collected before this date (YYYY-MM-DD) are aggregated (default: today)",
+    )
+
+    parser.add_argument(
+        "--patient-zero",
+        type=str,
+        default="NC_045512.2",
+        help="Name of the reference sequence in the alignment",
+    )
+
+    args = parser.parse_args()
+    start_time = time.time()
+    os.makedirs(args.out_dir, exist_ok=True)
+    cns = bs.load_fasta(args.alignment, is_aligned=True)
+    # substitutions and deletions are called in a single pass over the alignment (insertions are not aggregated)
+    subs, dels, _, _ = bm.identify_mutations_per_sample(
+        cns, data_src="gisaid_feed", patient_zero=args.patient_zero
+    )
+    meta = bm.load_metadata(args.metadata, "gisaid_feed")
+    subs = bm.merge_metadata(subs, meta, "gisaid_feed")
+    dels = bm.merge_metadata(dels, meta, "gisaid_feed")
+    subs_agg = bm.aggregate_replacements(
+        subs, args.date, "gisaid_feed", store_dir=os.path.join(args.store, "substitutions")
+    )
+    subs_agg.to_csv(os.path.join(args.out_dir, "substitutions.csv"), index=False)
+    dels_agg = bm.aggregate_deletions(
+        dels, args.date, "gisaid_feed", store_dir=os.path.join(args.store, "deletions")
+    )
+    dels_agg.to_csv(os.path.join(args.out_dir, "deletions.csv"), index=False)
+    print(
+        f"Aggregated {subs_agg.shape[0]} substitutions and {dels_agg.shape[0]} deletions into {args.out_dir} in {time.time() - start_time:.1f}s"
+    )
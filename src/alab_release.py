@@ -90,6 +90,7 @@ def create_genbank_meta(df: pd.DataFrame, meta_cols: list) -> pd.DataFrame:
     ]
 
 
+@bs.traced
 def create_github_meta(
         new_meta_df: pd.DataFrame, old_meta_filepath: str, meta_cols: list
 ):
@@ -100,6 +101,7 @@ def create_github_meta(
     return new_metadata
 
 
+@bs.traced
 def create_gisaid_meta(new_meta_df: pd.DataFrame, meta_cols: list):
     """Generate GISAID metadata for newly released samples"""
     gisaid_columns_new = [
@@ -205,6 +207,7 @@ def compress_files(filepaths: list, destination="/home/al/tmp2/fa/samples.tar.gz
     return 0
 
 
+@bs.traced
 def retransfer_files(
         filepaths: pd.DataFrame,
         destination: str,
@@ -293,6 +296,7 @@ def move_files(in_dir, out_dir, original_filepath):
     return 0
 
 
+@bs.traced
 def transfer_files(
         filepaths: pd.DataFrame, destination: str, include_bams=False, ncpus=1
 ):
@@ -362,6 +366,76 @@ def process_id(x):
     return "".join(x.split("-")[:2])
 
 
+# columns identifying each substitution, deletion and insertion in the aggregated mutation tables
+SUBSTITUTION_COLS = ['mutation', 'ref_codon', 'alt_codon', 'pos', 'ref_aa', 'codon_num', 'alt_aa',
+                     'type', 'gene']
+DELETION_COLS = ['mutation', 'absolute_coords', 'is_frameshift', 'gene', 'indel_len', 'indel_seq',
+                 'relative_coords', 'prev_10nts', 'next_10nts', 'type']
+INSERTION_COLS = ['mutation', 'absolute_coords', 'is_frameshift', 'gene', 'indel_len',
+                  'relative_coords', 'prev_10nts', 'next_10nts', 'type']
+
+
+@bs.traced
+def identify_mutations_in_files(consensus_files: list, meta_fp, patient_zero="NC_045512.2", cache_fp=None):
+    """
+    Identifies substitutions, deletions and insertions in a batch of alignment files
+    (meant to be run as a worker process). Returns the partial substitution, deletion
+    and insertion tables of the batch, followed by the per-sample records of each
+    mutation (sample `idx` and the mutation columns only). Mutations of sequences found
+    in the (optional) mutation cache `cache_fp` are not identified again.
+    """
+    mutation_frame_list = []
+    for seq_fp in consensus_files:
+        subs, dels, inss, _ = bm.identify_mutations_per_sample(
+            bs.load_fasta(seq_fp, is_aligned=True),
+            meta_fp,
+            data_src="alab",
+            patient_zero=patient_zero,
+            min_del_len=1,
+            min_ins_len=1,
+            cache_fp=cache_fp,
+        )
+        # the summaries rename the indel columns of the per-sample records in place
+        summaries = (
+            bm.summarize_replacements(subs, data_src="alab"),
+            bm.summarize_deletions(dels, data_src="alab"),
+            bm.summarize_insertions(inss, data_src="alab"),
+        )
+        records = (
+            # 1-based nucleotide position coordinate system, as in the summary
+            subs.reindex(columns=["idx"] + SUBSTITUTION_COLS).assign(pos=lambda df: df["pos"] + 1),
+            dels.reindex(columns=["idx"] + DELETION_COLS),
+            inss.reindex(columns=["idx"] + INSERTION_COLS),
+        )
+        mutation_frame_list.append(summaries + records)
+    return tuple(pd.concat(frame_list) for frame_list in zip(*mutation_frame_list))
+
+
+@bs.traced
+def identify_mutations_parallel(consensus_files: list, meta_fp, patient_zero="NC_045512.2", ncpus=1, cache_fp=None):
+    """
+    Identifies substitutions, deletions and insertions across all alignment files using a pool of
+    `ncpus` processes, each handling batches of files. Returns the (unaggregated) substitution,
+    deletion and insertion tables of all files, followed by their per-sample records
+    (see `identify_mutations_in_files`).
+    """
+    # parse the metadata once, before it gets inherited by each process
+    bm.load_metadata(meta_fp, "alab")
+    # a few batches per process, to keep the load balanced across files of different sizes
+    batch_size = max(1, -(-len(consensus_files) // (4 * ncpus)))
+    batches = list(bs.batch_iterator(iter(consensus_files), batch_size))
+    with Pool(ncpus) as pool:
+        partial_frame_list = pool.starmap(
+            identify_mutations_in_files,
+            zip(batches, repeat(meta_fp), repeat(patient_zero), repeat(cache_fp)),
+        )
+        pool.close()
+        pool.join()
+    # merge the partial tables once all batches are done
+    return tuple(pd.concat(frame_list) for frame_list in zip(*partial_frame_list))
+
+
+@bs.traced
 def edit_one_nuc(file: Path, row, sample_id, ref="NC_045512.2"):
     """
     Takes path of file to edit, dataframe row with mutation information, sample id,
@@ -371,14 +445,10 @@ def edit_one_nuc(file: Path, row, sample_id, ref="NC_045512.2"):
     Assumes mutation is 1 nucleotide.
     """
     # get sequences and type of mutation
-    for rec in SeqIO.parse(file, 'fasta'):
-        if rec.id == ref:
-            ref_seq = rec.seq
-        if rec.id == sample_id:
-            seq_id = rec.id
-            sequence = rec.seq
-    sequence = str(sequence)
-    ref_seq = str(ref_seq)
+    aln = bm.IndexedAlignment.from_fasta(file)
+    ref_seq = aln.get_seq(ref)
+    seq_id = sample_id
+    sequence = aln.get_seq(sample_id)
     type = row['type']
 
     # find mutation position
@@ -390,7 +460,7 @@ def edit_one_nuc(file: Path, row, sample_id, ref="NC_045512.2"):
         raise Exception("Position or Coordinates not found for mutation: {}".format(row['mutation']))
 
     # number of insertions before pos
-    num_insertions = ref_seq.count('-', 0, pos)
+    num_insertions = int(bm.CoordinateMapper(ref_seq).count_insertions(pos))
 
     if type == 'deletion' or type == 'substitution':
         sequence = sequence[:pos - 1 + num_insertions] + 'N' + sequence[pos + num_insertions:]
@@ -515,6 +585,20 @@ if __name__ == "__main__":
         "-n", "--cpus", type=int, default=1, help="Number of cpus to use"
     )
 
+    parser.add_argument(
+        "--mutation-cache",
+        type=str,
+        default=None,
+        help="(Optional) path to the cache of previously identified mutations, shared across releases",
+    )
+
+    parser.add_argument(
+        "--config",
+        type=str,
+        default="config.json",
+        help="JSON file with the non-concerning genes and mutations, and (optional) additional rules for flagging suspicious mutations",
+    )
+
     parser.add_argument(
         "-s",
         "--sample-sheet",
@@ -531,6 +615,13 @@ if __name__ == "__main__":
         help="Path to the analysis folder that contains all the files",
     )
 
+    parser.add_argument(
+        "--analysis-manifest",
+        type=str,
+        default=None,
+        help="(Optional) path to the manifest of the analysis folder, kept up to date across releases (default: <analysis-folder>.manifest.sqlite)",
+    )
+
     parser.add_argument(
         "-m",
         "--output-metadata",
@@ -562,8 +653,16 @@ if __name__ == "__main__":
     out_dir = Path(args.out_dir)
     # number of cores to use
     num_cpus = args.cpus
+    # cache of previously identified mutations
+    mutation_cache_fp = args.mutation_cache
+    # rules for flagging suspicious mutations
+    config_fp = args.config
     # path to analysis results
     analysis_fpath = args.analysis_folder
+    # manifest of the files in the analysis folder, only folders modified since the last release are scanned
+    analysis_manifest_fp = args.analysis_manifest
+    if analysis_manifest_fp is None:
+        analysis_manifest_fp = analysis_fpath.rstrip("/") + ".manifest.sqlite"
     # file path to metadata of samples that have already been released
     released_samples_fpath = args.output_metadata
     # Whether run is dry
@@ -578,8 +677,16 @@ if __name__ == "__main__":
     Searching analysis folder {analysis_fpath}.
     """
     )
+    # record the time and memory usage of each stage of the release
+    bs.set_trace_file(out_dir / "trace.jsonl")
 
     # Collecting Sequence Data
+    bs.stage("Collecting sequence data...")
+    # walk the analysis folder once, all file lookups below are answered from this index
+    analysis_index = bs.AnalysisIndex(analysis_fpath, manifest_fp=analysis_manifest_fp)
+    print(
+        f"Indexed {len(analysis_index.entries)} files and folders ({analysis_index.num_scanned} folders scanned)"
+    )
     # grab all filepaths for bam data
     bam_filepaths = bs.get_filepaths(
         analysis_fpath,
@@ -588,6 +695,7 @@ if __name__ == "__main__":
         tech=tech,
         generalised=True,
         return_type="list",
+        index=analysis_index,
     )
     # print(bam_filepaths)
     bam_filepaths = [Path(fp) for fp in bam_filepaths]
@@ -605,6 +713,7 @@ if __name__ == "__main__":
         tech=tech,
         generalised=True,
         return_type="list",
+        index=analysis_index,
     )
     consensus_filepaths = [Path(fp) for fp in consensus_filepaths]
     # consolidate sample ID format
@@ -672,6 +781,7 @@ if __name__ == "__main__":
     final_result = sequence_results.copy()
     print(f"Preparing {final_result.shape[0]} samples for release")
     # ## Getting coverage information
+    bs.stage("Reading coverage data...", rows=final_result.shape[0])
     cov_filepaths = bs.get_filepaths(
         analysis_fpath,
         data_fmt="tsv",
@@ -679,6 +789,7 @@ if __name__ == "__main__":
         tech=tech+"/reports",
         generalised=True,
         return_type="list",
+        index=analysis_index,
     )
     cov_filepaths = [Path(fp) for fp in cov_filepaths]
     # read coverage data and clean it up
@@ -722,6 +833,7 @@ if __name__ == "__main__":
     # generate concatenated consensus sequences
     if not dry_run:
         # Transfer files
+        bs.stage("Transferring files...", rows=ans.shape[0])
         transfer_files(ans, out_dir, include_bams=include_bams, ncpus=num_cpus)
         # all references to msa below are actually based on pair wise alignment as of
         # 2022 September
@@ -731,6 +843,7 @@ if __name__ == "__main__":
         seqs_dir = Path(out_dir / "fa")
         # copy(ref_path, seqs_dir)
         # generate files containing metadata for Github, GISAID, GenBank
+        bs.stage("Generating metadata...", rows=ans.shape[0])
         # GitHub metadata for all samples (out_dir/metadata.csv)
         git_meta_df = create_github_meta(
             ans.copy(), released_samples_fpath, git_meta_cols
@@ -738,6 +851,7 @@ if __name__ == "__main__":
         # GISAID metadata for all samples (out_dir/gisaid_metadata.csv)
         gisaid_meta_df = create_gisaid_meta(ans.copy(), gisaid_meta_cols)
         # generate pairwise sequence alignment
+        bs.stage("Aligning consensus sequences...")
         msa_fp = msa_dir / out_dir.basename() + "_aligned.fa"
         msa_fp_indiv = msa_dir / "aligned_consensus_sequences"
         if not Path.isdir(msa_fp_indiv):
@@ -751,21 +865,25 @@ if __name__ == "__main__":
         # identify insertions
         # get a list of all the consensus sequence files
         consensus_files = glob.glob(f"{msa_fp_indiv}/*.fasta")
-        insertion_frame_list = [
-            bm.identify_insertions(
-                bs.load_fasta(seq_fp, is_aligned=True),
-                meta_fp=meta_fp,
-                patient_zero=patient_zero,
-                min_ins_len=1,
-                data_src="alab",
-            )
-            for seq_fp in consensus_files]
-        insertions = pd.concat(insertion_frame_list)
+        bs.stage("Identifying mutations...", rows=len(consensus_files))
+        # identify substitutions, deletions and insertions in a single pass over each alignment,
+        # with alignment files processed in parallel
+        (substitutions, deletions, insertions,
+         substitution_records, deletion_records, insertion_records) = identify_mutations_parallel(
+            consensus_files, meta_fp, patient_zero=patient_zero, ncpus=num_cpus,
+            cache_fp=mutation_cache_fp
+        )
         # merge insertion counts
+        bs.stage("Aggregating mutations...")
+        # sample x mutation incidence matrix of each type of mutation
+        matrices = {}
         if not insertions.empty:
-            insertions = insertions.groupby(['mutation', 'absolute_coords', 'is_frameshift',
-                                       'gene', 'indel_len', 'relative_coords', 'prev_10nts',
-                                        'next_10nts', 'type'])['samples'].apply(','.join).reset_index()
+            # save sample x insertion incidence matrix (queryable without splitting the samples column)
+            # built from the per-sample records (rows with missing values are not aggregated)
+            matrices['insertion'] = bm.MutationMatrix.from_mutations(insertion_records.dropna(subset=INSERTION_COLS),
+                                                                  INSERTION_COLS, sample_col='idx')
+            matrices['insertion'].save(out_dir / "insertions.npz")
+            insertions = insertions.groupby(INSERTION_COLS)['samples'].apply(','.join).reset_index()
             insertions['num_samples'] = insertions['samples'].str.count(',') + 1
             # reorder insertion count dataframe
             insertions = insertions[['type', 'mutation', 'absolute_coords', 'is_frameshift',
@@ -773,45 +891,28 @@ if __name__ == "__main__":
                                        'samples', 'num_samples']]
         # save insertion results to file
         insertions.to_csv(out_dir / "insertions.csv", index=False)
-        # identify substitution mutations
-        substitution_frame_list = [
-            bm.identify_replacements(
-                bs.load_fasta(seq_fp, is_aligned=True),
-                meta_fp=meta_fp,
-                data_src="alab",
-                patient_zero=patient_zero
-            )
-            for seq_fp in consensus_files
-        ]
-        substitutions = pd.concat(substitution_frame_list)
         # merge substitution counts
         if not substitutions.empty:
-            substitutions = substitutions.groupby(['mutation', 'ref_codon',
-                                               'alt_codon','pos','ref_aa','codon_num','alt_aa',
-                                               'type', 'gene'])['samples'].apply(','.join).reset_index()
+            # save sample x substitution incidence matrix (queryable without splitting the samples column)
+            # built from the per-sample records (rows with missing values are not aggregated)
+            matrices['substitution'] = bm.MutationMatrix.from_mutations(substitution_records.dropna(subset=SUBSTITUTION_COLS),
+                                                                  SUBSTITUTION_COLS, sample_col='idx')
+            matrices['substitution'].save(out_dir / "substitutions.npz")
+            substitutions = substitutions.groupby(SUBSTITUTION_COLS)['samples'].apply(','.join).reset_index()
             substitutions['num_samples'] = substitutions['samples'].str.count(',') + 1
             # reorder substitution count dataframe
             substitutions = substitutions[['type', 'mutation', 'gene', 'ref_codon', 'alt_codon',
                                        'pos', 'ref_aa', 'codon_num', 'alt_aa', 'num_samples', 'samples']]
         # save substitution results to file
         substitutions.to_csv(out_dir / "substitutions.csv", index=False)
-        # identify deletions
-        deletion_frame_list = [
-            bm.identify_deletions(
-                bs.load_fasta(seq_fp, is_aligned=True),
-                meta_fp=meta_fp,
-                data_src="alab",
-                patient_zero=patient_zero,
-                min_del_len=1
-            )
-            for seq_fp in consensus_files
-        ]
-        deletions = pd.concat(deletion_frame_list)
         # merge deletions counts
         if not deletions.empty:
-            deletions = deletions.groupby(['mutation', 'absolute_coords', 'is_frameshift', 'gene',
-                                       'indel_len', 'indel_seq', 'relative_coords', 'prev_10nts',
-                                       'next_10nts', 'type'])['samples'].apply(','.join).reset_index()
+            # save sample x deletion incidence matrix (queryable without splitting the samples column)
+            # built from the per-sample records (rows with missing values are not aggregated)
+            matrices['deletion'] = bm.MutationMatrix.from_mutations(deletion_records.dropna(subset=DELETION_COLS),
+                                                                  DELETION_COLS, sample_col='idx')
+            matrices['deletion'].save(out_dir / "deletions.npz")
+            deletions = deletions.groupby(DELETION_COLS)['samples'].apply(','.join).reset_index()
             deletions['num_samples'] = deletions['samples'].str.count(',') + 1
             # reorder deletion count dataframe
             deletions = deletions[['type', 'mutation', 'absolute_coords', 'is_frameshift', 'gene',
@@ -821,19 +922,20 @@ if __name__ == "__main__":
         deletions.to_csv(out_dir / "deletions.csv", index=False)
 
         # identify samples with suspicious INDELs and/or substitutions
-        with open("config.json", "r") as f:
-            config = json.load(f)
-        nonconcerning_genes = config["nonconcerning_genes"]
-        nonconcerning_mutations = config["nonconcerning_mutations"]
+        bs.stage("Flagging suspicious mutations...")
+        rules = bm.SuspiciousMutationRules.from_config(config_fp)
         sus_ids, sus_muts = bm.identify_samples_with_suspicious_mutations(
             substitutions,
             deletions,
             insertions,
-            nonconcerning_genes,
-            nonconcerning_mutations,
+            rules.nonconcerning_genes,
+            rules.nonconcerning_mutations,
+            rules=rules,
+            matrices=matrices,
         )
 
         # collect metadata for white-listed samples
+        bs.stage("Separating suspicious samples...", rows=len(sus_ids))
         gisaid_white = gisaid_meta_df[~gisaid_meta_df["covv_virus_name"].isin(sus_ids)]
         git_white = git_meta_df[~git_meta_df["fasta_hdr"].isin(sus_ids)]
         # collect metadata for samples that require manual inspection
@@ -861,6 +963,7 @@ if __name__ == "__main__":
         if not Path.isdir(corrected_dir):
             Path.mkdir(corrected_dir)
         # loop through mutations
+        bs.stage("Correcting suspicious mutations...", rows=sus_muts.shape[0])
         # find all samples with that mutation
         # edit those samples at that location
         sus_muts_cp = []
@@ -910,6 +1013,7 @@ if __name__ == "__main__":
             os.rename(file, inspect_dir / Path(file.replace('.fa_keep', '').replace('.fa_nc', '')).basename())
 
         # generate compressed report containing main results
+        bs.stage("Generating release report...")
         bs.generate_release_report(out_dir)
 
     else:
@@ -935,4 +1039,5 @@ if __name__ == "__main__":
             f"""{len(sus_ids)} samples contain suspicious mutations and require manual inspection.
         They can be found in {out_dir}/fa_inspect and {out_dir}/bam_inspect\n"""
         )
+    bs.end_stage()
     print(f"Transfer Complete. All results saved in {out_dir}")
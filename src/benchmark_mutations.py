@@ -0,0 +1,281 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from Bio import SeqIO
+
+import bjorn_support as bs
+import mutations as bm
+
+from typing import Tuple
+
+
+# reference sequence shipped with the repo (MN908947.3, identical to NC_045512.2)
+REF_FP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'alab_minion_primers', 'nCoV-2019', 'V1', 'nCoV-2019.reference.fasta')
+NTS = np.frombuffer(b'ACGT', dtype=np.uint8)
+LOCATIONS = [('San Diego', 'California', 'USA'), ('Los Angeles', 'California', 'USA'),
+             ('Houston', 'Texas', 'USA'), ('Tijuana', 'Baja California', 'Mexico'),
+             ('Toronto', 'Ontario', 'Canada')]
+
+
+def generate_alignment(ref_seq: str,
+                       num_samples: int,
+                       mutation_rate: float=1e-3,
+                       indel_rate: float=1e-4,
+                       num_insertion_cols: int=3,
+                       insertion_rate: float=0.3,
+                       n_run_rate: float=0.3,
+                       duplicate_rate: float=0.0,
+                       seed: int=0) -> Tuple[list, list, str]:
+    """Generates a synthetic multiple sequence alignment against the reference sequence, which is deterministic
+    given the `seed`. Each sample gets substitutions (`mutation_rate` per nt), deletions (`indel_rate` per nt),
+    a run of Ns (with probability `n_run_rate`), leading/trailing gaps and bases in the insertion columns
+    (each with probability `insertion_rate`). With probability `duplicate_rate`, a sample is a copy of the previous one.
+    Returns the sample names, their aligned sequences and the aligned reference sequence"""
+    rng = np.random.default_rng(seed)
+    ref_arr = np.frombuffer(ref_seq.upper().encode('ascii'), dtype=np.uint8)
+    ref_len = ref_arr.shape[0]
+    # columns where insertions (gaps in the reference) are found
+    insertion_cols = np.sort(rng.choice(np.arange(300, ref_len - 1000), size=num_insertion_cols, replace=False))
+    aln_ref = np.insert(ref_arr, insertion_cols, ord('-'))
+    names, seqs = [], []
+    seq = None
+    for i in range(num_samples):
+        names.append(f'hCoV-19/USA/CA-SYNTH-{i:07d}/2021')
+        if seq is not None and rng.random() < duplicate_rate:
+            seqs.append(seq)
+            continue
+        sample = ref_arr.copy()
+        # substitutions
+        positions = rng.choice(ref_len, size=rng.poisson(mutation_rate * ref_len), replace=False)
+        offsets = rng.integers(1, 4, size=positions.shape[0])
+        sample[positions] = NTS[(np.searchsorted(NTS, sample[positions]) + offsets) % 4]
+        # deletions
+        for start in rng.integers(200, ref_len - 600, size=rng.poisson(indel_rate * ref_len)):
+            sample[start:start + rng.choice([1, 2, 3, 6, 9])] = ord('-')
+        # run of ambiguous nts
+        if rng.random() < n_run_rate:
+            start = rng.integers(0, ref_len - 500)
+            sample[start:start + rng.integers(10, 300)] = ord('N')
+        # leading and trailing gaps
+        sample[:rng.integers(0, 60)] = ord('-')
+        sample[ref_len - rng.integers(0, 100):] = ord('-')
+        # insertions
+        inserted = np.where(rng.random(num_insertion_cols) < insertion_rate,
+                            rng.choice(NTS, size=num_insertion_cols), ord('-')).astype(np.uint8)
+        seq = np.insert(sample, insertion_cols, inserted).tobytes().decode('ascii')
+        seqs.append(seq)
+    return names, seqs, aln_ref.tobytes().decode('ascii')
+
+
+def generate_metadata(names: list, data_src: str='alab', seed: int=0) -> pd.DataFrame:
+    """Generates the metadata of the synthetic samples, in the format of the given data source (alab or gisaid_feed)"""
+    rng = np.random.default_rng(seed)
+    dates = (pd.Timestamp('2020-03-01') + pd.to_timedelta(rng.integers(0, 640, size=len(names)), unit='D')).strftime('%Y-%m-%d')
+    places = [LOCATIONS[i] for i in rng.integers(0, len(LOCATIONS), size=len(names))]
+    if data_src=='alab':
+        return pd.DataFrame({'ID': [f'SYNTH-{i:07d}' for i in range(len(names))],
+                             'fasta_hdr': names,
+                             'collection_date': dates,
+                             'location': [f'{country}/{division}/{location}' for location, division, country in places]})
+    elif data_src=='gisaid_feed':
+        meta = pd.DataFrame({'strain': names, 'date': dates, 'date_collected': dates, 'date_submitted': dates,
+                             'location': [p[0] for p in places], 'division': [p[1] for p in places],
+                             'country': [p[2] for p in places], 'pangolin_lineage': 'B.1'})
+        for col in ['location', 'division', 'country']:
+            meta[f'{col}_normed'] = meta[col]
+        return meta
+    raise ValueError(f"user-specified data source {data_src} not recognized. Aborting.")
+
+
+def write_alignment(fasta_fp: str, names: list, seqs: list, aln_ref_seq: str, patient_zero: str='NC_045512.2'):
+    """Writes the synthetic alignment (including the reference sequence) to a FASTA file"""
+    with open(fasta_fp, 'w') as f:
+        f.write(f'>{patient_zero}\n{aln_ref_seq}\n')
+        for name, seq in zip(names, seqs):
+            f.write(f'>{name}\n{seq}\n')
+    return fasta_fp
+
+
+def generate_dataset(out_dir: str, num_samples: int, ref_fp: str=REF_FP, seed: int=0, **params) -> dict:
+    """Generates and saves a synthetic alignment along with its metadata (see `generate_alignment`),
+    returns the filepaths of the alignment and of the metadata for each data source"""
+    os.makedirs(out_dir, exist_ok=True)
+    ref_seq = str(SeqIO.read(ref_fp, 'fasta').seq)
+    names, seqs, aln_ref_seq = generate_alignment(ref_seq, num_samples, seed=seed, **params)
+    prefix = os.path.join(out_dir, f'synthetic_{num_samples}')
+    filepaths = {'fasta': write_alignment(prefix + '.aligned.fasta', names, seqs, aln_ref_seq)}
+    # A-lab metadata is a csv file, GISAID metadata is a compressed tsv file
+    filepaths['alab'] = prefix + '.alab.csv'
+    generate_metadata(names, 'alab', seed).to_csv(filepaths['alab'], index=False)
+    filepaths['gisaid_feed'] = prefix + '.gisaid_feed.tsv.gz'
+    generate_metadata(names, 'gisaid_feed', seed).to_csv(filepaths['gisaid_feed'], sep='\t', index=False, compression='gzip')
+    return filepaths
+
+
+def profile(func, *args, **kwargs) -> Tuple[object, dict]:
+    """Runs the function once without and once with memory tracing, returns its result along with
+    its wall-clock and CPU time (untraced run) and peak (Python-allocated) memory (traced run)"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = func(*args, **kwargs)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        tracemalloc.start()
+        func(*args, **kwargs)
+        peak_mem = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, {'wall_s': wall, 'cpu_s': cpu, 'peak_mem_mb': peak_mem / 2**20}
+
+
+def get_num_rows(result) -> int:
+    """helper function to count the records (or sequences) returned by an entry point (first item of tuples)"""
+    if isinstance(result, tuple):
+        result = result[0]
+    return len(result) if hasattr(result, '__len__') else None
+
+
+def call_with_cold_cache(func, cache_fp: str, *args, **kwargs):
+    """helper function to call an entry point with an empty mutation cache (see `mutations.MutationCache`)"""
+    if os.path.isfile(cache_fp):
+        os.remove(cache_fp)
+    return func(*args, cache_fp=cache_fp, **kwargs)
+
+
+def benchmark_dataset(filepaths: dict, patient_zero: str='NC_045512.2', date: str='2022-01-01') -> list:
+    """Times and memory-profiles each entry point of `mutations.py` on a synthetic dataset (see `generate_dataset`)"""
+    fasta_fp, meta_fp = filepaths['fasta'], filepaths['alab']
+    cns = bs.load_fasta(fasta_fp, is_aligned=True)
+    feed_meta_fp = filepaths['gisaid_feed']
+    cache_fp = os.path.splitext(fasta_fp)[0] + '.mutation_cache.sqlite'
+    entry_points = {
+        'load_fasta': (bs.load_fasta, (fasta_fp,), {'is_aligned': True}),
+        'identify_replacements_per_sample': (bm.identify_replacements_per_sample, (cns, meta_fp), {'data_src': 'alab'}),
+        'identify_deletions_per_sample': (bm.identify_deletions_per_sample, (cns, meta_fp), {'data_src': 'alab'}),
+        'identify_insertions_per_sample': (bm.identify_insertions_per_sample, (cns, meta_fp), {'data_src': 'alab'}),
+        'identify_mutations_per_sample': (bm.identify_mutations_per_sample, (cns, meta_fp), {'data_src': 'alab'}),
+        # the cold-cache run fills the cache used by the warm-cache run
+        'identify_mutations_per_sample_cold_cache': (call_with_cold_cache, (bm.identify_mutations_per_sample, cache_fp, cns, meta_fp), 
+                                                     {'data_src': 'alab'}),
+        'identify_mutations_per_sample_warm_cache': (bm.identify_mutations_per_sample, (cns, meta_fp), 
+                                                     {'data_src': 'alab', 'cache_fp': cache_fp}),
+        'identify_replacements': (bm.identify_replacements, (cns, meta_fp), {'data_src': 'alab'}),
+        'identify_deletions': (bm.identify_deletions, (cns, meta_fp), {'data_src': 'alab', 'min_del_len': 1}),
+        'identify_insertions': (bm.identify_insertions, (cns, meta_fp), {'data_src': 'alab', 'min_ins_len': 1}),
+        'identify_mutations': (bm.identify_mutations, (cns, meta_fp), {'data_src': 'alab', 'min_del_len': 1}),
+    }
+    results = []
+    for name, (func, args, kwargs) in entry_points.items():
+        print(f"Benchmarking {name}...")
+        result, stats = profile(func, *args, **kwargs)
+        results.append({'function': name, 'rows': get_num_rows(result), **stats})
+    # aggregation of the per-sample mutations (in the GISAID feed format)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        subs, _ = bm.identify_replacements_per_sample(cns, feed_meta_fp, data_src='gisaid_feed')
+        dels, _ = bm.identify_deletions_per_sample(cns, feed_meta_fp, data_src='gisaid_feed')
+    for name, func, muts in [('aggregate_replacements', bm.aggregate_replacements, subs),
+                             ('aggregate_deletions', bm.aggregate_deletions, dels)]:
+        print(f"Benchmarking {name}...")
+        result, stats = profile(lambda: func(muts.copy(), date, 'gisaid_feed'))
+        results.append({'function': name, 'rows': get_num_rows(result), **stats})
+    return results
+
+
+def run_benchmarks(out_dir: str, scales: list, seed: int=0, **params) -> dict:
+    """Generates a synthetic dataset for each number of samples in `scales` and benchmarks all entry points on it"""
+    results = []
+    for num_samples in scales:
+        print(f"Generating synthetic alignment of {num_samples} samples...")
+        filepaths = generate_dataset(out_dir, num_samples, seed=seed, **params)
+        for record in benchmark_dataset(filepaths):
+            results.append({'num_samples': num_samples, **record})
+    return {'created': pd.Timestamp.now().isoformat(),
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'pandas': pd.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count()},
+            'params': {'seed': seed, **params},
+            'results': results}
+
+
+def compare_benchmarks(results: dict, baseline: dict, max_slowdown: float=1.2) -> pd.DataFrame:
+    """Compares the wall-clock time and peak memory of each entry point (at each scale) against those of
+    previous results, flagging those that are more than `max_slowdown` times slower or larger"""
+    keys = ['function', 'num_samples']
+    current = pd.DataFrame(results['results']).set_index(keys)
+    previous = pd.DataFrame(baseline['results']).set_index(keys)
+    comparison = current[['wall_s', 'peak_mem_mb']].join(previous[['wall_s', 'peak_mem_mb']],
+                                                         rsuffix='_baseline', how='inner')
+    comparison['time_ratio'] = comparison['wall_s'] / comparison['wall_s_baseline']
+    comparison['mem_ratio'] = comparison['peak_mem_mb'] / comparison['peak_mem_mb_baseline']
+    comparison['is_regression'] = (comparison['time_ratio'] > max_slowdown) | (comparison['mem_ratio'] > max_slowdown)
+    return comparison.reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the entry points of mutations.py on synthetic alignments")
+
+    parser.add_argument(
+        "-o", "--out-dir", type=str, default="./benchmarks", help="Output directory (synthetic data and results)"
+    )
+
+    parser.add_argument(
+        "-s",
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="Number of samples of each synthetic alignment",
+    )
+
+    parser.add_argument(
+        "--mutation-rate", type=float, default=1e-3, help="Substitutions per nucleotide"
+    )
+
+    parser.add_argument(
+        "--indel-rate", type=float, default=1e-4, help="Deletions per nucleotide"
+    )
+
+    parser.add_argument(
+        "--insertion-cols", type=int, default=3, help="Number of insertion columns in the alignment"
+    )
+
+    parser.add_argument(
+        "--n-run-rate", type=float, default=0.3, help="Fraction of samples with a run of Ns"
+    )
+
+    parser.add_argument(
+        "--duplicate-rate", type=float, default=0.0, help="Fraction of samples identical to the previous sample"
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the synthetic data generator"
+    )
+
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        type=str,
+        default=None,
+        help="(Optional) previous benchmark results (JSON) to compare against",
+    )
+
+    args = parser.parse_args()
+    results = run_benchmarks(args.out_dir, args.scales, seed=args.seed,
+                             mutation_rate=args.mutation_rate, indel_rate=args.indel_rate,
+                             num_insertion_cols=args.insertion_cols, n_run_rate=args.n_run_rate,
+                             duplicate_rate=args.duplicate_rate)
+    results_fp = os.path.join(args.out_dir, f"benchmark_{pd.Timestamp.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    with open(results_fp, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(pd.DataFrame(results['results']).to_string(index=False))
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        comparison = compare_benchmarks(results, baseline)
+        print(comparison.to_string(index=False))
+        print(f"{comparison['is_regression'].sum()} potential performance regressions found")
+    print(f"Benchmark results saved in {results_fp}")
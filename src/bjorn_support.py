@@ -1,22 +1,140 @@
 import sys
 import shutil
 import glob
+import bisect
+import fnmatch
+import re
+import sqlite3
 import subprocess
 import math
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import gzip
+import io
+import functools
+import json
+import resource
+import selectors
+import signal
+import time
+import numpy as np
 import pandas as pd
 from Bio import SeqIO, AlignIO, Align
 
 from path import Path
 import os
 
+# spans (traced functions and their stages) that are currently open, from outermost to innermost,
+# along with the JSON-lines file where finished spans are recorded (see `set_trace_file`)
+TRACE = {"fp": None, "spans": []}
+
+
+def set_trace_file(trace_fp):
+    """Sets the JSON-lines file where the wall time, CPU time, peak memory (RSS) and number of rows
+    of each traced function and stage are recorded (None to stop recording)"""
+    if trace_fp is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(trace_fp)), exist_ok=True)
+    TRACE["fp"] = trace_fp
+
+
+def traced(func):
+    """Decorator recording a span for each call of the function, which contains the stages marked
+    inside the function (see `stage`). The number of rows of the returned dataframe
+    (or the first item of the returned tuple) is recorded along with the span"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        span = start_span(func.__name__, kind="function")
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            end_span(span, error=type(e).__name__)
+            raise
+        end_span(span, rows=count_rows(result))
+        return result
+
+    return wrapper
+
+
+def stage(message: str, rows: int = None):
+    """Prints the progress message and starts the corresponding stage of the current traced function
+    (or of the whole pipeline), ending its previous stage. `rows` is the number of rows entering the stage"""
+    print(message)
+    end_stage()
+    start_span(message.strip(" .:"), kind="stage", rows=rows)
+
+
+def end_stage():
+    """Ends the current stage, if any (stages are ended automatically when their traced function returns)"""
+    if TRACE["spans"] and TRACE["spans"][-1]["kind"] == "stage":
+        end_span(TRACE["spans"][-1])
+
+
+def start_span(name: str, kind: str, rows: int = None) -> dict:
+    """Support function for opening a span nested in the innermost open span"""
+    span = {
+        "name": name,
+        "kind": kind,
+        "parent": TRACE["spans"][-1]["name"] if TRACE["spans"] else None,
+        "pid": os.getpid(),
+        "start": time.time(),
+        "rows": rows,
+        "wall": time.perf_counter(),
+        "cpu": time.process_time(),
+        "peak_rss": get_peak_rss_mb(),
+    }
+    TRACE["spans"].append(span)
+    return span
+
+
+def end_span(span: dict, rows: int = None, error: str = None):
+    """Support function for closing a span along with any span nested in it, and recording it to the trace file"""
+    while TRACE["spans"] and TRACE["spans"][-1] is not span:
+        end_span(TRACE["spans"][-1], error=error)
+    if TRACE["spans"]:
+        TRACE["spans"].pop()
+    if TRACE["fp"] is None:
+        return
+    peak_rss = get_peak_rss_mb()
+    record = {
+        "name": span["name"],
+        "kind": span["kind"],
+        "parent": span["parent"],
+        "pid": span["pid"],
+        "start": span["start"],
+        "wall_s": time.perf_counter() - span["wall"],
+        "cpu_s": time.process_time() - span["cpu"],
+        "peak_rss_mb": peak_rss,
+        "peak_rss_increase_mb": peak_rss - span["peak_rss"],
+        "rows": rows if rows is not None else span["rows"],
+        "error": error,
+    }
+    with open(TRACE["fp"], "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def get_peak_rss_mb() -> float:
+    """helper function that returns the peak resident memory of the current process (in MB)"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS, and in KB on Linux
+    return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
+
+
+def count_rows(result) -> int:
+    """helper function that returns the number of rows of a dataframe, or of the first item of a tuple"""
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    return int(result.shape[0]) if isinstance(result, pd.DataFrame) else None
+
+
+@traced
 def get_variant_counts(
     analysis_filepath: str,
     search_ids: list,
     min_freq: float = 0.15,
     max_freq: float = 100.0,
     generalised: bool = False,
+    num_workers: int = 8,
 ):
     """Takes path to results directory and (optional) list of sample IDs
     Returns data frame of the number of variants identified in each sample
@@ -29,21 +147,23 @@ def get_variant_counts(
         generalised=generalised,
         return_type="list",
     )
-    var_df = pd.concat(
-        [
-            pd.read_csv(fp, sep="\t").assign(sample_id=fp.split("/")[-1].split("_")[0])
-            for fp in var_fps
-        ]
+    var_df = load_variants(
+        var_fps,
+        [fp.split("/")[-1].split("_")[0] for fp in var_fps],
+        columns=["POS", "ALT"],
+        min_freq=min_freq,
+        max_freq=max_freq,
+        sample_col="sample_id",
+        num_workers=num_workers,
     )
-    var_df = var_df.loc[
-        (var_df["ALT_FREQ"] < max_freq) & (var_df["ALT_FREQ"] > min_freq)
-    ]
-    var_df["variant"] = var_df["POS"].astype(str) + ":" + var_df["ALT"].astype(str)
-    return (
-        var_df.groupby("sample_id")
-        .agg(num_nt_mutations=("variant", "nunique"))
-        .sort_index()
+    # number of distinct variants (position and alternative allele) of each sample
+    num_variants = (
+        var_df.drop_duplicates(["sample_id", "POS", "ALT"])
+        .groupby("sample_id", observed=True)
+        .size()
     )
+    num_variants.index = num_variants.index.astype(str)
+    return num_variants.to_frame("num_nt_mutations").sort_index()
 
 
 def separate_samples(
@@ -87,6 +207,7 @@ def copy_files(filenames: list, destination_dir):
         )
 
 
+@traced
 def generate_release_report(out_dir, report_name="release_report.tar"):
     report_fp = out_dir / report_name
     s1 = "find {out_dir}/ -name '*.csv' -type f -exec tar rfP {report_fp} {{}} \\;".format(
@@ -100,6 +221,7 @@ def generate_release_report(out_dir, report_name="release_report.tar"):
     return 0
 
 
+@traced
 def separate_alignments(
     msa_data, sus_ids, out_dir, filename, patient_zero="NC_045512.2"
 ):
@@ -240,6 +362,230 @@ def fetch_seqs(
         return SeqIO.write(my_cns, out_fp, "fasta")
 
 
+class AnalysisIndex:
+    """Index of the files in an analysis folder, built by walking the folder once with `os.scandir`.
+    Files are grouped by depth and format, and the glob patterns of `get_filepaths` (data type and
+    technology folders, sample ID and format) are answered from memory.
+    Paths are returned in the same order and form as `glob.glob` would return them.
+    With a `manifest_fp`, folder listings are persisted across runs (see `AnalysisManifest`)
+    and only the folders modified since the last run are scanned again"""
+
+    def __init__(self, analysis_path: str, max_depth: int = 6, manifest_fp: str = None):
+        self.analysis_path = str(analysis_path).rstrip("/") or "/"
+        self.max_depth = max_depth
+        # relative path (tuple of folder and file names) of each entry, in walk order
+        self.entries = []
+        # positions of the entries in `entries`, by depth and format
+        self.entries_by_fmt = defaultdict(list)
+        self.num_scanned = 0
+        self.manifest = None
+        if manifest_fp is not None:
+            try:
+                self.manifest = AnalysisManifest(manifest_fp, self.analysis_path)
+            except sqlite3.Error as e:
+                print(f"Could not open analysis manifest {manifest_fp} ({e}), scanning all folders")
+        self._walk(self.analysis_path, ())
+        if self.manifest is not None:
+            self.manifest.save()
+            self.manifest.close()
+
+    def _walk(self, dir_path: str, parts: tuple):
+        for name, is_dir in self._list_folder(dir_path, parts):
+            rel = parts + (name,)
+            self.entries_by_fmt[(len(rel), get_file_format(name))].append(
+                len(self.entries)
+            )
+            self.entries.append(rel)
+            # the depth limit also guards against symlink loops
+            if is_dir and len(rel) < self.max_depth:
+                self._walk(os.path.join(dir_path, name), rel)
+
+    def _list_folder(self, dir_path: str, parts: tuple) -> list:
+        """Returns the name and whether it is a folder of each entry in a folder,
+        from the manifest if the folder was not modified since it was last scanned"""
+        if self.manifest is None:
+            self.num_scanned += 1
+            return scan_folder(dir_path)
+        try:
+            # read before scanning, so that changes made during the scan are picked up next time
+            mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return []
+        folder = "/".join(parts)
+        listing = self.manifest.get_listing(folder, mtime)
+        if listing is None:
+            self.num_scanned += 1
+            listing = scan_folder(dir_path)
+            self.manifest.set_listing(folder, mtime, listing)
+        return listing
+
+    def get_path(self, rel: tuple) -> str:
+        return os.path.join(self.analysis_path, *rel)
+
+    def find(self, pattern: str) -> list:
+        """Returns the paths matching `pattern`, a (non-recursive) glob pattern relative to
+        the analysis folder e.g. "**/*merged_aligned_bams*/*illumina*/*.bam" """
+        components = pattern.strip("/").split("/")
+        depth = len(components)
+        fmt = get_file_format(components[-1])
+        if fmt and not glob.has_magic(fmt):
+            positions = self.entries_by_fmt.get((depth, fmt), [])
+        else:
+            positions = sorted(
+                p for (d, _), ps in self.entries_by_fmt.items() if d == depth for p in ps
+            )
+        matchers = [get_component_matcher(c) for c in components]
+        return [
+            self.get_path(self.entries[p])
+            for p in positions
+            if all(m(name) for m, name in zip(matchers, self.entries[p]))
+        ]
+
+    def find_samples(self, pattern: str, sample_ids: list) -> list:
+        """Returns, for each sample ID, the list of paths matching `pattern` with the leading "*"
+        of its filename component replaced by "*{s_id}*" e.g. "*/*variants*/*illumina*/*.tsv" """
+        fps = self.find(pattern)
+        if not fps:
+            return [[] for _ in sample_ids]
+        suffix = pattern.split("/")[-1][1:]
+        names = [fp.split("/")[-1][: -len(suffix) or None] for fp in fps]
+        # search all filenames at once, mapping each hit back to its filename by offset
+        text = "\n".join(names)
+        offsets = []
+        offset = 0
+        for name in names:
+            offsets.append(offset)
+            offset += len(name) + 1
+        sample_fps = []
+        for s_id in map(str, sample_ids):
+            sample_fps.append([])
+            pos = text.find(s_id)
+            while pos >= 0:
+                i = bisect.bisect_right(offsets, pos) - 1
+                if pos + len(s_id) > offsets[i] + len(names[i]):
+                    pos = text.find(s_id, pos + 1)
+                    continue
+                sample_fps[-1].append(fps[i])
+                if i + 1 == len(names):
+                    break
+                pos = text.find(s_id, offsets[i + 1])
+        return sample_fps
+
+
+def scan_folder(dir_path: str) -> list:
+    """Returns the name and whether it is a folder of each entry in a folder"""
+    try:
+        with os.scandir(dir_path) as it:
+            dir_entries = list(it)
+    except OSError:
+        return []
+    entries = []
+    for entry in dir_entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        entries.append((entry.name, is_dir))
+    return entries
+
+
+class AnalysisManifest:
+    """Persistent (SQLite) cache of the folder listings of an analysis folder: the entries (name and
+    whether it is a folder) of each scanned folder, along with its modification time (mtime).
+    A folder whose mtime is unchanged still holds the same entries, so its listing is served from
+    the manifest instead of the filesystem. Files are only looked up in memory (see `AnalysisIndex`)"""
+
+    def __init__(self, manifest_fp: str, analysis_path: str):
+        self.db = sqlite3.connect(manifest_fp, timeout=60)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, mtime INTEGER NOT NULL)"
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS entries (folder TEXT NOT NULL, pos INTEGER NOT NULL,
+                                                   name TEXT NOT NULL, is_dir INTEGER NOT NULL,
+                                                   PRIMARY KEY (folder, pos))"""
+        )
+        root = self.db.execute(
+            "SELECT value FROM meta WHERE key='analysis_path'"
+        ).fetchone()
+        if root is None or root[0] != analysis_path:
+            # manifest of another analysis folder
+            self.db.execute("DELETE FROM folders")
+            self.db.execute("DELETE FROM entries")
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('analysis_path', ?)",
+                (analysis_path,),
+            )
+        self.db.commit()
+        self.mtimes = dict(self.db.execute("SELECT folder, mtime FROM folders"))
+        self.listings = defaultdict(list)
+        for folder, name, is_dir in self.db.execute(
+            "SELECT folder, name, is_dir FROM entries ORDER BY folder, pos"
+        ):
+            self.listings[folder].append((name, bool(is_dir)))
+        # folders found during this run, and the ones scanned again
+        self.found = set()
+        self.scanned = {}
+
+    def get_listing(self, folder: str, mtime: int) -> list:
+        """Returns the recorded entries of `folder` (relative to the analysis folder),
+        or None if it is new or was modified since it was recorded"""
+        self.found.add(folder)
+        if self.mtimes.get(folder) != mtime:
+            return None
+        return self.listings[folder]
+
+    def set_listing(self, folder: str, mtime: int, entries: list):
+        """Records the entries (name, is_dir) found when scanning `folder`"""
+        self.found.add(folder)
+        self.scanned[folder] = (mtime, entries)
+
+    def save(self):
+        """Writes the folders scanned again and removes the ones that no longer exist"""
+        removed = [(folder,) for folder in set(self.mtimes) - self.found]
+        updated = [(folder,) for folder in self.scanned]
+        self.db.executemany("DELETE FROM folders WHERE folder=?", removed + updated)
+        self.db.executemany("DELETE FROM entries WHERE folder=?", removed + updated)
+        self.db.executemany(
+            "INSERT INTO folders VALUES (?, ?)",
+            [(folder, mtime) for folder, (mtime, _) in self.scanned.items()],
+        )
+        self.db.executemany(
+            "INSERT INTO entries VALUES (?, ?, ?, ?)",
+            [
+                (folder, pos, name, is_dir)
+                for folder, (_, entries) in self.scanned.items()
+                for pos, (name, is_dir) in enumerate(entries)
+            ],
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def get_file_format(filename: str) -> str:
+    """Returns the extension of `filename` (without the dot), or an empty string if it has none"""
+    return filename.rsplit(".", 1)[-1] if "." in filename else ""
+
+
+@functools.lru_cache(maxsize=None)
+def get_component_matcher(component: str):
+    """Returns a function that tells whether a file or folder name matches one component of
+    a glob pattern, following `glob.glob` (hidden names are only matched explicitly)"""
+    if not glob.has_magic(component):
+        return component.__eq__
+    match = re.compile(fnmatch.translate(component)).match
+    if component.startswith("."):
+        return lambda name: match(name) is not None
+    return lambda name: not name.startswith(".") and match(name) is not None
+
+
+
+@traced
 def get_filepaths(
     analysis_path: str,
     data_fmt: str,
@@ -248,55 +594,45 @@ def get_filepaths(
     tech: str = "",
     generalised=False,
     return_type="dict",
+    index: AnalysisIndex = None,
 ) -> dict:
     """Take list of sample IDs, the general area where your files are located, and their format.
     Returns a dictionary with sample IDs as keys and the filepaths as values.
+    Pass an `AnalysisIndex` of `analysis_path` to reuse it across queries (one is built otherwise,
+    unless the lookup is not `generalised`, in which case the folders are globbed directly)
     """
     file_paths = defaultdict(list)
     fs = []
-    generalised_flag = ""
-    if sample_ids:
-        for s_id in sample_ids:
-            if generalised:
-                generalised_flag = "/**"
-            if data_type and tech:
-                f = glob.glob(
-                    f"{analysis_path}{generalised_flag}/*{data_type}*/*{tech}*/*{s_id}*.{data_fmt}"
-                )
-            elif data_type:
-                f = glob.glob(
-                    f"{analysis_path}{generalised_flag}/*{data_type}*/*{s_id}*.{data_fmt}"
-                )
-            else:
-                f = glob.glob(f"{analysis_path}{generalised_flag}/*{s_id}*.{data_fmt}")
-            try:
-                fs.append(f)
-                file_paths[s_id].append(f[0])
-            except:
-                continue
+    if data_type and tech:
+        folders = f"*{data_type}*/*{tech}*/"
+    elif data_type:
+        folders = f"*{data_type}*/"
     else:
-        if data_type and tech:
-            if generalised:
-                fs = glob.glob(
-                    f"{analysis_path}/**/*{data_type}*/*{tech}*/*.{data_fmt}"
-                )
-            else:
-                fs = glob.glob(f"{analysis_path}/*{data_type}*/*{tech}*/*.{data_fmt}")
-        elif data_type:
-            if generalised:
-                fs = glob.glob(f"{analysis_path}/**/*{data_type}*/*.{data_fmt}")
-            else:
-                fs = glob.glob(f"{analysis_path}/*{data_type}*/*.{data_fmt}")
+        folders = ""
+    pattern = f"{folders}*.{data_fmt}"
+    if generalised:
+        pattern = f"**/{pattern}"
+    if index is None and generalised:
+        index = AnalysisIndex(analysis_path)
+    if sample_ids:
+        if index is None:
+            sample_fps = [
+                glob.glob(f"{analysis_path}/{folders}*{s_id}*.{data_fmt}")
+                for s_id in sample_ids
+            ]
         else:
-            if generalised:
-                fs = glob.glob(f"{analysis_path}/**/*.{data_fmt}")
-            else:
-                fs = glob.glob(f"{analysis_path}/*.{data_fmt}")
+            sample_fps = index.find_samples(pattern, sample_ids)
+        for s_id, f in zip(sample_ids, sample_fps):
+            fs.append(f)
+            file_paths[s_id].extend(f[:1])
+    else:
+        fs = (
+            glob.glob(f"{analysis_path}/{pattern}")
+            if index is None
+            else index.find(pattern)
+        )
         for f in fs:
-            try:
-                sample_id = f.split("/")[-1].split("_")[0]
-            except:
-                sample_id = f.split("/")[-1]
+            sample_id = f.split("/")[-1].split("_")[0]
             file_paths[sample_id].append(f)
     if return_type == "dict":
         return file_paths
@@ -305,12 +641,16 @@ def get_filepaths(
 
 
 def get_variant_filepaths(
-    sample_ids: list, analysis_path: str = "/home/gk/analysis"
+    sample_ids: list,
+    analysis_path: str = "/home/gk/analysis",
+    index: AnalysisIndex = None,
 ) -> dict:
     """Takes list of sample IDs and returns filepaths of variant data for corresponding samples"""
+    if index is None:
+        index = AnalysisIndex(analysis_path)
     variant_paths = {}
-    for s_id in sample_ids:
-        f = glob.glob(f"{analysis_path}/**/variants/illumina/*{s_id}*.tsv")
+    sample_fps = index.find_samples("**/variants/illumina/*.tsv", sample_ids)
+    for s_id, f in zip(sample_ids, sample_fps):
         variant_paths[s_id] = f[0]
     return variant_paths
 
@@ -320,17 +660,327 @@ def find_loc(f: str):
     return f.split("/")[-1].split("_")[0].split("-")[-1]
 
 
-def get_variant_data(variant_filepaths: dict):
-    """Takes dict of variant filepaths and loads all variant data into dataframe"""
-    df = pd.concat(
-        (
-            pd.read_csv(f, sep="\t").assign(sample=s_id, location=find_loc(f))
-            for s_id, f in variant_filepaths.items()
+# column types of the variant calls (TSV) of iVar, text columns are categorical
+IVAR_VARIANT_DTYPES = {
+    "REGION": "category",
+    "POS": "int32",
+    "REF": "category",
+    "ALT": "category",
+    "REF_DP": "int32",
+    "REF_RV": "int32",
+    "REF_QUAL": "int32",
+    "ALT_DP": "int32",
+    "ALT_RV": "int32",
+    "ALT_QUAL": "int32",
+    "ALT_FREQ": "float64",
+    "TOTAL_DP": "int32",
+    "PVAL": "float64",
+    "PASS": "bool",
+    "GFF_FEATURE": "category",
+    "REF_CODON": "category",
+    "REF_AA": "category",
+    "ALT_CODON": "category",
+    "ALT_AA": "category",
+    "POS_AA": "float64",
+}
+
+
+@traced
+def load_variants(
+    filepaths: list,
+    sample_ids: list,
+    columns: list = None,
+    min_freq: float = None,
+    max_freq: float = None,
+    sample_col: str = "sample",
+    num_workers: int = 8,
+) -> pd.DataFrame:
+    """Loads the iVar variant calls (TSV) of each sample into a single data frame.
+    Files are read in parallel (`num_workers` threads) and the ones with the same columns are
+    parsed at once, reading only `columns` (all if None) with the types of `IVAR_VARIANT_DTYPES`.
+    Variants with frequencies outside of `min_freq` and `max_freq` (exclusive) are dropped
+    before the frames are put together. Text columns, including `sample_col`, are categorical"""
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        files = list(pool.map(read_variant_file, filepaths))
+    if not files:
+        return pd.DataFrame(columns=(columns or []) + [sample_col])
+    usecols = None
+    if columns is not None:
+        usecols = set(columns)
+        if min_freq is not None or max_freq is not None:
+            usecols.add("ALT_FREQ")
+    # text columns are read as strings and made categorical once all files are put together,
+    # which is cheaper than building the categories of each file
+    dtypes = {
+        c: object if t == "category" else t for c, t in IVAR_VARIANT_DTYPES.items()
+    }
+    samples = pd.Categorical(sample_ids)
+    # files with the same header (iVar version)
+    file_groups = defaultdict(list)
+    for i, (header, _, _) in enumerate(files):
+        file_groups[header].append(i)
+    dfs = []
+    for header, file_idxs in file_groups.items():
+        rows = [files[i][1] for i in file_idxs if files[i][2]]
+        num_rows = [files[i][2] for i in file_idxs]
+        df = read_variant_rows([header] + rows, usecols, dtypes)
+        if df.shape[0] != sum(num_rows):
+            # blank lines, rows can't be traced back to their files: parse files one by one
+            file_dfs = [
+                read_variant_rows([header, files[i][1]], usecols, dtypes)
+                for i in file_idxs
+            ]
+            num_rows = [file_df.shape[0] for file_df in file_dfs]
+            df = pd.concat(file_dfs, ignore_index=True)
+        df["_file"] = np.repeat(file_idxs, num_rows)
+        keep = np.ones(df.shape[0], dtype=bool)
+        if min_freq is not None:
+            keep &= (df["ALT_FREQ"] > min_freq).values
+        if max_freq is not None:
+            keep &= (df["ALT_FREQ"] < max_freq).values
+        if columns is not None:
+            df = df[[c for c in columns if c in df.columns] + ["_file"]]
+        dfs.append(df.loc[keep])
+    df = pd.concat(dfs, ignore_index=True)
+    if len(dfs) > 1:
+        # back to the order of the files
+        df = df.iloc[np.argsort(df["_file"].values, kind="stable")].reset_index(drop=True)
+    for c in df.columns:
+        if IVAR_VARIANT_DTYPES.get(c) == "category":
+            df[c] = df[c].astype("category")
+    df[sample_col] = pd.Categorical.from_codes(
+        samples.codes[df.pop("_file").values], dtype=samples.dtype
+    )
+    return df
+
+
+def read_variant_rows(lines: list, usecols: set, dtypes: dict) -> pd.DataFrame:
+    """Parses the lines (header first) of a variant calls TSV"""
+    return pd.read_csv(
+        io.BytesIO(b"\n".join(lines)),
+        sep="\t",
+        usecols=None if usecols is None else lambda c: c in usecols,
+        dtype=dtypes,
+    )
+
+
+def read_variant_file(fp) -> tuple:
+    """Returns the header, the rows (without trailing line breaks) and the number of rows of a TSV file"""
+    with open(fp, "rb") as handle:
+        header = handle.readline().rstrip(b"\r\n")
+        rows = handle.read().rstrip(b"\r\n")
+    return header, rows, rows.count(b"\n") + 1 if rows else 0
+
+
+class VariantStore:
+    """Columnar (Parquet) store of the iVar variant calls found in an analysis folder, partitioned by run.
+    Each ingest appends the variant TSVs found since the last one as a new Parquet file of their run
+    (runs whose TSVs were modified or removed are rebuilt). A SQLite catalog records the ingested TSVs
+    and, for each Parquet file, its samples and range of positions and frequencies, so that queries
+    only open the files that can hold matching variants; filters are then pushed down to the
+    row groups of these files (rows are sorted by position)"""
+
+    def __init__(self, store_dir: str):
+        self.store_dir = str(store_dir)
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.db = sqlite3.connect(
+            os.path.join(self.store_dir, "catalog.sqlite"), timeout=60
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS tsvs (path TEXT PRIMARY KEY, run TEXT NOT NULL,
+                                                sample_id TEXT NOT NULL, part TEXT NOT NULL,
+                                                mtime INTEGER NOT NULL, size INTEGER NOT NULL)"""
         )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS parts (part TEXT PRIMARY KEY, run TEXT NOT NULL,
+                                                 num_rows INTEGER NOT NULL,
+                                                 min_pos INTEGER, max_pos INTEGER,
+                                                 min_freq REAL, max_freq REAL)"""
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS part_samples (part TEXT NOT NULL, sample_id TEXT NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS part_samples_sample_id ON part_samples (sample_id)"
+        )
+        self.db.commit()
+
+    def ingest(
+        self,
+        index: AnalysisIndex,
+        pattern: str = "**/variants/illumina/*.tsv",
+        num_workers: int = 8,
+        row_group_size: int = 2**16,
+    ) -> int:
+        """Adds the variant TSVs of an indexed analysis folder (matching `pattern`) that were not
+        ingested yet, returns the number of TSVs ingested"""
+        found = {}
+        for fp in index.find(pattern):
+            try:
+                fp_stat = os.stat(fp)
+            except OSError:
+                continue
+            found[fp] = (fp_stat.st_mtime_ns, fp_stat.st_size)
+        known = {
+            fp: (run, (mtime, size))
+            for fp, run, mtime, size in self.db.execute(
+                "SELECT path, run, mtime, size FROM tsvs"
+            )
+        }
+        # runs with TSVs that were modified or removed since they were ingested are rebuilt
+        stale_runs = {run for fp, (run, stamp) in known.items() if found.get(fp) != stamp}
+        for run in stale_runs:
+            self.drop_run(run)
+        new_fps = defaultdict(list)
+        for fp in found:
+            if fp not in known or known[fp][0] in stale_runs:
+                run = fp[len(index.analysis_path) :].strip("/").split("/")[0]
+                new_fps[run].append(fp)
+        for run, fps in new_fps.items():
+            self.add_part(run, fps, found, num_workers, row_group_size)
+        return sum(len(fps) for fps in new_fps.values())
+
+    def add_part(
+        self, run: str, fps: list, stamps: dict, num_workers: int, row_group_size: int
+    ):
+        """Writes the variants of the given TSVs of a run as a new Parquet file and adds it to the catalog"""
+        sample_ids = [fp.split("/")[-1].split("_")[0] for fp in fps]
+        df = load_variants(fps, sample_ids, num_workers=num_workers)
+        df = df.sort_values(["POS", "sample"], kind="stable", ignore_index=True)
+        num_parts = self.db.execute(
+            "SELECT COUNT(*) FROM parts WHERE run=?", (run,)
+        ).fetchone()[0]
+        part = os.path.join(run, f"part-{num_parts:05d}.parquet")
+        part_fp = os.path.join(self.store_dir, part)
+        os.makedirs(os.path.dirname(part_fp), exist_ok=True)
+        # only cataloged files are queried, an interrupted write leaves nothing behind
+        df.to_parquet(part_fp + ".tmp", index=False, row_group_size=row_group_size)
+        os.replace(part_fp + ".tmp", part_fp)
+        has_rows = df.shape[0] > 0
+        self.db.execute(
+            "INSERT OR REPLACE INTO parts VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                part,
+                run,
+                df.shape[0],
+                int(df["POS"].min()) if has_rows else None,
+                int(df["POS"].max()) if has_rows else None,
+                float(df["ALT_FREQ"].min()) if has_rows else None,
+                float(df["ALT_FREQ"].max()) if has_rows else None,
+            ),
+        )
+        self.db.executemany(
+            "INSERT INTO part_samples VALUES (?, ?)",
+            [(part, s_id) for s_id in set(sample_ids)],
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO tsvs VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (fp, run, s_id, part) + stamps[fp]
+                for fp, s_id in zip(fps, sample_ids)
+            ],
+        )
+        self.db.commit()
+
+    def drop_run(self, run: str):
+        """Removes the Parquet files of a run and their TSVs from the store"""
+        parts = [
+            part
+            for (part,) in self.db.execute("SELECT part FROM parts WHERE run=?", (run,))
+        ]
+        self.db.executemany(
+            "DELETE FROM part_samples WHERE part=?", [(part,) for part in parts]
+        )
+        self.db.execute("DELETE FROM parts WHERE run=?", (run,))
+        self.db.execute("DELETE FROM tsvs WHERE run=?", (run,))
+        self.db.commit()
+        for part in parts:
+            try:
+                os.remove(os.path.join(self.store_dir, part))
+            except OSError:
+                pass
+
+    def query(
+        self,
+        samples: list = None,
+        min_freq: float = None,
+        max_freq: float = None,
+        min_pos: int = None,
+        max_pos: int = None,
+        runs: list = None,
+        columns: list = None,
+    ) -> pd.DataFrame:
+        """Returns the variants of the given samples and runs (all if None), with frequencies between
+        `min_freq` and `max_freq` (exclusive) and positions between `min_pos` and `max_pos` (inclusive).
+        Only `columns` are loaded (all if None), along with the sample and run"""
+        conditions, params, filters = [], [], []
+        if samples is not None:
+            samples = list(samples)
+            conditions.append(
+                f"part IN (SELECT part FROM part_samples WHERE sample_id IN ({','.join('?' * len(samples))}))"
+            )
+            params += samples
+            filters.append(("sample", "in", samples))
+        if runs is not None:
+            runs = list(runs)
+            conditions.append(f"run IN ({','.join('?' * len(runs))})")
+            params += runs
+        if min_freq is not None:
+            conditions.append("max_freq > ?")
+            params.append(min_freq)
+            filters.append(("ALT_FREQ", ">", min_freq))
+        if max_freq is not None:
+            conditions.append("min_freq < ?")
+            params.append(max_freq)
+            filters.append(("ALT_FREQ", "<", max_freq))
+        if min_pos is not None:
+            conditions.append("max_pos >= ?")
+            params.append(min_pos)
+            filters.append(("POS", ">=", min_pos))
+        if max_pos is not None:
+            conditions.append("min_pos <= ?")
+            params.append(max_pos)
+            filters.append(("POS", "<=", max_pos))
+        query = "SELECT part, run FROM parts WHERE num_rows > 0"
+        if conditions:
+            query += " AND " + " AND ".join(conditions)
+        if columns is not None:
+            columns = [c for c in columns if c not in ("sample", "run")] + ["sample"]
+        dfs = [
+            pd.read_parquet(
+                os.path.join(self.store_dir, part),
+                columns=columns,
+                filters=filters or None,
+            ).assign(run=run)
+            for part, run in self.db.execute(query + " ORDER BY rowid", params)
+        ]
+        if not dfs:
+            return pd.DataFrame(columns=(columns or ["sample"]) + ["run"])
+        df = pd.concat(dfs, ignore_index=True)
+        for c in df.columns:
+            if c in ("sample", "run") or IVAR_VARIANT_DTYPES.get(c) == "category":
+                df[c] = df[c].astype("category")
+        return df
+
+    def close(self):
+        self.db.close()
+
+
+@traced
+def get_variant_data(variant_filepaths: dict, num_workers: int = 8):
+    """Takes dict of variant filepaths and loads all variant data into dataframe"""
+    df = load_variants(
+        list(variant_filepaths.values()),
+        list(variant_filepaths.keys()),
+        num_workers=num_workers,
+    )
+    df["location"] = df["sample"].map(
+        {s_id: find_loc(f) for s_id, f in variant_filepaths.items()}
     )
     return df
 
 
+@traced
 def load_fasta(fasta_filepath, is_gzip=False, is_aligned=False):
     if is_gzip:
         with gzip.open(fasta_filepath, "rt") as handle:
@@ -385,33 +1035,130 @@ def sample_fasta(fasta_filepath, out_filepath, sample_size=100):
 def concat_fasta(in_dir, out_dir):
     """Concatenate fasta sequences into single fasta file"""
     cat_cmd = f"cat {in_dir}/*.fa* > {out_dir}.fa"
-    subprocess.check_call(cat_cmd, shell=True)
+    run_command(cat_cmd, check=True)
     return f"{out_dir}.fa"
 
 
-def run_command(cmd):
-    "helper function used to run bash commands"
-    # run it
-    p = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE)
-    # But do not wait till netstat finish, start displaying output immediately
-    while True:
-        out = p.stderr.read(1)
-        if out == b"" and p.poll() != None:
-            break
-        if out != b"":
-            sys.stdout.write(out.decode("utf-8"))
-            sys.stdout.flush()
+def run_command(
+    cmd,
+    timeout: float = None,
+    cancel=None,
+    check: bool = False,
+    echo: bool = True,
+    tail_lines: int = 100,
+) -> dict:
+    """helper function used to run bash commands.
+    stdout and stderr are read concurrently and echoed line by line as the command writes them.
+    Returns the exit status (`returncode`) along with the last `tail_lines` lines of `stdout` and `stderr`.
+    If `tail_lines` is None, all lines are returned, along with the exact output of the command
+    (`stdout_text` and `stderr_text`). The command and its children are killed once `timeout` seconds have passed
+    or when `cancel` (a `threading.Event`) is set, which is reported as `timed_out` or `cancelled`.
+    With `check`, raises `subprocess.CalledProcessError` if the command fails"""
+    # own process group, so that the children of the shell are killed along with it
+    p = subprocess.Popen(
+        cmd,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+    )
+    tails = {p.stdout: deque(maxlen=tail_lines), p.stderr: deque(maxlen=tail_lines)}
+    partial_lines = {p.stdout: b"", p.stderr: b""}
+    # complete output, only kept when all lines are requested
+    outputs = {p.stdout: [], p.stderr: []} if tail_lines is None else None
+    result = {"timed_out": False, "cancelled": False}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    sel = selectors.DefaultSelector()
+    sel.register(p.stdout, selectors.EVENT_READ)
+    sel.register(p.stderr, selectors.EVENT_READ)
+    try:
+        while sel.get_map():
+            # wake up regularly to check for cancellation
+            wait = None if cancel is None else 0.5
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    result["timed_out"] = True
+                    break
+                wait = remaining if wait is None else min(wait, remaining)
+            if cancel is not None and cancel.is_set():
+                result["cancelled"] = True
+                break
+            for key, _ in sel.select(wait):
+                data = os.read(key.fd, 2**16)
+                if outputs is not None:
+                    outputs[key.fileobj].append(data)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    lines = [partial_lines[key.fileobj]] if partial_lines[key.fileobj] else []
+                else:
+                    lines = (partial_lines[key.fileobj] + data).split(b"\n")
+                    partial_lines[key.fileobj] = lines.pop()
+                    # no line breaks (e.g. binary output), don't buffer it all
+                    if len(partial_lines[key.fileobj]) > 2**20:
+                        lines.append(partial_lines[key.fileobj])
+                        partial_lines[key.fileobj] = b""
+                for line in lines:
+                    line = line.decode("utf-8", errors="replace")
+                    tails[key.fileobj].append(line)
+                    if echo:
+                        sys.stdout.write(line + "\n")
+                if echo and lines:
+                    sys.stdout.flush()
+    except BaseException:
+        # e.g. KeyboardInterrupt, the command no longer receives it from the terminal
+        kill_process_group(p)
+        raise
+    finally:
+        sel.close()
+    if deadline is not None and not (result["timed_out"] or result["cancelled"]):
+        # output closed, the command may still be running
+        try:
+            p.wait(timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            result["timed_out"] = True
+    if result["timed_out"] or result["cancelled"]:
+        kill_process_group(p)
+    p.stdout.close()
+    p.stderr.close()
+    result["returncode"] = p.wait()
+    if outputs is not None:
+        for name, f in [("stdout", p.stdout), ("stderr", p.stderr)]:
+            result[f"{name}_text"] = b"".join(outputs[f]).decode("utf-8", errors="replace")
+            result[name] = result[f"{name}_text"].splitlines()
+    else:
+        result["stdout"] = list(tails[p.stdout])
+        result["stderr"] = list(tails[p.stderr])
+    if result["timed_out"]:
+        print(f"Command timed out after {timeout}s: {cmd}")
+    elif result["cancelled"]:
+        print(f"Command cancelled: {cmd}")
+    if check and result["returncode"] != 0:
+        raise subprocess.CalledProcessError(
+            result["returncode"],
+            cmd,
+            output="\n".join(result["stdout"]),
+            stderr="\n".join(result["stderr"]),
+        )
+    return result
+
+
+def kill_process_group(p: subprocess.Popen, grace_period: float = 5):
+    """Terminates a command started by `run_command` and its children, killing them if they are
+    still running after `grace_period` seconds"""
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        p.wait(timeout=grace_period)
+    except subprocess.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
 
 
 def run_command_log(cmd):
-    "helper function used to run bash commands"
-    # run it
-    p = subprocess.Popen(
-        cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    # But do not wait till netstat finish, start displaying output immediately
-    out = p.stdout.read()
-    return out.decode("utf-8")
+    "helper function used to run bash commands, returns their output (stdout)"
+    result = run_command(cmd, echo=False, tail_lines=None)
+    return result["stdout_text"]
 
 
 def align_fasta(fasta_filepath, out_filepath, num_cpus=8):
@@ -421,6 +1168,7 @@ def align_fasta(fasta_filepath, out_filepath, num_cpus=8):
     run_command(msa_cmd)
     return out_filepath
 
+@traced
 def gofasta_align(fasta_filepaths, indiv_out_filepath, out_filepath):
     """
     Gets a combined fasta file with all the sequences
@@ -492,7 +1240,7 @@ def compute_time_tree(msa_filepath, tree_filepath, num_cpus=8):
     """Compute time tree (???)"""
     out_path = "/".join(msa_filepath.split("/")[:-1]) + "/timetree"
     tree_cmd = f"treetime ancestral --aln {msa_filepath} --tree {tree_filepath} --outdir {out_path}"
-    subprocess.check_call(tree_cmd, shell=True)
+    run_command(tree_cmd, check=True)
     return out_path
 
 
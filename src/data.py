@@ -87,6 +87,72 @@ GENE2POS = {
            }
 
 
+# rules flagging mutations that require manual inspection before release, unless found in a non-concerning 
+# gene or listed as a non-concerning mutation (see `config.json`): stop codons and frameshifting indels
+SUSPICIOUS_MUTATION_RULES = [
+                             {'type': 'substitution', 'column': 'alt_aa', 'values': ['*']},
+                             {'type': 'deletion', 'column': 'is_frameshift', 'values': [True]},
+                             {'type': 'insertion', 'column': 'is_frameshift', 'values': [True]}
+                            ]
+
+
+# version of the genome annotation (and of the way mutations are annotated), to be increased whenever
+# either changes such that previously cached mutations are not used anymore
+ANNOTATION_VERSION = '1'
+
+
+# nucleotide intervals (start, end] used to assign positions to genes, consistent with `map_gene_to_pos`
+# positions before the first interval or after the last one belong to the 5UTR and 3UTR, respectively
+GENE2INTERVAL = {
+            '5UTR': {'start': 0, 'end': 265},
+            'ORF1a': {'start': 265, 'end': 13466},
+            'ORF1b': {'start': 13466, 'end': 21555},
+            'S': {'start': 21562, 'end': 25384},
+            'ORF3a': {'start': 25392, 'end': 26220},
+            'E': {'start': 26244, 'end': 26472},
+            'M': {'start': 26522, 'end': 27191},
+            'ORF6': {'start': 27201, 'end': 27387},
+            'ORF7a': {'start': 27393, 'end': 27759},
+            'ORF7b': {'start': 27759, 'end': 27887},
+            'ORF8': {'start': 27893, 'end': 28259},
+            'N': {'start': 28273, 'end': 29533},
+            'ORF10': {'start': 29557, 'end': 29674},
+            '3UTR': {'start': 29674, 'end': 29903}
+           }
+
+
+CODON2AA = { 
+    'ATA':'I', 'ATC':'I', 'ATT':'I', 'ATG':'M', 
+    'ACA':'T', 'ACC':'T', 'ACG':'T', 'ACT':'T', 
+    'AAC':'N', 'AAT':'N', 'AAA':'K', 'AAG':'K', 
+    'AGC':'S', 'AGT':'S', 'AGA':'R', 'AGG':'R',                  
+    'CTA':'L', 'CTC':'L', 'CTG':'L', 'CTT':'L', 
+    'CCA':'P', 'CCC':'P', 'CCG':'P', 'CCT':'P', 
+    'CAC':'H', 'CAT':'H', 'CAA':'Q', 'CAG':'Q', 
+    'CGA':'R', 'CGC':'R', 'CGG':'R', 'CGT':'R', 
+    'GTA':'V', 'GTC':'V', 'GTG':'V', 'GTT':'V', 
+    'GCA':'A', 'GCC':'A', 'GCG':'A', 'GCT':'A', 
+    'GAC':'D', 'GAT':'D', 'GAA':'E', 'GAG':'E', 
+    'GGA':'G', 'GGC':'G', 'GGG':'G', 'GGT':'G', 
+    'TCA':'S', 'TCC':'S', 'TCG':'S', 'TCT':'S', 
+    'TTC':'F', 'TTT':'F', 'TTA':'L', 'TTG':'L', 
+    'TAC':'Y', 'TAT':'Y', 'TAA':'*', 'TAG':'*', 
+    'TGC':'C', 'TGT':'C', 'TGA':'*', 'TGG':'W', 
+}
+
+
+# types of the sample metadata columns used when calling mutations (for each data source),
+# the other columns of the metadata are loaded with their inferred types
+META_SCHEMA = {
+    'alab': {'ID': str, 'fasta_hdr': str, 'collection_date': str, 'location': str},
+    'gisaid': {'strain': str, 'date': str, 'host': str, 'location': str, 
+               'division': str, 'country': str, 'pangolin_lineage': str},
+    'gisaid_feed': {'strain': str, 'date': str, 'date_collected': str, 'date_submitted': str, 
+                    'location': str, 'division': str, 'country': str, 'location_normed': str, 
+                    'division_normed': str, 'country_normed': str, 'pangolin_lineage': str}
+}
+
+
 GENE2NTCOORDS = {
     'ORF1a': 0,
     'ORF1b': 13201,
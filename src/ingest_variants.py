@@ -0,0 +1,60 @@
+import argparse
+import time
+
+import bjorn_support as bs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Add the iVar variant calls (TSV) of an analysis folder to a Parquet variant store, partitioned by run"
+    )
+
+    parser.add_argument(
+        "-a",
+        "--analysis-folder",
+        type=str,
+        required=True,
+        help="Path to the analysis folder that contains all the files",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--store",
+        type=str,
+        required=True,
+        help="Path to the variant store (created if it does not exist)",
+    )
+
+    parser.add_argument(
+        "--analysis-manifest",
+        type=str,
+        default=None,
+        help="(Optional) path to the manifest of the analysis folder, kept up to date across runs (default: <analysis-folder>.manifest.sqlite)",
+    )
+
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        default="**/variants/illumina/*.tsv",
+        help="Glob pattern of the variant TSVs, relative to the analysis folder",
+    )
+
+    parser.add_argument(
+        "--num-workers", type=int, default=8, help="Number of threads reading TSVs"
+    )
+
+    args = parser.parse_args()
+    analysis_fpath = args.analysis_folder
+    analysis_manifest_fp = args.analysis_manifest
+    if analysis_manifest_fp is None:
+        analysis_manifest_fp = analysis_fpath.rstrip("/") + ".manifest.sqlite"
+    start_time = time.time()
+    analysis_index = bs.AnalysisIndex(analysis_fpath, manifest_fp=analysis_manifest_fp)
+    store = bs.VariantStore(args.store)
+    num_ingested = store.ingest(
+        analysis_index, pattern=args.pattern, num_workers=args.num_workers
+    )
+    store.close()
+    print(
+        f"Ingested {num_ingested} variant files into {args.store} in {time.time() - start_time:.1f}s"
+    )
@@ -1,145 +1,386 @@
-import gc
+import gzip
+import hashlib
+import json
 import math
+import os
 import re
+import sqlite3
+import tempfile
+import time
 import numpy as np
 import pandas as pd
 
 import more_itertools as mit
 from Bio import Seq, SeqIO, Align
-from bjorn_support import map_gene_to_pos
+from Bio.SeqRecord import SeqRecord
+from bjorn_support import batch_iterator, traced, stage
 import data as bd
 
 from typing import Tuple
 
+@traced
 def identify_samples_with_suspicious_mutations(substitutions: pd.DataFrame, 
                                                deletions: pd.DataFrame, 
                                                insertions: pd.DataFrame,
                                                nonconcerning_genes: list,
-                                               nonconcerning_mutations: list):
-    """Returns list of sample IDs that have triggered an insertion, deletion, and/or 
+                                               nonconcerning_mutations: list,
+                                               rules: 'SuspiciousMutationRules'=None,
+                                               matrices: dict=None) -> Tuple[set, pd.DataFrame]:
+    """Returns set of sample IDs that have triggered an insertion, deletion, and/or 
     substitution-based flag, indicating that they require further manual inspection 
-    before public release"""
+    before public release. Pre-compiled `rules` (see `SuspiciousMutationRules`) take 
+    precedence over the non-concerning genes and mutations.
+    Sample IDs are taken from the sample x mutation `matrices` of each type of mutation 
+    (see `MutationMatrix`) if given, otherwise from the samples listed for each flagged mutation"""
     # nonconcerning_genes = ['5UTR', 'ORF7a', 'ORF7b', 'ORF8', 'ORF10', 'Non-coding region']
     cols = ['type', 'mutation', 'absolute_coords', 'gene', 'ref_codon', 'alt_codon', 'pos', 'ref_aa',
        'codon_num', 'alt_aa', 'num_samples',
        'is_frameshift', 'indel_len', 'indel_seq', 'relative_coords',
        'prev_10nts', 'next_10nts', 'samples']
-    try:
-        subs_flag = ((substitutions['alt_aa']=='*') & (~substitutions['gene'].isin(nonconcerning_genes)) & (~substitutions['mutation'].isin(nonconcerning_mutations))) 
-        sus_subs_ids = substitutions.loc[subs_flag, 'samples'].str.split(',').explode().unique().tolist()
-        sus_subs = substitutions.loc[subs_flag]
-    except:
-        sus_subs_ids = []
-        sus_subs = pd.DataFrame()
-    try:
-        dels_flag = ((deletions['is_frameshift']==True) & (~deletions['gene'].isin(nonconcerning_genes)) & (~deletions['mutation'].isin(nonconcerning_mutations)))
-        sus_dels_ids = deletions.loc[dels_flag, 'samples'].str.split(',').explode().unique().tolist()
-        sus_dels = deletions.loc[dels_flag]
-    except:
-        sus_dels_ids = []
-        sus_dels = pd.DataFrame()
-    try:
-        ins_flag = ((insertions['is_frameshift']==True) & (~insertions['gene'].isin(nonconcerning_genes)) & (~insertions['mutation'].isin(nonconcerning_mutations)))
-        sus_ins_ids = insertions.loc[ins_flag, 'samples'].str.split(',').explode().unique().tolist()
-        sus_inss = insertions.loc[ins_flag]
-    except:
-        sus_ins_ids = []
-        sus_inss = pd.DataFrame()
-    sus_subs = sus_subs.loc[:,~sus_subs.columns.duplicated()]
-    sus_dels = sus_dels.loc[:,~sus_dels.columns.duplicated()]
-    sus_inss = sus_inss.loc[:,~sus_inss.columns.duplicated()]
-    sus_mutations = pd.concat([sus_subs, sus_dels, sus_inss])
-    try:
-        sus_mutations = sus_mutations[cols]
-    except:
-        pass
-    sus_ids = list(set(sus_subs_ids + sus_dels_ids + sus_ins_ids))
+    if rules is None:
+        rules = SuspiciousMutationRules(nonconcerning_genes, nonconcerning_mutations)
+    mutations = {'substitution': substitutions, 'deletion': deletions, 'insertion': insertions}
+    mutations = {mut_type: df.loc[:, ~df.columns.duplicated()] for mut_type, df in mutations.items()}
+    # all mutation types are flagged at once
+    flags = rules.flag(mutations)
+    sus_mutations = pd.concat([df.loc[flags[mut_type]] for mut_type, df in mutations.items()])
+    sus_mutations = sus_mutations[[col for col in cols if col in sus_mutations.columns]]
+    sus_ids = set()
+    if matrices is not None:
+        # the mutations of each matrix are flagged the same way, then mapped to their samples
+        matrix_flags = rules.flag({mut_type: matrix.mutations for mut_type, matrix in matrices.items()})
+        for mut_type, matrix in matrices.items():
+            sus_ids.update(matrix.get_mutation_samples(matrix_flags[mut_type]).tolist())
+    elif 'samples' in sus_mutations.columns:
+        # sample IDs are listed (comma-separated) for each flagged mutation
+        for samples in sus_mutations['samples'].dropna():
+            sus_ids.update(samples.split(','))
     return sus_ids, sus_mutations
 
+
+class SuspiciousMutationRules:
+    """Rules for flagging suspicious mutations (see `bd.SUSPICIOUS_MUTATION_RULES`), compiled once and then 
+    evaluated on integer codes (`pd.factorize`) of each column, so that each distinct value is only checked once"""
+
+    def __init__(self, nonconcerning_genes: list, nonconcerning_mutations: list, 
+                 rules: list=bd.SUSPICIOUS_MUTATION_RULES):
+        self.nonconcerning_genes = frozenset(nonconcerning_genes)
+        self.nonconcerning_mutations = frozenset(nonconcerning_mutations)
+        # flagged values of each column, for each mutation type
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule['type'], {}).setdefault(rule['column'], set()).update(rule['values'])
+
+    @classmethod
+    def from_config(cls, config_fp: str):
+        """Loads the rules from a JSON file with the lists of `nonconcerning_genes` and `nonconcerning_mutations`, 
+        along with (optional) additional `suspicious_rules` in the same format as `bd.SUSPICIOUS_MUTATION_RULES`"""
+        with open(config_fp, 'r') as f:
+            config = json.load(f)
+        rules = bd.SUSPICIOUS_MUTATION_RULES + config.get('suspicious_rules', [])
+        return cls(config.get('nonconcerning_genes', []), config.get('nonconcerning_mutations', []), rules)
+
+    def flag(self, mutations: dict) -> dict:
+        """Returns a boolean mask of the suspicious mutations for each type of mutation (dataframe) in `mutations`.
+        Mutations without a gene and name (e.g. empty dataframes) are never flagged"""
+        flags = {mut_type: np.zeros(df.shape[0], dtype=bool) for mut_type, df in mutations.items()}
+        mutations = {mut_type: df for mut_type, df in mutations.items() 
+                     if df.shape[0] > 0 and 'gene' in df.columns and 'mutation' in df.columns}
+        if not mutations:
+            return flags
+        # single table of the columns used by the rules, along with the type of each mutation
+        columns = {col for mut_type in mutations for col in self.rules.get(mut_type, {})}
+        data = pd.concat([df[[col for col in df.columns if col in columns or col in ('gene', 'mutation')]] 
+                          for df in mutations.values()], keys=list(mutations.keys()))
+        type_codes, types = pd.factorize(data.index.get_level_values(0))
+        is_flagged = np.zeros(data.shape[0], dtype=bool)
+        for col in columns & set(data.columns):
+            value_codes, values = pd.factorize(data[col])
+            for code, mut_type in enumerate(types):
+                flagged_values = self.rules.get(mut_type, {}).get(col)
+                if flagged_values:
+                    is_flagged |= (type_codes == code) & self.is_listed_code(values, flagged_values)[value_codes]
+        is_flagged &= ~self.is_listed(data['gene'], self.nonconcerning_genes)
+        is_flagged &= ~self.is_listed(data['mutation'], self.nonconcerning_mutations)
+        # split the flags back into each type of mutation
+        offsets = np.cumsum([0] + [df.shape[0] for df in mutations.values()])
+        for mut_type, start, end in zip(mutations, offsets[:-1], offsets[1:]):
+            flags[mut_type] = is_flagged[start:end]
+        return flags
+
+    @classmethod
+    def is_listed(cls, col: pd.Series, values: frozenset) -> np.ndarray:
+        """helper function to check whether each value of a column is listed, once per distinct value"""
+        codes, uniques = pd.factorize(col)
+        return cls.is_listed_code(uniques, values)[codes]
+
+    @staticmethod
+    def is_listed_code(uniques, values) -> np.ndarray:
+        """helper function to check whether each distinct value is listed, indexed by its code 
+        (the last entry stands for missing values, whose code is -1)"""
+        return np.array([value in values for value in uniques] + [False], dtype=bool)
+
+
+@traced
 def aggregate_replacements(subs: pd.DataFrame, 
                            date: str,
-                           data_src: str):
+                           data_src: str,
+                           store_dir: str=None):
     """Return a dataframe containing all substitution-based mutations (inside open reading frames)
-    The data is aggregated on each type of mutation e.g. S:N501Y"""
-    if data_src=='gisaid':
-        subs.rename(columns={'date': 'date_collected'}, inplace=True)
-    subs.loc[:, 'tmp'] = subs['date_collected'].str.split('-').copy()
-    subs = subs[subs['tmp'].str.len()>=2].copy()
-    subs['date_collected'] = subs['date_collected'].astype(str)
-    subs.loc[subs['tmp'].str.len()==2, 'date_collected'] += '-15'
-    subs = subs[subs['date_collected']<date].copy()
-    subs.loc[:, 'date_collected'] = pd.to_datetime(subs['date_collected'], errors='coerce')
-    # aggregate on mutation
-    subs_agg = (subs.groupby(['mutation', 'gene', 'ref_codon', 'pos', 'alt_codon', 'ref_aa', 'codon_num', 'alt_aa'])
-                .agg(
-                 num_samples=('strain', 'nunique'),
-                 first_detected=('date_collected', 'min'),
-                 last_detected=('date_collected', 'max'),
-                 num_locations=('location_normed', 'nunique'),
-                 location_counts=('location_normed', 
-                                  lambda x: np.unique(x, 
-                                                      return_counts=True)),
-                 num_divisions=('division_normed', 'nunique'),
-                 division_counts=('division_normed', 
-                                  lambda x: np.unique(x, 
-                                                      return_counts=True)),
-                 num_countries=('country_normed', 'nunique'),
-                 country_counts=('country_normed', 
-                                 lambda x: np.unique(x, 
-                                                     return_counts=True))
-                )
-                .reset_index())
-    subs_agg.loc[:, 'divisions'] = subs_agg['division_counts'].apply(lambda x: x[0]).apply(lambda x: ','.join(x))
-    # subs['divisions'] = subs['divisions'].apply(process_list).astype(str)
-    subs_agg.loc[:, 'division_counts'] = subs_agg['division_counts'].apply(lambda x: x[1]).apply(lambda x: ','.join(map(str, x)))
-    # subs['division_counts'] = subs['division_counts'].apply(process_list).astype(str)
-    subs_agg.loc[:, 'countries'] = subs_agg['country_counts'].apply(lambda x: x[0]).apply(lambda x: ','.join(x))#.astype(str)
-    # subs['countries'] = subs['countries'].apply(process_list).astype(str)
-    subs_agg.loc[:, 'country_counts'] = subs_agg['country_counts'].apply(lambda x: x[1]).apply(lambda x: ','.join(map(str, x)))
-    return subs_agg
+    The data is aggregated on each type of mutation e.g. S:N501Y. 
+    If `store_dir` is given, `subs` is only expected to contain the newly submitted samples, which are 
+    added to the aggregates persisted in `store_dir` (see `update_aggregate_store`)"""
+    mutation_cols = ['mutation', 'gene', 'ref_codon', 'pos', 'alt_codon', 'ref_aa', 'codon_num', 'alt_aa']
+    if store_dir is not None:
+        return update_aggregate_store(store_dir, subs, date, data_src, mutation_cols)
+    return aggregate_mutations(subs, date, data_src, mutation_cols)
 
 
+@traced
 def aggregate_deletions(dels: pd.DataFrame, 
                         date: str,
-                        data_src: str):
+                        data_src: str,
+                        store_dir: str=None):
     """Return a dataframe containing all deletion-based mutations (inside open reading frames)
-    The data is aggregated on each type of mutation e.g. S:DEL69/70"""
+    The data is aggregated on each type of mutation e.g. S:DEL69/70. 
+    If `store_dir` is given, `dels` is only expected to contain the newly submitted samples, which are 
+    added to the aggregates persisted in `store_dir` (see `update_aggregate_store`)"""
+    mutation_cols = ['mutation', 'relative_coords', 'del_len']
+    if store_dir is not None:
+        return update_aggregate_store(store_dir, dels, date, data_src, mutation_cols)
+    return aggregate_mutations(dels, date, data_src, mutation_cols)
+
+
+# places for which the number of samples containing each mutation are counted
+PLACE_COLS = ['location_normed', 'division_normed', 'country_normed']
+
+
+def aggregate_mutations(muts: pd.DataFrame, 
+                        date: str,
+                        data_src: str,
+                        mutation_cols: list) -> pd.DataFrame:
+    """Return a dataframe containing the given mutations aggregated on `mutation_cols`, along with the number 
+    of samples, dates of detection and counts per location, division and country of each mutation"""
+    muts = filter_collection_dates(muts, date, data_src)
+    partials = compute_partial_aggregates(muts, mutation_cols)
+    return finalize_aggregates(partials, mutation_cols)
+
+
+def filter_collection_dates(muts: pd.DataFrame, date: str, data_src: str) -> pd.DataFrame:
+    """Keep mutations from samples collected before `date` with (at least) year and month of collection, 
+    defaulting to mid-month. Collection dates are converted to datetime"""
     if data_src=='gisaid':
-        dels.rename(columns={'date': 'date_collected'}, inplace=True)
-    dels.loc[:, 'tmp'] = dels['date_collected'].str.split('-').copy()
-    dels['date_collected'] = dels['date_collected'].astype(str)
-    dels = dels[dels['tmp'].str.len()>=2].copy()
-    dels.loc[dels['tmp'].str.len()==2, 'date_collected'] += '-15'
-    dels = dels[dels['date_collected']<date].copy()
-    dels.loc[:, 'date_collected'] = pd.to_datetime(dels['date_collected'], errors='coerce')
-    # aggregate on mutation
-    dels_agg = (dels.groupby(['mutation', 'relative_coords', 'del_len'])
-                .agg(
-                 num_samples=('strain', 'nunique'),
-                 first_detected=('date_collected', 'min'),
-                 last_detected=('date_collected', 'max'),
-                 num_locations=('location_normed', 'nunique'),
-                 location_counts=('location_normed', 
-                                  lambda x: np.unique(x, 
-                                                      return_counts=True)),
-                 num_divisions=('division_normed', 'nunique'),
-                 division_counts=('division_normed', 
-                                  lambda x: np.unique(x, 
-                                                      return_counts=True)),
-                 num_countries=('country_normed', 'nunique'),
-                 country_counts=('country_normed', 
-                                 lambda x: np.unique(x, 
-                                                     return_counts=True))
-                )
-                .reset_index())
-    dels_agg.loc[:, 'divisions'] = dels_agg['division_counts'].apply(lambda x: x[0]).apply(lambda x: ','.join(x))
-    # subs['divisions'] = subs['divisions'].apply(process_list).astype(str)
-    dels_agg.loc[:, 'division_counts'] = dels_agg['division_counts'].apply(lambda x: x[1]).apply(lambda x: ','.join(map(str, x)))
-    # subs['division_counts'] = subs['division_counts'].apply(process_list).astype(str)
-    dels_agg.loc[:, 'countries'] = dels_agg['country_counts'].apply(lambda x: x[0]).apply(lambda x: ','.join(x))#.astype(str)
-    # subs['countries'] = subs['countries'].apply(process_list).astype(str)
-    dels_agg.loc[:, 'country_counts'] = dels_agg['country_counts'].apply(lambda x: x[1]).apply(lambda x: ','.join(map(str, x)))
-    return dels_agg
+        muts.rename(columns={'date': 'date_collected'}, inplace=True)
+    # each unique date is only processed once
+    date_map = {d: (d + '-15' if d.count('-')==1 else d) 
+                for d in muts['date_collected'].unique() if isinstance(d, str) and d.count('-')>=1}
+    muts = muts[muts['date_collected'].isin(date_map.keys())].copy()
+    muts['date_collected'] = muts['date_collected'].map(date_map)
+    muts = muts[muts['date_collected']<date].copy()
+    muts['date_collected'] = pd.to_datetime(muts['date_collected'], errors='coerce')
+    return muts
+
+
+def compute_partial_aggregates(muts: pd.DataFrame, mutation_cols: list) -> dict:
+    """Aggregates mutations on `mutation_cols` into partial results that can be merged with those of other 
+    samples (see `merge_partial_aggregates`): the number of samples and dates of detection of each mutation, 
+    along with the number of samples for each (mutation, place) e.g. (S:N501Y, California).
+    Counts are computed on integer-coded samples and places, using a single grouping over composite keys"""
+    muts = muts.copy()
+    for col in ['strain'] + PLACE_COLS:
+        muts[col] = muts[col].astype('category')
+    grouped = muts.groupby(mutation_cols)
+    partials = {'mutations': (grouped.agg(num_samples=('strain', 'nunique'),
+                                          first_detected=('date_collected', 'min'),
+                                          last_detected=('date_collected', 'max'))
+                                     .reset_index())}
+    mutation_codes = grouped.ngroup().fillna(-1).values.astype(np.int64)
+    for col in PLACE_COLS:
+        place_codes, places = pd.factorize(muts[col])
+        is_valid = (mutation_codes>=0) & (place_codes>=0)
+        counts = (pd.DataFrame({'mutation': mutation_codes[is_valid], 'place': place_codes[is_valid]})
+                    .groupby(['mutation', 'place'])
+                    .size())
+        place_counts = partials['mutations'][mutation_cols].iloc[counts.index.get_level_values('mutation')]
+        place_counts = place_counts.reset_index(drop=True)
+        place_counts[col] = np.asarray(places, dtype=object)[counts.index.get_level_values('place')]
+        place_counts['count'] = counts.values
+        partials[col] = place_counts
+    return partials
+
+
+def merge_partial_aggregates(partials_list: list, mutation_cols: list) -> dict:
+    """Merges the partial aggregates computed over different samples (see `compute_partial_aggregates`), 
+    by adding up counts and taking the earliest and latest dates of detection"""
+    partials = {'mutations': (pd.concat([p['mutations'] for p in partials_list])
+                                .groupby(mutation_cols)
+                                .agg(num_samples=('num_samples', 'sum'),
+                                     first_detected=('first_detected', 'min'),
+                                     last_detected=('last_detected', 'max'))
+                                .reset_index())}
+    for col in PLACE_COLS:
+        partials[col] = (pd.concat([p[col] for p in partials_list])
+                           .groupby(mutation_cols + [col])['count'].sum()
+                           .reset_index())
+    return partials
+
+
+def finalize_aggregates(partials: dict, mutation_cols: list) -> pd.DataFrame:
+    """Formats partial aggregates (see `compute_partial_aggregates`) as the output of `aggregate_mutations`"""
+    muts_agg = partials['mutations'].sort_values(mutation_cols).reset_index(drop=True)
+    # dates of detection are returned as Timestamp objects, as written to CSV by earlier versions (YYYY-MM-DD 00:00:00)
+    muts_agg['first_detected'] = muts_agg['first_detected'].astype(object)
+    muts_agg['last_detected'] = muts_agg['last_detected'].astype(object)
+    num_groups = muts_agg.shape[0]
+    mutation_index = pd.MultiIndex.from_frame(muts_agg[mutation_cols])
+    place_counts = {}
+    for col in PLACE_COLS:
+        groups = mutation_index.get_indexer(pd.MultiIndex.from_frame(partials[col][mutation_cols]))
+        place_counts[col] = (np.bincount(groups, minlength=num_groups),) + \
+                            split_values_per_group(groups, partials[col][col], partials[col]['count'].values, num_groups)
+    num_locations, locations, location_counts = place_counts['location_normed']
+    num_divisions, divisions, division_counts = place_counts['division_normed']
+    num_countries, countries, country_counts = place_counts['country_normed']
+    muts_agg['num_locations'] = num_locations
+    muts_agg['location_counts'] = list(zip(locations, location_counts))
+    muts_agg['num_divisions'] = num_divisions
+    muts_agg['division_counts'] = join_values(division_counts)
+    muts_agg['num_countries'] = num_countries
+    muts_agg['country_counts'] = join_values(country_counts)
+    muts_agg['divisions'] = join_values(divisions)
+    muts_agg['countries'] = join_values(countries)
+    return muts_agg
+
+
+def split_values_per_group(group_codes: np.ndarray, values: pd.Series, counts: np.ndarray, num_groups: int) -> Tuple[list, list]:
+    """Support function for splitting (value, count) records by group (given as integer codes), 
+    as returned by `np.unique(x, return_counts=True)` for each group i.e. values are sorted within each group"""
+    if num_groups == 0:
+        return [], []
+    value_codes, uniques = factorize_sorted(values)
+    order = np.lexsort((value_codes, group_codes))
+    bounds = np.searchsorted(group_codes[order], np.arange(1, num_groups))
+    return np.split(uniques[value_codes[order]], bounds), np.split(counts[order], bounds)
+
+
+def factorize_sorted(values: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Support function for encoding (e.g. categorical) values as integers following the sorted order of 
+    their unique values (missing values are encoded as -1)"""
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques, dtype=object)
+    order = np.argsort(uniques, kind='stable')
+    ranks = np.empty(order.shape[0], dtype=np.int64)
+    ranks[order] = np.arange(order.shape[0])
+    codes = np.where(codes>=0, ranks[codes], -1)
+    return codes, uniques[order]
+
+
+def join_values(values: list) -> list:
+    """Support function for joining each array of values (e.g. counts) into a comma-separated string"""
+    return [','.join(map(str, x)) for x in values]
+
+
+@traced
+def update_aggregate_store(store_dir: str, 
+                           muts: pd.DataFrame, 
+                           date: str,
+                           data_src: str,
+                           mutation_cols: list) -> pd.DataFrame:
+    """Adds newly submitted samples to the mutation aggregates persisted in `store_dir`, and returns the updated 
+    aggregates (same format as `aggregate_mutations`). Partial aggregates are stored for each month of collection, 
+    and only the partitions of the months found in `muts` are updated. The mutations of each partition are kept in 
+    shards, one per update, so that an update only writes the mutations of the newly submitted samples. 
+    A catalog keeps the month of each sample that was added: samples that were already added are ignored, unless 
+    they come back with a different month of collection, in which case they are removed from their previous partition 
+    (whose shards are then compacted into one). The overall aggregates are then merged from the partial aggregates 
+    of all months, given that each sample is only collected in a single month. Files are only added to the store 
+    once the index of the store (`aggregates.pkl`) is replaced, so that an interrupted update leaves it unchanged"""
+    os.makedirs(store_dir, exist_ok=True)
+    index = load_aggregate_index(store_dir)
+    muts = filter_collection_dates(muts, date, data_src)
+    months = pd.Series(muts['date_collected'].dt.strftime('%Y-%m').fillna('unknown').values, index=muts['strain'].values)
+    strain_months = months[~months.index.duplicated()]
+    prev_months = index['strains'].reindex(strain_months.index)
+    is_new = (strain_months!=prev_months)
+    muts, months = muts[muts['strain'].map(is_new).values], months[muts['strain'].map(is_new).values]
+    # samples that moved to another month of collection
+    moved = prev_months[is_new & prev_months.notna()]
+    affected = sorted(set(months.unique()) | set(moved.unique()))
+    if not affected:
+        if index['partials'] is None:
+            return finalize_aggregates(compute_partial_aggregates(muts, mutation_cols), mutation_cols)
+        return finalize_aggregates(index['partials'], mutation_cols)
+    version = index['version'] + 1
+    partitions = dict(index['partitions'])
+    for month in affected:
+        stage(f"Updating aggregates of samples collected in {month}...")
+        month_muts = muts.loc[(months==month).values, ['strain', 'date_collected'] + mutation_cols + PLACE_COLS]
+        partition = partitions.get(month)
+        removed = moved.index[moved==month]
+        if partition is not None and removed.size > 0:
+            records = pd.concat([read_store_file(store_dir, shard, 'records') for shard in partition['shards']], 
+                                ignore_index=True)
+            records = pd.concat([records[~records['strain'].isin(removed)], month_muts], ignore_index=True)
+            shards = []
+            partials = compute_partial_aggregates(records, mutation_cols) if not records.empty else None
+        elif not month_muts.empty:
+            records = month_muts.reset_index(drop=True)
+            shards = list(partition['shards']) if partition is not None else []
+            partials = compute_partial_aggregates(records, mutation_cols)
+            if partition is not None:
+                partials = merge_partial_aggregates([read_store_file(store_dir, partition['partials'], 'partials'), 
+                                                     partials], mutation_cols)
+        else:
+            continue
+        if records.empty:
+            partitions.pop(month)
+            continue
+        name = f'{month}.v{version}'
+        write_store_file(records, os.path.join(store_dir, f'{name}.records.pkl'))
+        write_store_file(partials, os.path.join(store_dir, f'{name}.partials.pkl'))
+        partitions[month] = {'partials': name, 'shards': shards + [name]}
+    # the contribution of each updated month is replaced by merging the partial aggregates of all months
+    aggregates = merge_partial_aggregates([read_store_file(store_dir, partition['partials'], 'partials') 
+                                           for partition in partitions.values()], mutation_cols)
+    strains = index['strains']
+    strains = pd.concat([strains[~strains.index.isin(strain_months.index[is_new])], strain_months[is_new]])
+    write_store_file({'partials': aggregates, 'strains': strains, 'partitions': partitions, 'version': version}, 
+                     os.path.join(store_dir, 'aggregates.pkl'))
+    # remove the files that are no longer part of the store
+    for fn in get_store_files(index['partitions']) - get_store_files(partitions):
+        os.remove(os.path.join(store_dir, fn))
+    return finalize_aggregates(aggregates, mutation_cols)
+
+
+def load_aggregate_index(store_dir: str) -> dict:
+    """Support function for loading the index of the aggregate store: the overall partial aggregates, 
+    the month of collection of each sample, the files of each month's partition and the version of the store"""
+    index_fp = os.path.join(store_dir, 'aggregates.pkl')
+    if os.path.isfile(index_fp):
+        return pd.read_pickle(index_fp)
+    return {'partials': None, 'strains': pd.Series(dtype=object), 'partitions': {}, 'version': 0}
+
+
+def get_store_files(partitions: dict) -> set:
+    """Support function for listing the files of the partitions of the aggregate store"""
+    return ({f"{partition['partials']}.partials.pkl" for partition in partitions.values()} 
+            | {f'{shard}.records.pkl' for partition in partitions.values() for shard in partition['shards']})
+
+
+def read_store_file(store_dir: str, name: str, kind: str):
+    """Support function for reading the partial aggregates or the mutations (`kind`) of a partition file"""
+    return pd.read_pickle(os.path.join(store_dir, f'{name}.{kind}.pkl'))
+
+
+def write_store_file(obj, fp: str):
+    """Support function for (atomically) writing a file of the aggregate store, through a temporary file"""
+    pd.to_pickle(obj, fp + '.tmp')
+    os.replace(fp + '.tmp', fp)
+
+
+def load_aggregate_store(store_dir: str, mutation_cols: list) -> pd.DataFrame:
+    """Returns the mutation aggregates persisted in `store_dir` (see `update_aggregate_store`)"""
+    return finalize_aggregates(load_aggregate_index(store_dir)['partials'], mutation_cols)
 
 
 def process_samples(x):
@@ -149,6 +390,380 @@ def process_samples(x):
     return x
 
 
+@traced
+def identify_mutations_per_sample(cns, 
+                                  meta_fp=None,
+                                  gene2pos: dict=bd.GENE2POS,
+                                  data_src: str='gisaid',
+                                  min_seq_len=20000,
+                                  max_num_subs=5000,
+                                  min_del_len=1,
+                                  max_del_len=500,
+                                  min_ins_len=1,
+                                  start_pos=265,
+                                  end_pos=29674,
+                                  patient_zero: str='NC_045512.2',
+                                  test: bool=False,
+                                  cache_fp: str=None,
+                                  max_cache_size_mb: int=1024) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, str]:
+    """Returns dataframes of all substitution, deletion and insertion-based mutations from a pre-loaded 
+    multiple sequence alignment, containing the reference sequence (default: NC_045512.2)
+    The alignment is processed once and shared by all three mutation types, which yields the same 
+    results as calling `identify_replacements_per_sample`, `identify_deletions_per_sample` and 
+    `identify_insertions_per_sample` separately: in particular, insertions are joined with the sample metadata 
+    in the A-lab format, whatever the data source.
+    If `cache_fp` is given, mutations are only called for sequences that are not found in the cache 
+    (see `MutationCache`), and the cache is updated with the mutations of the remaining ones.
+    The data is NOT aggregated, meaning that there will be a record for each observed mutation for each sample"""
+    cns = IndexedAlignment.from_records(cns)
+    meta = load_metadata(meta_fp, data_src) if meta_fp else None
+    # as in `identify_insertions_per_sample`, sample metadata of insertions is expected in the A-lab format
+    ins_meta = load_metadata(meta_fp, 'alab') if meta_fp else None
+    if cache_fp is not None and not test:
+        mutations = call_mutations_cached(cns, cache_fp, max_cache_size_mb, gene2pos, data_src, min_seq_len, 
+                                          max_num_subs, min_del_len, max_del_len, min_ins_len, 
+                                          start_pos, end_pos, patient_zero)
+        *mutations, ref_seq = mutations
+        if meta is not None:
+            mutations = [merge_metadata(df, df_meta, df_src) if 'idx' in df.columns else df 
+                         for df, df_meta, df_src in zip(mutations, [meta, meta, ins_meta], [data_src, data_src, 'alab'])]
+        return (*mutations, ref_seq)
+    # insertions are identified from the original alignment, before they get removed below
+    stage(f"Identifying insertions...")
+    ins_df, _ = call_insertions(cns, ins_meta, gene2pos, 'alab', min_ins_len, 
+                                start_pos, end_pos, patient_zero)
+    stage(f"Initial cleaning...")
+    # load the alignment as a (num_samples x num_positions) matrix of bytes
+    names, seq_arr, ref_seq = process_cns_array(cns, patient_zero, 
+                                                start_pos=0, end_pos=end_pos)
+    seqsdf = pd.DataFrame({'idx': names, 'seq_len': seq_arr.shape[1]})
+    if test:
+        seqsdf = seqsdf.sample(100)
+    subs_df = call_replacements(seqsdf, seq_arr, ref_seq, meta, gene2pos, data_src, 
+                                min_seq_len, max_num_subs)
+    # deletions are only identified after the first `start_pos` nts e.g. 265nts
+    seqsdf = seqsdf.assign(seq_len=(seqsdf['seq_len'] - start_pos).clip(lower=0))
+    dels_df = call_deletions(seqsdf, seq_arr[:, start_pos:], ref_seq, meta, gene2pos, data_src,
+                             min_seq_len, min_del_len, max_del_len, start_pos)
+    return subs_df, dels_df, ins_df, ref_seq
+
+
+@traced
+def call_mutations_cached(cns: 'IndexedAlignment', 
+                          cache_fp: str,
+                          max_cache_size_mb: int=1024,
+                          gene2pos: dict=bd.GENE2POS,
+                          data_src: str='gisaid',
+                          min_seq_len=20000,
+                          max_num_subs=5000,
+                          min_del_len=1,
+                          max_del_len=500,
+                          min_ins_len=1,
+                          start_pos=265,
+                          end_pos=29674,
+                          patient_zero: str='NC_045512.2') -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, str]:
+    """Same as `identify_mutations_per_sample` (without metadata), where the mutations of each sequence are 
+    fetched from the cache if available. Sequences are identified by a hash of their aligned sequence along with 
+    the aligned reference sequence, calling parameters and annotation (version)"""
+    ref_row = cns.get_row(patient_zero)
+    if ref_row < 0:
+        return identify_mutations_per_sample(cns, None, gene2pos, data_src, min_seq_len, max_num_subs, min_del_len, 
+                                             max_del_len, min_ins_len, start_pos, end_pos, patient_zero)
+    # one record per sample name (the last one wins, as when parsing the MSA into a dict)
+    rows = {}
+    for i, name in enumerate(cns.ids):
+        rows[name] = i
+    params = json.dumps([bd.ANNOTATION_VERSION, gene2pos, patient_zero, cns.get_row_seq(ref_row), 
+                         cns.get_alignment_length(), min_seq_len, max_num_subs, min_del_len, max_del_len, 
+                         min_ins_len, start_pos, end_pos])
+    params_hash = hashlib.sha1(params.encode('ascii'))
+    keys = {}
+    for name, i in rows.items():
+        seq_hash = params_hash.copy()
+        seq_hash.update(cns.seq_arr[i, :cns.seq_lens[i]])
+        keys[name] = seq_hash.hexdigest()
+    cache = MutationCache(cache_fp, max_cache_size_mb)
+    seq_ids, mutations = cache.get(set(keys.values()))
+    # one sample per sequence that is not found in the cache
+    missing = {}
+    for name, key in keys.items():
+        if key not in seq_ids:
+            missing.setdefault(key, name)
+    missing = list(missing.values())
+    print(f"Found {len(rows) - len(missing)} sequences in the mutation cache, calling mutations of {len(missing)} sequences...")
+    ref_name = cns.ids[ref_row]
+    if missing:
+        # the reference is needed to call mutations of the remaining sequences
+        names = missing if ref_name in missing else [ref_name] + missing
+        missing_cns = IndexedAlignment(names, [cns.get_row_seq(rows[name]) for name in names])
+        *new_mutations, _ = identify_mutations_per_sample(missing_cns, None, gene2pos, data_src, min_seq_len, max_num_subs, 
+                                                          min_del_len, max_del_len, min_ins_len, start_pos, end_pos, 
+                                                          patient_zero)
+        missing_names = pd.Series(missing)
+        new_mutations = [df.loc[df['idx'].isin(missing_names)].rename(columns={'idx': 'key'}).assign(key=lambda x: x['key'].map(keys)) 
+                         if 'idx' in df.columns else df for df in new_mutations]
+        new_ids = cache.put(missing_names.map(keys).tolist(), new_mutations)
+        seq_ids.update(new_ids)
+        mutations = [pd.concat([df, new_df.rename(columns={'key': 'seq_id'}).assign(seq_id=lambda x: x['seq_id'].map(new_ids))]) 
+                     if 'key' in new_df.columns else df for df, new_df in zip(mutations, new_mutations)]
+    cache.close()
+    # join the mutations of each sequence back to its samples, following their order in the alignment
+    samples = pd.DataFrame({'idx': list(rows), 'seq_id': [seq_ids[keys[name]] for name in rows]})
+    mutations = [samples.join(df.set_index('seq_id'), on='seq_id', how='inner').drop(columns='seq_id') 
+                 if not df.empty else pd.DataFrame() for df in mutations]
+    ref_seq = cns.get_row_seq(ref_row).replace('-', '')
+    return (*mutations, ref_seq)
+
+
+class MutationCache:
+    """Persistent (SQLite) cache of the substitutions, deletions and insertions found in aligned sequences, 
+    keyed by a hash of each sequence (see `call_mutations_cached`). 
+    Each type of mutation is stored in its own table, with a row per mutation of each sequence and a column per field. 
+    The least recently used sequences are evicted once the cache exceeds `max_size_mb`"""
+    TABLES = ['substitutions', 'deletions', 'insertions']
+
+    def __init__(self, cache_fp: str, max_size_mb: int=1024):
+        self.max_size = max_size_mb * 2**20
+        self.db = sqlite3.connect(cache_fp, timeout=60)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sequences (id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, 
+                                                                 size INTEGER NOT NULL, last_used REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sequences_last_used ON sequences (last_used)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS columns (tbl TEXT NOT NULL, pos INTEGER NOT NULL, name TEXT NOT NULL, 
+                                                               dtype TEXT NOT NULL, PRIMARY KEY (tbl, pos))""")
+        self.db.execute("CREATE TEMP TABLE requested (key TEXT PRIMARY KEY)")
+        self.db.commit()
+
+    def get_columns(self) -> dict:
+        """Returns the (name, dtype) of the columns of each mutation table that exists"""
+        columns = {}
+        for tbl, name, dtype in self.db.execute("SELECT tbl, name, dtype FROM columns ORDER BY tbl, pos"):
+            columns.setdefault(tbl, []).append((name, dtype))
+        return columns
+
+    def set_requested(self, keys):
+        """Support function for loading the keys of a request into a temporary table, so that they can be joined"""
+        self.db.execute("DELETE FROM requested")
+        self.db.executemany("INSERT OR IGNORE INTO requested VALUES (?)", ((key,) for key in keys))
+
+    def get(self, keys: set) -> Tuple[dict, list]:
+        """Returns the id of each of the given keys that is found in the cache, along with their cached mutations 
+        (substitutions, deletions and insertions), where the `seq_id` column holds the id of their sequence"""
+        self.set_requested(keys)
+        seq_ids = dict(self.db.execute("SELECT s.key, s.id FROM sequences s JOIN requested r ON s.key=r.key"))
+        self.db.execute("UPDATE sequences SET last_used=? WHERE key IN (SELECT key FROM requested)", (time.time(),))
+        self.db.commit()
+        columns = self.get_columns()
+        mutations = []
+        for tbl in self.TABLES:
+            if tbl not in columns or not seq_ids:
+                mutations.append(pd.DataFrame())
+                continue
+            query = f"""SELECT t.* FROM {tbl} t JOIN sequences s ON t.seq_id=s.id JOIN requested r ON s.key=r.key 
+                        ORDER BY t.rowid"""
+            df = pd.DataFrame.from_records(self.db.execute(query).fetchall(), 
+                                           columns=['seq_id'] + [name for name, _ in columns[tbl]])
+            mutations.append(self.decode(df, columns[tbl]))
+        return seq_ids, mutations
+
+    def put(self, keys: list, mutations: list) -> dict:
+        """Adds the given keys to the cache along with their mutations (substitutions, deletions and insertions), 
+        where the `key` column holds the key of their sequence. Returns the id of each added key"""
+        columns = {tbl: [(col, self.get_dtype(df[col])) for col in df.columns if col!='key'] 
+                   for tbl, df in zip(self.TABLES, mutations) if not df.empty}
+        # lock the cache, in case another process is adding the same sequences
+        self.db.execute("BEGIN IMMEDIATE")
+        stored_columns = self.get_columns()
+        if any(stored_columns.get(tbl, cols)!=cols for tbl, cols in columns.items()):
+            # the fields of the mutations have changed, previously cached ones are dropped
+            self.clear()
+            stored_columns = {}
+        for tbl, cols in columns.items():
+            if tbl not in stored_columns:
+                self.create_table(tbl, cols)
+        self.set_requested(keys)
+        cached_keys = {key for key, in self.db.execute("SELECT key FROM requested WHERE key IN (SELECT key FROM sequences)")}
+        # approximate size of each sequence: 64 bytes for its key and id, 8 bytes per number 
+        # and one byte per character of each of its mutations
+        sizes = pd.Series(64, index=keys)
+        records = []
+        for tbl, df in zip(self.TABLES, mutations):
+            if tbl not in columns:
+                continue
+            df = df.loc[~df['key'].isin(cached_keys)]
+            values = [df['key'].tolist()] + [self.encode(df[col], dtype) for col, dtype in columns[tbl]]
+            row_sizes = sum(pd.Series(col, dtype=object).str.len().fillna(0).to_numpy() if dtype in ('object', 'list') else 8 
+                            for col, (_, dtype) in zip(values[1:], columns[tbl]))
+            sizes = sizes.add(pd.Series(row_sizes, index=values[0]).groupby(level=0).sum(), fill_value=0)
+            records.append((tbl, values))
+        now = time.time()
+        self.db.executemany("INSERT INTO sequences (key, size, last_used) VALUES (?, ?, ?)", 
+                            [(key, int(size), now) for key, size in sizes.items() if key not in cached_keys])
+        seq_ids = dict(self.db.execute("SELECT s.key, s.id FROM sequences s JOIN requested r ON s.key=r.key"))
+        for tbl, (row_keys, *values) in records:
+            row_ids = [seq_ids[key] for key in row_keys]
+            self.db.executemany(f"INSERT INTO {tbl} VALUES ({','.join('?'*(len(values) + 1))})", zip(row_ids, *values))
+        self.db.commit()
+        self.evict()
+        return seq_ids
+
+    def create_table(self, tbl: str, columns: list):
+        """Support function for creating the table of a type of mutation, with a column per field"""
+        sql_types = {'int64': 'INTEGER', 'bool': 'INTEGER', 'float64': 'REAL'}
+        col_defs = ', '.join(f'"{name}" {sql_types.get(dtype, "TEXT")}' for name, dtype in columns)
+        self.db.execute(f"CREATE TABLE {tbl} (seq_id INTEGER NOT NULL, {col_defs})")
+        self.db.execute(f"CREATE INDEX {tbl}_seq_id ON {tbl} (seq_id)")
+        self.db.executemany("INSERT INTO columns VALUES (?, ?, ?, ?)", 
+                            [(tbl, pos, name, dtype) for pos, (name, dtype) in enumerate(columns)])
+
+    def clear(self):
+        """Support function for removing all cached sequences along with their mutations"""
+        for tbl in self.TABLES:
+            self.db.execute(f"DROP TABLE IF EXISTS {tbl}")
+        self.db.execute("DELETE FROM columns")
+        self.db.execute("DELETE FROM sequences")
+
+    @staticmethod
+    def get_dtype(col: pd.Series) -> str:
+        """Support function for getting the type of a field, where lists (of positions) are stored as text"""
+        if col.dtype==object and isinstance(col.iloc[0], list):
+            return 'list'
+        return str(col.dtype)
+
+    @staticmethod
+    def encode(col: pd.Series, dtype: str) -> list:
+        """Support function for converting a field to values that can be stored in SQLite"""
+        if dtype=='list':
+            return [','.join(map(str, values)) for values in col]
+        return col.tolist()
+
+    @staticmethod
+    def decode(df: pd.DataFrame, columns: list) -> pd.DataFrame:
+        """Support function for restoring the type of each field of the mutations read from SQLite"""
+        for name, dtype in columns:
+            if dtype=='list':
+                df[name] = [[int(value) for value in values.split(',')] if values else [] for values in df[name]]
+            elif dtype!='object':
+                df[name] = df[name].astype(dtype)
+        return df
+
+    def evict(self):
+        """Removes the least recently used sequences, until the cache no longer exceeds its maximum size"""
+        excess = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM sequences").fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for seq_id, size in self.db.execute("SELECT id, size FROM sequences ORDER BY last_used").fetchall():
+            evicted.append((seq_id,))
+            excess -= size
+            if excess <= 0:
+                break
+        for tbl in self.get_columns():
+            self.db.executemany(f"DELETE FROM {tbl} WHERE seq_id=?", evicted)
+        self.db.executemany("DELETE FROM sequences WHERE id=?", evicted)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# sample metadata parsed by the current process, keyed by filepath, data source and columns
+METADATA_CACHE = {}
+
+
+@traced
+def load_metadata(meta_fp: str, data_src: str, columns: list=None) -> pd.DataFrame:
+    """Support function for loading sample metadata, based on the data source (alab, gisaid or gisaid_feed).
+    All columns are loaded unless `columns` are given (a ValueError is raised if any of them is missing), 
+    and the columns listed in `data.META_SCHEMA` are parsed with their given types.
+    Each metadata file is parsed once per process, after which it is cached in memory and on disk 
+    (as a Feather file next to it, if pyarrow is available) until the file is modified. 
+    The returned dataframe is shared and should not be modified in place"""
+    if data_src not in bd.META_SCHEMA:
+        raise ValueError(f"user-specified data source {data_src} not recognized. Aborting.")
+    meta_stat = os.stat(meta_fp)
+    # the column set is part of the stamp, so that copies holding other columns are not reused
+    stamp = {'mtime': meta_stat.st_mtime_ns, 'size': meta_stat.st_size, 
+             'columns': list(columns) if columns is not None else None}
+    key = (os.path.abspath(meta_fp), data_src, tuple(columns) if columns is not None else None)
+    if key in METADATA_CACHE and METADATA_CACHE[key][0] == stamp:
+        return METADATA_CACHE[key][1]
+    meta = read_metadata_sidecar(meta_fp, data_src, stamp)
+    if meta is None:
+        meta = read_metadata(meta_fp, data_src, columns)
+        write_metadata_sidecar(meta, meta_fp, data_src, stamp)
+    METADATA_CACHE[key] = (stamp, meta)
+    return meta
+
+
+def read_metadata(meta_fp: str, data_src: str, columns: list=None) -> pd.DataFrame:
+    """Support function for parsing the given columns (default: all) of a metadata file, 
+    using the types in `data.META_SCHEMA` for the columns it lists"""
+    dtypes = bd.META_SCHEMA[data_src]
+    if data_src=='alab':
+        return pd.read_csv(meta_fp, usecols=columns, dtype=dtypes)
+    return pd.read_csv(meta_fp, sep='\t', compression='gzip', usecols=columns, dtype=dtypes)
+
+
+def get_metadata_sidecar_fp(meta_fp: str, data_src: str) -> str:
+    """Support function for getting the filepath of the columnar copy of a metadata file"""
+    meta_dir, meta_name = os.path.split(os.path.abspath(meta_fp))
+    return os.path.join(meta_dir, f'.{meta_name}.{data_src}.feather')
+
+
+def read_metadata_sidecar(meta_fp: str, data_src: str, stamp: dict) -> pd.DataFrame:
+    """Support function for reading the columnar copy of a metadata file, 
+    if it is still up-to-date with the metadata file (based on its modification time, size and columns)"""
+    sidecar_fp = get_metadata_sidecar_fp(meta_fp, data_src)
+    try:
+        with open(sidecar_fp + '.json', 'r') as f:
+            if json.load(f) != stamp:
+                return None
+        return pd.read_feather(sidecar_fp)
+    except Exception:
+        return None
+
+
+def write_metadata_sidecar(meta: pd.DataFrame, meta_fp: str, data_src: str, stamp: dict):
+    """Support function for saving a columnar copy of a metadata file (skipped if pyarrow is not available 
+    or the folder is not writable)"""
+    sidecar_fp = get_metadata_sidecar_fp(meta_fp, data_src)
+    try:
+        meta.to_feather(sidecar_fp)
+        with open(sidecar_fp + '.json', 'w') as f:
+            json.dump(stamp, f)
+    except Exception:
+        pass
+
+
+def merge_metadata(seqsdf: pd.DataFrame, meta: pd.DataFrame, data_src: str) -> pd.DataFrame:
+    """Support function for joining mutations of each sample with their metadata, 
+    based on the data source (alab, gisaid or gisaid_feed)"""
+    if data_src=='alab':
+        seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='fasta_hdr')
+        # clean and process sample collection dates
+        seqsdf = seqsdf.loc[(seqsdf['collection_date']!='Unknown') 
+                    & (seqsdf['collection_date']!='1900-01-00')]
+        seqsdf.loc[seqsdf['collection_date'].str.contains('/'), 'collection_date'] = seqsdf['collection_date'].apply(lambda x: x.split('/')[0])
+        seqsdf['date'] = pd.to_datetime(seqsdf['collection_date'])
+    elif data_src=='gisaid':
+        # filter out improper collection dates
+        # meta['tmp'] = meta['date'].str.split('-')
+        # meta = meta[meta['tmp'].str.len()>=3]
+        seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='strain')
+        # seqsdf['date'] = pd.to_datetime(seqsdf['date'], errors='coerce')
+        # seqsdf['month'] = seqsdf['date'].dt.month
+        seqsdf.loc[seqsdf['location'].isna(), 'location'] = 'unk'
+        seqsdf = seqsdf[seqsdf['host']=='Human']
+        seqsdf.loc[seqsdf['country']=='USA', 'country'] = 'United States of America'
+    elif data_src=='gisaid_feed':
+        seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='strain')
+        # seqsdf.loc[seqsdf['country']=='USA', 'country'] = 'United States of America'
+    else:
+        raise ValueError(f"user-specified data source {data_src} not recognized. Aborting.")
+    return seqsdf
+
+
+@traced
 def identify_replacements_per_sample(cns, 
                                      meta_fp=None,
                                      gene2pos: dict=bd.GENE2POS,
@@ -161,108 +776,89 @@ def identify_replacements_per_sample(cns,
     """Returns dataframe of all substitution-based mutations from a pre-loaded multiple sequence alignment, 
     containing the reference sequence (default: NC_045512.2)
     The data is NOT aggregated, meaning that there will be a record for each observed substitution for each sample"""
-    print(f"Initial cleaning...")
-    seqs, ref_seq = process_cns_seqs(cns, patient_zero,
-                                     start_pos=0, end_pos=29674)
+    stage(f"Initial cleaning...")
+    # load the alignment as a (num_samples x num_positions) matrix of bytes
+    names, seq_arr, ref_seq = process_cns_array(cns, patient_zero,
+                                                start_pos=0, end_pos=29674)
 #     ref_seq = get_seq_from_fasta(ref_path)
-    seqsdf = (pd.DataFrame(index=seqs.keys(), 
-                           data=seqs.values(), 
-                           columns=['sequence'])
-                .reset_index()
-                .rename(columns={'index': 'idx'}))
+    seqsdf = pd.DataFrame({'idx': names, 'seq_len': seq_arr.shape[1]})
     if test:
         seqsdf = seqsdf.sample(100)
+    meta = load_metadata(meta_fp, data_src) if meta_fp else None
+    seqsdf = call_replacements(seqsdf, seq_arr, ref_seq, meta, gene2pos, data_src, 
+                               min_seq_len, max_num_subs)
+    return seqsdf, ref_seq
+
+
+@traced
+def call_replacements(seqsdf: pd.DataFrame, 
+                      seq_arr: np.ndarray, 
+                      ref_seq: str,
+                      meta: pd.DataFrame=None,
+                      gene2pos: dict=bd.GENE2POS,
+                      data_src: str='gisaid',
+                      min_seq_len=20000,
+                      max_num_subs=5000) -> pd.DataFrame:
+    """Returns dataframe of all substitution-based mutations from an alignment matrix (see `seqs2array`).
+    `seqsdf` contains the name (idx) and length (seq_len) of the samples to consider, indexed by their row in `seq_arr`"""
     try:
-        # compute length of each sequence
-        seqsdf['seq_len'] = seqsdf['sequence'].str.len()
         # filter out seqs that are too short
         seqsdf = seqsdf[seqsdf['seq_len']>min_seq_len]
-        print(f"Identifying mutations...")
-        # for each sample, identify list of substitutions (position:alt)
-        seqsdf['replacements'] = seqsdf['sequence'].apply(find_replacements, 
-                                                        args=(ref_seq,))
-        # sequences with one or more substitutions
-        seqsdf = seqsdf.loc[seqsdf['replacements'].str.len() > 0]
-        seqsdf = seqsdf.loc[seqsdf['replacements'].str.len() < max_num_subs]
-        seqs = dict(zip(seqsdf['idx'], seqsdf['sequence']))
-        # drop the actual sequences to save mem
-        seqsdf.drop(columns=['sequence'], inplace=True)
-        gc.collect();
-        # wide-to-long data manipulation
-        seqsdf = seqsdf.explode('replacements')
-        # initialize position column
-        seqsdf['pos'] = -1
-        # populate position column
-        seqsdf.loc[~seqsdf['replacements'].isna(), 'pos'] = (seqsdf.loc[~seqsdf['replacements'].isna(), 'replacements']
-        .apply(lambda x: int(x.split(':')[0])))
-        # filter out non-substitutions
-        seqsdf = seqsdf.loc[seqsdf['pos']!=-1]
-        print(f"Mapping Genes to mutations...")
+        # collapse identical sequences, so that substitutions are called once per distinct sequence
+        samples = seqsdf
+        seqsdf, seq_codes, first = collapse_identical_sequences(samples, hash_rows(seq_arr, samples.index.values))
+        unique_rows = seqsdf.index.values
+        stage(f"Identifying mutations...", rows=seqsdf.shape[0])
+        ref_arr = seqs2array([ref_seq[:seq_arr.shape[1]]])[0]
+        # for each distinct sequence, identify all substitutions (row, position, alt)
+        rows, positions, alts = find_replacements_in_array(seq_arr[unique_rows], ref_arr)
+        rows = unique_rows[rows]
+        # sequences with one or more substitutions, and less than `max_num_subs`
+        num_subs = np.bincount(rows, minlength=seq_arr.shape[0])
+        keep = (num_subs[rows] > 0) & (num_subs[rows] < max_num_subs)
+        rows, positions, alts = rows[keep], positions[keep], alts[keep]
+        # wide-to-long data manipulation: one record for each substitution in each sample
+        seqsdf = seqsdf.loc[rows]
+        seqsdf['replacements'] = positions.astype(str).astype(object) + ':' + alts.view('S1').astype(str).astype(object)
+        seqsdf['pos'] = positions
+        stage(f"Mapping Genes to mutations...", rows=seqsdf.shape[0])
         # identify gene of each substitution
-        seqsdf['gene'] = seqsdf['pos'].apply(map_gene_to_pos)
-        seqsdf.loc[seqsdf['gene'].isna(), 'gene'] = 'Non-coding region'
-        seqsdf.loc[seqsdf['gene']=='nan', 'gene'] = 'Non-coding region'
-        # seqsdf = seqsdf.loc[~seqsdf['gene'].isna()]
-        # seqsdf = seqsdf.loc[seqsdf['gene']!='nan']
-        # filter our substitutions in non-gene positions
-        seqsdf = seqsdf.loc[seqsdf['gene']!='nan']
-        print(f"Computing codon numbers...")
+        annotation = AnnotationIndex(gene2pos)
+        gene_codes = annotation.get_gene_codes(seqsdf['pos'].values)
+        seqsdf['gene'] = annotation.genes[gene_codes]
+        stage(f"Computing codon numbers...", rows=seqsdf.shape[0])
         # compute codon number of each substitution
-        seqsdf['gene_start_pos'] = seqsdf['gene'].apply(lambda x: gene2pos.get(x, {}).get('start', 0))
+        seqsdf['gene_start_pos'] = annotation.get_gene_starts(gene_codes, default=0)
         seqsdf['codon_num'] = np.ceil((seqsdf['pos'] - seqsdf['gene_start_pos'] + 1) / 3).astype(int)
-        # seqsdf['codon_num'] = seqsdf.apply(compute_codon_num, args=(gene2pos,), axis=1)
-        print(f"Fetching reference codon...")
+        stage(f"Fetching reference codon...", rows=seqsdf.shape[0])
         # fetch the reference codon for each substitution
         seqsdf['codon_start'] = seqsdf['gene_start_pos'] + (3*(seqsdf['codon_num'] - 1))
-        seqsdf['ref_codon'] = seqsdf['codon_start'].apply(lambda x: ref_seq[x:x+3].upper())
-        # seqsdf['ref_codon'] = seqsdf.apply(get_ref_codon, args=(ref_seq, gene2pos), axis=1)
-        print(f"Fetching alternative codon...")
+        ref_codons = get_codons(seqs2array([ref_seq]), np.zeros(seqsdf.shape[0], dtype=int), 
+                                seqsdf['codon_start'].values)
+        seqsdf['ref_codon'] = codons2str(ref_codons)
+        stage(f"Fetching alternative codon...", rows=seqsdf.shape[0])
         # fetch the alternative codon for each substitution
-        seqsdf['alt_codon'] = seqsdf[['idx', 'codon_start']].apply(get_alt_codon, args=(seqs,), axis=1)
-        # seqsdf['alt_codon'] = seqsdf.apply(get_alt_codon_old, args=(seqs, gene2pos,), axis=1)
-        del seqs
-        gc.collect();
-        print(f"Mapping amino acids...")
+        alt_codons = get_codons(seq_arr, seqsdf.index.values, seqsdf['codon_start'].values)
+        seqsdf['alt_codon'] = codons2str(alt_codons)
+        stage(f"Mapping amino acids...", rows=seqsdf.shape[0])
         # fetch the reference and alternative amino acids
-        seqsdf['ref_aa'] = seqsdf['ref_codon'].apply(get_aa)
-        seqsdf['alt_aa'] = seqsdf['alt_codon'].apply(get_aa)
+        seqsdf['ref_aa'] = annotation.translate(ref_codons)
+        seqsdf['alt_aa'] = annotation.translate(alt_codons)
         # filter out substitutions with non-amino acid alternates (bad consensus calls)
         seqsdf = seqsdf.loc[seqsdf['alt_aa']!='nan']
-        print("Naming substitutions")
+        stage("Naming substitutions", rows=seqsdf.shape[0])
         seqsdf['mutation'] = seqsdf['gene'] + ':' + seqsdf['ref_aa'] + seqsdf['codon_num'].astype(str) + seqsdf['alt_aa']
         seqsdf['type'] = 'substitution'
-        print(f"Fusing with metadata...")
-        # load and join metadata
-        if meta_fp:
-            if data_src=='alab':
-                meta = pd.read_csv(meta_fp)
-                seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='fasta_hdr')
-                # clean and process sample collection dates
-                seqsdf = seqsdf.loc[(seqsdf['collection_date']!='Unknown') 
-                            & (seqsdf['collection_date']!='1900-01-00')]
-                seqsdf.loc[seqsdf['collection_date'].str.contains('/'), 'collection_date'] = seqsdf['collection_date'].apply(lambda x: x.split('/')[0])
-                seqsdf['date'] = pd.to_datetime(seqsdf['collection_date'])
-            elif data_src=='gisaid':
-                meta = pd.read_csv(meta_fp, sep='\t', compression='gzip')
-                # filter out improper collection dates
-                # meta['tmp'] = meta['date'].str.split('-')
-                # meta = meta[meta['tmp'].str.len()>=3]
-                seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='strain')
-                # seqsdf['date'] = pd.to_datetime(seqsdf['date'], errors='coerce')
-                # seqsdf['month'] = seqsdf['date'].dt.month
-                seqsdf.loc[seqsdf['location'].isna(), 'location'] = 'unk'
-                seqsdf = seqsdf[seqsdf['host']=='Human']
-                seqsdf.loc[seqsdf['country']=='USA', 'country'] = 'United States of America'
-            elif data_src=='gisaid_feed':
-                meta = pd.read_csv(meta_fp, sep='\t', compression='gzip')
-                seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='strain')
-                # seqsdf.loc[seqsdf['country']=='USA', 'country'] = 'United States of America'
-            else:
-                raise ValueError(f"user-specified data source {data_src} not recognized. Aborting.")
+        # one record for each substitution in each sample
+        seqsdf = expand_identical_sequences(seqsdf, samples, seq_codes, first)
+        stage(f"Fusing with metadata...", rows=seqsdf.shape[0])
+        # join metadata
+        if meta is not None:
+            seqsdf = merge_metadata(seqsdf, meta, data_src)
     except:
         print(f"No substitutions found in any of the sequences in the alignment. Output will contain an empty dataframe")
         seqsdf = pd.DataFrame()
-    return seqsdf, ref_seq
+    return seqsdf
 
 
 def find_replacements(x, ref):
@@ -271,6 +867,103 @@ def find_replacements(x, ref):
             if n!=ref[i] and n!='-' and n!='n']
 
 
+def collapse_identical_sequences(samples: pd.DataFrame, seqs) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """Support function for calling mutations once per distinct sequence. `seqs` contains the sequence 
+    (str, bytes or digest, see `hash_rows`) of each sample in `samples`. Returns the first sample with each distinct sequence, 
+    along with the code of each sample's sequence i.e. its position among the distinct sequences, 
+    and the position (in `samples`) of the first sample with each distinct sequence"""
+    codes = {}
+    first = []
+    seq_codes = np.empty(samples.shape[0], dtype=int)
+    for i, seq in enumerate(seqs):
+        code = codes.setdefault(seq, len(codes))
+        if code == len(first):
+            first.append(i)
+        seq_codes[i] = code
+    first = np.array(first, dtype=int)
+    return samples.iloc[first], seq_codes, first
+
+
+def hash_rows(seq_arr: np.ndarray, rows: np.ndarray):
+    """Support function for hashing rows of an alignment matrix into fixed-size (16-byte) digests, 
+    so that sequences can be compared without keeping a copy of each of them"""
+    return (hashlib.blake2b(np.ascontiguousarray(seq_arr[row]), digest_size=16).digest() for row in rows)
+
+
+def expand_identical_sequences(seqsdf: pd.DataFrame, samples: pd.DataFrame, 
+                               seq_codes: np.ndarray, first: np.ndarray) -> pd.DataFrame:
+    """Support function for expanding the mutations called on distinct sequences (see `collapse_identical_sequences`) 
+    to each sample sharing the sequence. Records of each sample are indexed and ordered by the sample's row, 
+    and take its values for the columns of `samples`"""
+    num_seqs = first.shape[0]
+    if num_seqs == samples.shape[0]:
+        return seqsdf
+    # samples with each distinct sequence
+    seq_samples = np.argsort(seq_codes, kind='stable')
+    num_samples = np.bincount(seq_codes, minlength=num_seqs)
+    offsets = np.cumsum(num_samples) - num_samples
+    # distinct sequence of each record
+    codes = pd.Index(samples.index.values[first]).get_indexer(seqsdf.index)
+    # one copy of each record per sample
+    counts = num_samples[codes]
+    records = np.repeat(np.arange(seqsdf.shape[0]), counts)
+    copy_num = np.arange(records.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+    members = seq_samples[offsets[codes][records] + copy_num]
+    order = np.argsort(samples.index.values[members], kind='stable')
+    records, members = records[order], members[order]
+    seqsdf = seqsdf.iloc[records].set_axis(samples.index.values[members], axis=0)
+    for col in samples.columns:
+        seqsdf[col] = samples[col].values[members]
+    return seqsdf
+
+
+def seqs2array(seqs: list, width: int=None, fill: str='n') -> np.ndarray:
+    """Support function for loading aligned sequences into a (num_samples x num_positions) matrix of bytes.
+    Sequences are truncated to `width` (default: length of longest sequence) and shorter sequences 
+    are padded using `fill`, which is ignored when calling substitutions, deletions and insertions"""
+    max_len = max((len(s) for s in seqs), default=0)
+    if width is None or width > max_len:
+        width = max_len
+    if all(len(s)==width for s in seqs):
+        # fast path: all sequences in the alignment have equal length
+        return np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8).reshape(len(seqs), width)
+    seq_arr = np.full((len(seqs), width), ord(fill), dtype=np.uint8)
+    for i, s in enumerate(seqs):
+        s = np.frombuffer(s[:width].encode('ascii'), dtype=np.uint8)
+        seq_arr[i, :s.shape[0]] = s
+    return seq_arr
+
+
+def find_replacements_in_array(seq_arr: np.ndarray, ref_arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Support function for enumerating nucleotide substitutions of all samples at once (see `find_replacements`)
+    Returns the row (sample) index, position and alternative nucleotide (byte) of each substitution, 
+    ordered by sample and then by position"""
+    is_sub = ((seq_arr!=ref_arr[:seq_arr.shape[1]]) 
+              & (seq_arr!=ord('-')) 
+              & (seq_arr!=ord('n')))
+    rows, positions = np.nonzero(is_sub)
+    return rows, positions, seq_arr[rows, positions]
+
+
+def get_codons(seq_arr: np.ndarray, rows: np.ndarray, codon_starts: np.ndarray) -> np.ndarray:
+    """Support function for fetching the (upper-case) codons starting at `codon_starts` in the given rows 
+    of an alignment matrix, as a (num_codons x 3) matrix of bytes. 
+    Codons running past the end of the alignment are truncated (padded with zeros)"""
+    width = seq_arr.shape[1]
+    codons = np.zeros((len(rows), 3), dtype=np.uint8)
+    for i in range(3):
+        cols = codon_starts + i
+        in_bounds = cols < width
+        codons[in_bounds, i] = seq_arr[rows[in_bounds], cols[in_bounds]]
+    return np.where((codons>=ord('a')) & (codons<=ord('z')), codons - 32, codons).astype(np.uint8)
+
+
+def codons2str(codons: np.ndarray) -> np.ndarray:
+    """helper function to convert a (num_codons x 3) matrix of bytes into codon strings"""
+    return np.ascontiguousarray(codons).view('S3').ravel().astype(str).astype(object)
+
+
+@traced
 def identify_deletions_per_sample(cns, 
                                   meta_fp=None, 
                                   gene2pos: dict=bd.GENE2POS, 
@@ -285,105 +978,99 @@ def identify_deletions_per_sample(cns,
     """Returns dataframe of all deletion-based mutations from a pre-loaded multiple sequence alignment, 
     containing the reference sequence (default: NC_045512.2)
     The data is NOT aggregated, meaning that there will be a record for each observed deletion for each sample"""
-    seqs, ref_seq = process_cns_seqs(cns, patient_zero, start_pos, end_pos)
-    print(f"Initial cleaning...")
+    # load the alignment as a (num_samples x num_positions) matrix of bytes
+    names, seq_arr, ref_seq = process_cns_array(cns, patient_zero, start_pos, end_pos)
+    stage(f"Initial cleaning...")
     # load into dataframe
-    seqsdf = (pd.DataFrame(index=seqs.keys(), data=seqs.values(), 
-                           columns=['sequence'])
-                .reset_index().rename(columns={'index': 'idx'}))
+    seqsdf = pd.DataFrame({'idx': names, 'seq_len': seq_arr.shape[1]})
     if test:
         seqsdf = seqsdf.sample(100)
+    meta = load_metadata(meta_fp, data_src) if meta_fp else None
+    seqsdf = call_deletions(seqsdf, seq_arr, ref_seq, meta, gene2pos, data_src,
+                            min_seq_len, min_del_len, max_del_len, start_pos)
+    return seqsdf, ref_seq
+
+
+@traced
+def call_deletions(seqsdf: pd.DataFrame, 
+                   seq_arr: np.ndarray, 
+                   ref_seq: str,
+                   meta: pd.DataFrame=None,
+                   gene2pos: dict=bd.GENE2POS,
+                   data_src: str='gisaid',
+                   min_seq_len=20000,
+                   min_del_len=1, 
+                   max_del_len=500,
+                   start_pos=265) -> pd.DataFrame:
+    """Returns dataframe of all deletion-based mutations from an alignment matrix (see `seqs2array`), 
+    whose first column corresponds to `start_pos` in the reference sequence.
+    `seqsdf` contains the name (idx) and length (seq_len) of the samples to consider, indexed by their row in `seq_arr`"""
     try:
-        # compute length of each sequence
-        seqsdf['seq_len'] = seqsdf['sequence'].str.len()
         seqsdf = seqsdf[seqsdf['seq_len']>min_seq_len]
-        print(f"Identifying deletions...")
-        # identify deletion positions
-        seqsdf['del_positions'] = seqsdf['sequence'].apply(find_deletions)
-        # dump sequences to save mem, boost speed
-        seqsdf.drop(columns=['sequence'], inplace=True)
-        gc.collect();
-        # sequences with one or more deletions
-        seqsdf = seqsdf.loc[seqsdf['del_positions'].str.len() > 0]
-        # sequences with less than 500 deletions
-        seqsdf = seqsdf.loc[seqsdf['del_positions'].str.len() < max_del_len]
-        seqsdf = seqsdf.explode('del_positions')
+        # collapse identical sequences, so that deletions are called once per distinct sequence
+        samples = seqsdf
+        seqsdf, seq_codes, first = collapse_identical_sequences(samples, hash_rows(seq_arr, samples.index.values))
+        unique_rows = seqsdf.index.values
+        stage(f"Identifying deletions...", rows=seqsdf.shape[0])
+        # identify start and end positions of each contiguous deletion
+        rows, del_starts, del_ends = find_deletions_in_array(seq_arr[unique_rows])
+        rows = unique_rows[rows]
+        # sequences with one or more deletions, and less than 500 deletions
+        num_dels = np.bincount(rows, minlength=seq_arr.shape[0])
+        keep = (num_dels[rows] > 0) & (num_dels[rows] < max_del_len)
+        rows, del_starts, del_ends = rows[keep], del_starts[keep], del_ends[keep]
         # compute length of each deletion
-        seqsdf['del_len'] = seqsdf['del_positions'].apply(len)
-        # only consider deletions longer than 1nts
-        seqsdf = seqsdf[seqsdf['del_len'] >= min_del_len]
-        # only consider deletions shorter than 500nts
-        seqsdf = seqsdf[seqsdf['del_len'] < max_del_len]
+        del_lens = del_ends - del_starts + 1
+        # only consider deletions longer than 1nts, and shorter than 500nts
+        keep = (del_lens >= min_del_len) & (del_lens < max_del_len)
+        rows, del_starts, del_ends, del_lens = rows[keep], del_starts[keep], del_ends[keep], del_lens[keep]
+        # wide-to-long data manipulation: one record for each deletion in each sample
+        seqsdf = seqsdf.loc[rows]
+        seqsdf['del_start'] = del_starts
+        seqsdf['del_end'] = del_ends
+        seqsdf['del_len'] = del_lens
         # fetch coordinates of each deletion
-        seqsdf['relative_coords'] = seqsdf['del_positions'].apply(get_indel_coords)
+        seqsdf['relative_coords'] = join_coords(del_starts, del_ends)
         seqsdf['type'] = 'deletion'
         # adjust coordinates to account for the nts trimmed from beginning e.g. 265nts
-        seqsdf['absolute_coords'] = seqsdf['relative_coords'].apply(adjust_coords, args=(start_pos+1,))
-        seqsdf['pos'] = seqsdf['absolute_coords'].apply(lambda x: int(x.split(':')[0])+1)
-        print(f"Mapping Genes to mutations...")
+        abs_starts, abs_ends = del_starts + start_pos + 1, del_ends + start_pos + 1
+        seqsdf['absolute_coords'] = join_coords(abs_starts, abs_ends)
+        seqsdf['pos'] = abs_starts + 1
+        stage(f"Mapping Genes to mutations...", rows=seqsdf.shape[0])
         # approximate the gene where each deletion was identified
-        seqsdf['gene'] = seqsdf['pos'].apply(map_gene_to_pos)
-        seqsdf.loc[seqsdf['gene'].isna(), 'gene'] = 'Non-coding region'
-        # seqsdf = seqsdf.loc[~seqsdf['gene'].isna()]
-        # filter our substitutions in non-gene positions
-        seqsdf.loc[seqsdf['gene']=='nan', 'gene'] = 'Non-coding region'
-        # seqsdf = seqsdf.loc[seqsdf['gene']!='nan']
-        print(f"Computing codon numbers...")
-        seqsdf['codon_num'] = seqsdf.apply(compute_codon_num, args=(gene2pos,), axis=1)
-        print(f"Fetching reference codon...")
-        # fetch the reference codon for each substitution
-        # seqsdf['ref_codon'] = seqsdf.apply(get_ref_codon, args=(ref_seq, gene2pos), axis=1)
-        print(f"Mapping amino acids...")
-        # fetch the reference and alternative amino acids
-        # seqsdf['ref_aa'] = seqsdf['ref_codon'].apply(get_aa)
+        annotation = AnnotationIndex(gene2pos)
+        gene_codes = annotation.get_gene_codes(seqsdf['pos'].values)
+        seqsdf['gene'] = annotation.genes[gene_codes]
+        stage(f"Computing codon numbers...", rows=seqsdf.shape[0])
+        gene_starts = annotation.get_gene_starts(gene_codes, default=-1)
+        seqsdf['codon_num'] = np.where(gene_starts >= 0, 
+                                       np.ceil((seqsdf['pos'] - gene_starts + 1) / 3), 0).astype(int)
         # record the deletion subsequence
-        seqsdf['del_seq'] = seqsdf['absolute_coords'].apply(get_deletion, args=(ref_seq,))
+        seqsdf['del_seq'] = [ref_seq[start-1:end] for start, end in zip(abs_starts, abs_ends)]
         # record the 10 nts before each deletion (based on reference seq)
-        seqsdf['prev_10nts'] = seqsdf['absolute_coords'].apply(lambda x: ref_seq[int(x.split(':')[0])-11:int(x.split(':')[0])-1])
+        seqsdf['prev_10nts'] = [ref_seq[start-11:start-1] for start in abs_starts]
         # record the 10 nts after each deletion (based on reference seq)
-        seqsdf['next_10nts'] = seqsdf['absolute_coords'].apply(lambda x: ref_seq[int(x.split(':')[1]):int(x.split(':')[1])+10])
-        print("Naming deletions")
-        seqsdf['pos'] = seqsdf['absolute_coords'].apply(lambda x: int(x.split(':')[0]))
+        seqsdf['next_10nts'] = [ref_seq[end:end+10] for end in abs_ends]
+        stage("Naming deletions", rows=seqsdf.shape[0])
+        seqsdf['pos'] = abs_starts
         seqsdf['ref_codon'] = seqsdf['del_seq'].copy()
-        seqsdf['gene_start_pos'] = seqsdf['gene'].apply(lambda x: gene2pos.get(x, {}).get('start', -2)+2)
+        seqsdf['gene_start_pos'] = np.where(gene_starts >= 0, gene_starts + 2, 0)
         seqsdf['pos_in_codon'] = (seqsdf['pos'] - seqsdf['gene_start_pos']) % 3
-        seqsdf['mutation'] = seqsdf[['pos_in_codon', 'gene', 'codon_num', 'del_len']].apply(assign_deletion_v2, axis=1)
-        seqsdf['deletion_codon_coords'] = seqsdf[['pos_in_codon', 'gene', 'codon_num', 'del_len']].apply(assign_deletion_codon_coords, axis=1)
-        seqsdf['is_frameshift'] = seqsdf['del_len'].apply(is_frameshift)
-        del seqs
-        gc.collect();
-        print(f"Fuse with metadata...")
-        # load and join metadata
-        if meta_fp:
-            if data_src=='alab':
-                meta = pd.read_csv(meta_fp)
-                seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='fasta_hdr')
-                # clean and process sample collection dates
-                seqsdf = seqsdf.loc[(seqsdf['collection_date']!='Unknown') 
-                            & (seqsdf['collection_date']!='1900-01-00')]
-                seqsdf.loc[seqsdf['collection_date'].str.contains('/'), 'collection_date'] = seqsdf['collection_date'].apply(lambda x: x.split('/')[0])
-                seqsdf['date'] = pd.to_datetime(seqsdf['collection_date'])
-            elif data_src=='gisaid':
-                meta = pd.read_csv(meta_fp, sep='\t', compression='gzip')
-                # filter out improper collection dates
-                # meta['tmp'] = meta['date'].str.split('-')
-                # meta = meta[meta['tmp'].str.len()>=3]
-                seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='strain')
-                # seqsdf['date'] = pd.to_datetime(seqsdf['date'], errors='coerce')
-                # seqsdf['month'] = seqsdf['date'].dt.month
-                seqsdf.loc[seqsdf['location'].isna(), 'location'] = 'unk'
-                seqsdf = seqsdf[seqsdf['host']=='Human']
-                seqsdf.loc[seqsdf['country']=='USA', 'country'] = 'United States of America'
-            elif data_src=='gisaid_feed':
-                meta = pd.read_csv(meta_fp, sep='\t', compression='gzip')
-                seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='strain')
-                # seqsdf.loc[seqsdf['country']=='USA', 'country'] = 'United States of America'
-            else:
-                raise ValueError(f"user-specified data source {data_src} not recognized. Aborting.")
+        seqsdf['mutation'] = name_indels(seqsdf['gene'].values, seqsdf['codon_num'].values, 
+                                         seqsdf['pos_in_codon'].values, del_lens, 'DEL')
+        seqsdf['deletion_codon_coords'] = name_deletion_codon_coords(seqsdf['gene'].values, seqsdf['codon_num'].values, 
+                                                                     seqsdf['pos_in_codon'].values, del_lens)
+        seqsdf['is_frameshift'] = (del_lens % 3) != 0
+        # one record for each deletion in each sample
+        seqsdf = expand_identical_sequences(seqsdf, samples, seq_codes, first)
+        stage(f"Fuse with metadata...", rows=seqsdf.shape[0])
+        # join metadata
+        if meta is not None:
+            seqsdf = merge_metadata(seqsdf, meta, data_src)
     except:
         print(f"No deletions found in any of the sequences in the alignment. Output will contain an empty dataframe")
         seqsdf = pd.DataFrame()
-    return seqsdf, ref_seq
+    return seqsdf
 
 
 def get_deletion(x, ref_seq):
@@ -396,6 +1083,7 @@ def assign_deletion(x):
     return deletion
 
     
+@traced
 def identify_insertions_per_sample(cns, 
                                    meta_fp=None, 
                                    gene2pos: dict=bd.GENE2POS, 
@@ -405,115 +1093,316 @@ def identify_insertions_per_sample(cns,
                                    end_pos=29674,
                                    patient_zero: str='NC_045512.2',
                                    test=False):
-        """Returns dataframe of all insertion-based mutations from a pre-loaded multiple sequence alignment, 
-            containing the reference sequence (default: NC_045512.2)
-            The data is NOT aggregated, meaning that there will be a record for each observed insertion for each sample"""
-        # load into dataframe
-        ref_seq = get_seq(cns, patient_zero)[start_pos:end_pos]
-        insert_positions = identify_insertion_positions(ref_seq)
-        # insert_positions = []
-        # prev_insertion_len = 0
-        # for insertion in mit.consecutive_groups(insert_positions_tmp):
-        #     insertion = list(insertion)
-        #     for ins_pos in insertion:
-        #         insert_positions.append(ins_pos-prev_insertion_len+1)
-        #     prev_insertion_len += len(insertion)
-        if insert_positions:
-            seqs = get_seqs(cns)
-        else:
-            print(f"No insertions found in any of the sequences in the alignment. Output will contain an empty dataframe")
-            return pd.DataFrame(), ref_seq
-        seqsdf = (pd.DataFrame(index=seqs.keys(), 
-                               data=seqs.values(), 
-                               columns=['sequence'])
-                    .reset_index()
-                    .rename(columns={'index': 'idx'}))
-        seqsdf['seq_len'] = seqsdf['sequence'].str.len()
-        # identify contiguous insertions 
-        seqsdf['ins_positions'] = seqsdf['sequence'].apply(find_insertions, args=(insert_positions,))
-        # keep sequences with one or more insertions
-        seqsdf = seqsdf.loc[seqsdf['ins_positions'].str.len() > 0]
-        # drop sequences to save mem 
-        seqsdf.drop(columns=['sequence'], inplace=True)
-        seqsdf = seqsdf.explode('ins_positions')
-        # compute length of each insertion
-        seqsdf['ins_len'] = seqsdf['ins_positions'].apply(len)
-        # only consider insertions longer than 2nts
-        seqsdf = seqsdf[seqsdf['ins_len'] >= min_ins_len]
-        # fetch coordinates of each insertion
-        seqsdf['relative_coords'] = seqsdf['ins_positions'].apply(get_indel_coords)
-        seqsdf['absolute_coords'] = seqsdf['relative_coords'].apply(adjust_coords, args=(start_pos,))
-        # record the deletion subsequence
-        # seqsdf['ins_seq'] = seqsdf['absolute_coords'].apply(get_deletion, args=(ref_seq,))
-        seqsdf['pos'] = seqsdf['absolute_coords'].apply(lambda x: int(x.split(':')[0])+1)
-
-        # approximate the gene where each insertion was identified
-        seqsdf['gene'] = seqsdf['pos'].apply(map_gene_to_pos)
-        seqsdf.loc[seqsdf['gene'].isna(), 'gene'] = 'Non-coding region'
-        # seqsdf = seqsdf.loc[~seqsdf['gene'].isna()]
-        # filter our substitutions in non-gene positions
-        seqsdf.loc[seqsdf['gene']=='nan', 'gene'] = 'Non-coding region'
-        # compute codon number of each substitution
-        seqsdf['codon_num'] = seqsdf.apply(compute_codon_num, args=(gene2pos,), axis=1)
-        # fetch the reference codon for each substitution
-        seqsdf['ref_codon'] = seqsdf.apply(get_ref_codon, args=(ref_seq, gene2pos), axis=1)
-        # fetch the reference and alternative amino acids
-        seqsdf['ref_aa'] = seqsdf['ref_codon'].apply(get_aa)
-        # start position of the gene that each insert is found on
-        seqsdf['gene_start_pos'] = seqsdf['gene'].apply(lambda x: gene2pos.get(x, {}).get('start', -2)+2)
-        # insert position in codon number
-        seqsdf['pos_in_codon'] = (seqsdf['pos'] - seqsdf['gene_start_pos']) % 3
-        # insert mutation name
-        seqsdf['mutation'] = seqsdf[['pos_in_codon', 'gene', 'codon_num', 'ins_len']].apply(assign_insertion_v2, axis=1)
-        # # record the 5 nts before each deletion (based on reference seq)
-        # ins_seqs['prev_5nts'] = ins_seqs['absolute_coords'].apply(lambda x: ref_seq[int(x.split(':')[0])-5:int(x.split(':')[0])])
-        # # record the 5 nts after each deletion (based on reference seq)
-        # ins_seqs['next_5nts'] = ins_seqs['absolute_coords'].apply(lambda x: ref_seq[int(x.split(':')[1])+1:int(x.split(':')[1])+6])
-        seqsdf['type'] = 'insertion'
-        seqsdf['is_frameshift'] = seqsdf['ins_len'].apply(is_frameshift)
-        # record the 10 nts before each deletion (based on reference seq)
-        seqsdf['prev_10nts'] = seqsdf['relative_coords'].apply(lambda x: ref_seq[int(x.split(':')[0])-10:int(x.split(':')[0])])
-        # record the 10 nts after each deletion (based on reference seq)
-        seqsdf['next_10nts'] = seqsdf['relative_coords'].apply(lambda x: ref_seq[int(x.split(':')[1])+1:int(x.split(':')[1])+11])
-
-        ref_seq = get_seq(cns, patient_zero)
-        coord_begin = seqsdf['pos']
-        coord_end = seqsdf['absolute_coords'].apply(lambda x: int(x.split(':')[1])+1)
-        num_ins_before_pos = [ref_seq.count('-', 0, pos+1) for pos in coord_begin]
-        coord_begin = [pos - i for pos, i in zip(coord_begin, num_ins_before_pos)]
-        coord_end = [pos - i for pos, i in zip(coord_end, num_ins_before_pos)]
-        new_abs_coords = [str(begin) + ":" + str(end) for begin, end in zip(coord_begin, coord_end)]
-        seqsdf['absolute_coords'] = new_abs_coords
-
-        if meta_fp:
-            # load and join metadata
-            meta = pd.read_csv(meta_fp)
-            seqsdf = pd.merge(seqsdf, meta, left_on='idx', right_on='fasta_hdr')
-            # clean and process sample collection dates
-            seqsdf = seqsdf.loc[(seqsdf['collection_date']!='Unknown') 
-                        & (seqsdf['collection_date']!='1900-01-00')]
-            seqsdf.loc[seqsdf['collection_date'].str.contains('/'), 'collection_date'] = seqsdf['collection_date'].apply(lambda x: x.split('/')[0])
-            seqsdf['date'] = pd.to_datetime(seqsdf['collection_date'])
-        return seqsdf, ref_seq
-
-
-def pad_aligned_sequences(in_fp, out_fp):
-    """helper function that ensures all sequences in the given alignment have equal length using padding"""
-    records = SeqIO.parse(in_fp, 'fasta')
-    records = list(records) # make a copy, otherwise our generator
-                            # is exhausted after calculating maxlen
-    maxlen = max(len(record.seq) for record in records)
+    """Returns dataframe of all insertion-based mutations from a pre-loaded multiple sequence alignment, 
+        containing the reference sequence (default: NC_045512.2)
+        The data is NOT aggregated, meaning that there will be a record for each observed insertion for each sample"""
+    # sample metadata is expected in the A-lab format
+    meta = load_metadata(meta_fp, 'alab') if meta_fp else None
+    return call_insertions(cns, meta, gene2pos, 'alab', min_ins_len, 
+                           start_pos, end_pos, patient_zero)
+
+
+@traced
+def call_insertions(cns, 
+                    meta: pd.DataFrame=None,
+                    gene2pos: dict=bd.GENE2POS, 
+                    data_src='alab',
+                    min_ins_len=1, 
+                    start_pos=265,
+                    end_pos=29674,
+                    patient_zero: str='NC_045512.2') -> Tuple[pd.DataFrame, str]:
+    """Returns dataframe of all insertion-based mutations from a pre-loaded multiple sequence alignment, 
+    before insertions are removed from it (see `process_cns_seqs`)"""
+    cns = IndexedAlignment.from_records(cns)
+    # load into dataframe
+    aln_ref_seq = cns.get_seq(patient_zero)
+    coords = CoordinateMapper(aln_ref_seq)
+    ref_seq = aln_ref_seq[start_pos:end_pos]
+    insert_positions = coords.insertion_positions
+    insert_positions = (insert_positions[(insert_positions >= start_pos) & (insert_positions < end_pos)] - start_pos).tolist()
+    # insert_positions = []
+    # prev_insertion_len = 0
+    # for insertion in mit.consecutive_groups(insert_positions_tmp):
+    #     insertion = list(insertion)
+    #     for ins_pos in insertion:
+    #         insert_positions.append(ins_pos-prev_insertion_len+1)
+    #     prev_insertion_len += len(insertion)
+    if insert_positions:
+        seqs = get_seqs(cns)
+    else:
+        print(f"No insertions found in any of the sequences in the alignment. Output will contain an empty dataframe")
+        return pd.DataFrame(), ref_seq
+    seqsdf = (pd.DataFrame(index=seqs.keys(), 
+                           data=seqs.values(), 
+                           columns=['sequence'])
+                .reset_index()
+                .rename(columns={'index': 'idx'}))
+    seqsdf['seq_len'] = seqsdf['sequence'].str.len()
+    # collapse identical sequences, so that insertions are identified once per distinct sequence
+    samples = seqsdf[['idx', 'seq_len']]
+    seqsdf, seq_codes, first = collapse_identical_sequences(seqsdf, seqsdf['sequence'].values)
+    # identify contiguous insertions 
+    seqsdf['ins_positions'] = seqsdf['sequence'].apply(find_insertions, args=(insert_positions,))
+    # keep sequences with one or more insertions
+    seqsdf = seqsdf.loc[seqsdf['ins_positions'].str.len() > 0]
+    # drop sequences to save mem 
+    seqsdf.drop(columns=['sequence'], inplace=True)
+    seqsdf = seqsdf.explode('ins_positions')
+    # compute length of each insertion
+    seqsdf['ins_len'] = seqsdf['ins_positions'].apply(len)
+    # only consider insertions longer than 2nts
+    seqsdf = seqsdf[seqsdf['ins_len'] >= min_ins_len]
+    # fetch coordinates of each insertion
+    seqsdf['relative_coords'] = seqsdf['ins_positions'].apply(get_indel_coords)
+    seqsdf['absolute_coords'] = seqsdf['relative_coords'].apply(adjust_coords, args=(start_pos,))
+    # record the deletion subsequence
+    # seqsdf['ins_seq'] = seqsdf['absolute_coords'].apply(get_deletion, args=(ref_seq,))
+    seqsdf['pos'] = seqsdf['absolute_coords'].apply(lambda x: int(x.split(':')[0])+1)
+
+    # approximate the gene where each insertion was identified
+    annotation = AnnotationIndex(gene2pos)
+    gene_codes = annotation.get_gene_codes(seqsdf['pos'].values)
+    seqsdf['gene'] = annotation.genes[gene_codes]
+    # compute codon number of each substitution
+    gene_starts = annotation.get_gene_starts(gene_codes, default=-1)
+    is_gene = gene_starts >= 0
+    seqsdf['codon_num'] = np.where(is_gene, np.ceil((seqsdf['pos'] - gene_starts + 1) / 3), 0).astype(int)
+    # fetch the reference codon for each substitution
+    codon_starts = gene_starts + ((seqsdf['codon_num'].values - 1) * 3)
+    seqsdf['ref_codon'] = [ref_seq[start:start+3].upper() if coding else 'NA' 
+                           for start, coding in zip(codon_starts, is_gene)]
+    # fetch the reference and alternative amino acids
+    seqsdf['ref_aa'] = annotation.translate(seqsdf['ref_codon'].values)
+    # start position of the gene that each insert is found on
+    seqsdf['gene_start_pos'] = np.where(is_gene, gene_starts + 2, 0)
+    # insert position in codon number
+    seqsdf['pos_in_codon'] = (seqsdf['pos'] - seqsdf['gene_start_pos']) % 3
+    # insert mutation name
+    seqsdf['mutation'] = name_indels(seqsdf['gene'].values, seqsdf['codon_num'].values, 
+                                     seqsdf['pos_in_codon'].values, seqsdf['ins_len'].values, 'INS')
+    # # record the 5 nts before each deletion (based on reference seq)
+    # ins_seqs['prev_5nts'] = ins_seqs['absolute_coords'].apply(lambda x: ref_seq[int(x.split(':')[0])-5:int(x.split(':')[0])])
+    # # record the 5 nts after each deletion (based on reference seq)
+    # ins_seqs['next_5nts'] = ins_seqs['absolute_coords'].apply(lambda x: ref_seq[int(x.split(':')[1])+1:int(x.split(':')[1])+6])
+    seqsdf['type'] = 'insertion'
+    seqsdf['is_frameshift'] = (seqsdf['ins_len'] % 3) != 0
+    # record the 10 nts before each deletion (based on reference seq)
+    seqsdf['prev_10nts'] = seqsdf['relative_coords'].apply(lambda x: ref_seq[int(x.split(':')[0])-10:int(x.split(':')[0])])
+    # record the 10 nts after each deletion (based on reference seq)
+    seqsdf['next_10nts'] = seqsdf['relative_coords'].apply(lambda x: ref_seq[int(x.split(':')[1])+1:int(x.split(':')[1])+11])
+
+    ref_seq = aln_ref_seq
+    coord_begin = seqsdf['pos'].values
+    coord_end = seqsdf['absolute_coords'].apply(lambda x: int(x.split(':')[1])+1).values
+    num_ins_before_pos = coords.count_insertions(coord_begin + 1)
+    seqsdf['absolute_coords'] = join_coords(coord_begin - num_ins_before_pos, coord_end - num_ins_before_pos)
+    # one record for each insertion in each sample
+    seqsdf = expand_identical_sequences(seqsdf, samples, seq_codes, first)
+
+    # join metadata
+    if meta is not None:
+        seqsdf = merge_metadata(seqsdf, meta, data_src)
+    return seqsdf, ref_seq
 
+
+@traced
+def identify_replacements_per_sample_streaming(fasta_fp: str, 
+                                               meta_fp=None,
+                                               gene2pos: dict=bd.GENE2POS,
+                                               data_src: str='gisaid',
+                                               min_seq_len=20000,
+                                               max_num_subs=5000,
+                                               patient_zero: str='NC_045512.2',
+                                               is_gzip: bool=False,
+                                               max_memory_mb: int=2048,
+                                               out_dir: str=None) -> Tuple[list, str]:
+    """Streaming version of `identify_replacements_per_sample` for alignments that are too large to be loaded 
+    in memory: the alignment file is read in batches of records sized by `max_memory_mb`, and the substitutions 
+    found in each batch are saved to `out_dir` (default: temporary directory).
+    Returns the filepaths of the per-batch results (see `load_batch_results`) and the reference sequence"""
+    meta = load_metadata(meta_fp, data_src) if meta_fp else None
+    if out_dir is None:
+        out_dir = tempfile.mkdtemp(prefix='bjorn_batches_')
+    os.makedirs(out_dir, exist_ok=True)
+    batch_fps, ref_seq = [], ''
+    for batch_num, (seqsdf, seq_arr, ref_seq) in enumerate(stream_cns_batches(fasta_fp, patient_zero, 0, 29674, 
+                                                                                   is_gzip, max_memory_mb)):
+        stage(f"Identifying substitutions in batch {batch_num}...")
+        batch_df = call_replacements(seqsdf, seq_arr, ref_seq, meta, gene2pos, data_src, 
+                                     min_seq_len, max_num_subs)
+        batch_fps.append(save_batch_results(batch_df, batch_num, out_dir))
+    return batch_fps, ref_seq
+
+
+@traced
+def identify_deletions_per_sample_streaming(fasta_fp: str, 
+                                            meta_fp=None,
+                                            gene2pos: dict=bd.GENE2POS,
+                                            data_src: str='gisaid',
+                                            min_del_len=1, 
+                                            max_del_len=500,
+                                            min_seq_len=20000,
+                                            start_pos=265,
+                                            end_pos=29674,
+                                            patient_zero: str='NC_045512.2',
+                                            is_gzip: bool=False,
+                                            max_memory_mb: int=2048,
+                                            out_dir: str=None) -> Tuple[list, str]:
+    """Streaming version of `identify_deletions_per_sample` for alignments that are too large to be loaded 
+    in memory: the alignment file is read in batches of records sized by `max_memory_mb`, and the deletions 
+    found in each batch are saved to `out_dir` (default: temporary directory).
+    Returns the filepaths of the per-batch results (see `load_batch_results`) and the reference sequence"""
+    meta = load_metadata(meta_fp, data_src) if meta_fp else None
+    if out_dir is None:
+        out_dir = tempfile.mkdtemp(prefix='bjorn_batches_')
+    os.makedirs(out_dir, exist_ok=True)
+    batch_fps, ref_seq = [], ''
+    for batch_num, (seqsdf, seq_arr, ref_seq) in enumerate(stream_cns_batches(fasta_fp, patient_zero, start_pos, end_pos, 
+                                                                                   is_gzip, max_memory_mb)):
+        stage(f"Identifying deletions in batch {batch_num}...")
+        batch_df = call_deletions(seqsdf, seq_arr, ref_seq, meta, gene2pos, data_src,
+                                  min_seq_len, min_del_len, max_del_len, start_pos)
+        batch_fps.append(save_batch_results(batch_df, batch_num, out_dir))
+    return batch_fps, ref_seq
+
+
+def stream_cns_batches(fasta_fp: str, patient_zero: str, start_pos: int, end_pos: int, 
+                       is_gzip: bool=False, max_memory_mb: int=2048):
+    """Generator that reads an alignment file in batches of records and yields each batch as processed 
+    by `process_cns_array` i.e. a dataframe of sample names (indexed by row) along with the trimmed alignment 
+    and the reference sequence. The number of records per batch is chosen such that the memory used 
+    by each batch stays within `max_memory_mb`"""
+    # first pass: fetch the reference sequence (used to remove insertions from each batch)
+    with open_fasta(fasta_fp, is_gzip) as handle:
+        ref_rec = next((rec for rec in SeqIO.parse(handle, 'fasta') if patient_zero in rec.id), None)
+    if ref_rec is None:
+        print('WARNING: reference sequence not acquired. Something is off.')
+        return
+    batch_size = get_batch_size(len(ref_rec.seq), max_memory_mb)
+    print(f"Reading alignment in batches of {batch_size} sequences...")
+    num_seqs = 0
+    with open_fasta(fasta_fp, is_gzip) as handle:
+        for batch in batch_iterator(SeqIO.parse(handle, 'fasta'), batch_size):
+            # the reference is appended to batches that do not contain it, and dropped afterwards
+            has_ref = any(patient_zero in rec.id for rec in batch)
+            cns = IndexedAlignment.from_records(batch if has_ref else [ref_rec] + batch)
+            del batch
+            names, seq_arr, ref_seq = process_cns_array(cns, patient_zero, start_pos, end_pos)
+            del cns
+            if not has_ref:
+                names, seq_arr = names[1:], seq_arr[1:]
+            seqsdf = pd.DataFrame({'idx': names, 'seq_len': seq_arr.shape[1]})
+            yield seqsdf, seq_arr, ref_seq
+            num_seqs += len(names)
+    print(f"Processed {num_seqs} sequences")
+
+
+def get_batch_size(aln_len: int, max_memory_mb: int, bytes_per_nt: int=8) -> int:
+    """Number of aligned sequences that can be processed at once within `max_memory_mb`, assuming that each 
+    nucleotide takes up `bytes_per_nt` bytes (parsed records, alignment matrix and the masks computed over it)"""
+    return max(1, (max_memory_mb * 2**20) // (aln_len * bytes_per_nt))
+
+
+def open_fasta(fasta_fp: str, is_gzip: bool=False, binary: bool=False):
+    """Opens a (optionally gzip-compressed) FASTA file for reading, as text or bytes"""
+    mode = 'rb' if binary else 'r'
+    return gzip.open(fasta_fp, mode if binary else 'rt') if is_gzip else open(fasta_fp, mode)
+
+
+def save_batch_results(batch_df: pd.DataFrame, batch_num: int, out_dir: str) -> str:
+    """Saves the mutations found in a batch of sequences to `out_dir`. Returns the filepath of the saved results"""
+    batch_fp = os.path.join(out_dir, f'batch_{batch_num}.pkl')
+    batch_df.to_pickle(batch_fp)
+    return batch_fp
+
+
+def load_batch_results(batch_fps: list) -> pd.DataFrame:
+    """Loads and combines the per-batch results of `identify_*_per_sample_streaming`"""
+    batch_dfs = [pd.read_pickle(fp) for fp in batch_fps]
+    batch_dfs = [df for df in batch_dfs if not df.empty]
+    if not batch_dfs:
+        return pd.DataFrame()
+    return pd.concat(batch_dfs, ignore_index=True)
+
+
+@traced
+def pad_aligned_sequences(in_fp, out_fp, is_gzip: bool=False, line_width: int=60):
+    """helper function that ensures all sequences in the given alignment have equal length using padding.
+    The (optionally gzip-compressed) alignment is streamed twice: once to find the length of the longest 
+    sequence by scanning its lines, and once to write out each padded record, one record at a time"""
+    with open_fasta(in_fp, is_gzip, binary=True) as f:
+        maxlen = max(scan_fasta_lengths(f), default=0)
     # pad sequences so that they all have the same length
-    for record in records:
-        if len(record.seq) != maxlen:
-            sequence = str(record.seq).ljust(maxlen, '.')
-            record.seq = Seq.Seq(sequence)
-    assert all(len(record.seq) == maxlen for record in records)
-    # write to temporary file and do alignment
-    with open(out_fp, 'w') as f:
-        SeqIO.write(records, f, 'fasta')
+    with open_fasta(in_fp, is_gzip, binary=True) as f, open(out_fp, 'wb') as out:
+        title, fragments = None, []
+        for next_title, fragment in iter_fasta_blocks(f):
+            if next_title is None:
+                fragments.append(fragment)
+                continue
+            if title is not None:
+                write_padded_record(out, title, fragments, maxlen, line_width)
+            title, fragments = next_title, []
+        if title is not None:
+            write_padded_record(out, title, fragments, maxlen, line_width)
     return out_fp
+
+
+def scan_fasta_lengths(handle):
+    """helper function that yields the length of each sequence in a FASTA file (opened in binary mode), 
+    by counting the characters between headers (without building any records)"""
+    seq_len = None
+    for title, fragment in iter_fasta_blocks(handle):
+        if title is not None:
+            if seq_len is not None:
+                yield seq_len
+            seq_len = 0
+        elif seq_len is not None:
+            seq_len += len(fragment.translate(None, FASTA_WHITESPACE))
+    if seq_len is not None:
+        yield seq_len
+
+
+def iter_fasta_blocks(handle, block_size: int=2**22):
+    """helper function that reads a FASTA file (opened in binary mode) block by block, yielding the title of each 
+    record as (title, None), followed by its sequence as one or more raw fragments (None, fragment) that may still 
+    contain line breaks. Only one block (and the line that overlaps the next block) is held in memory at a time"""
+    tail = b''
+    while True:
+        block = handle.read(block_size)
+        if not block and not tail:
+            break
+        block = tail + block if block else tail + b'\n'
+        # only process complete lines, the last (partial) line is carried over to the next block
+        cut = block.rfind(b'\n') + 1
+        block, tail = block[:cut], block[cut:]
+        pos = 0
+        while pos < len(block):
+            if block.startswith(b'>', pos):
+                end = block.index(b'\n', pos)
+                yield block[pos+1:end].rstrip(), None
+                pos = end + 1
+            else:
+                end = block.find(b'\n>', pos) + 1
+                end = end if end > 0 else len(block)
+                yield None, block[pos:end]
+                pos = end
+
+
+def write_padded_record(out, title: bytes, fragments: list, maxlen: int, line_width: int=60):
+    """helper function that writes a FASTA record padded to `maxlen` using '.', wrapped every `line_width` nts"""
+    sequence = b''.join(fragments).translate(None, FASTA_WHITESPACE).ljust(maxlen, b'.')
+    out.write(b'>' + title + b'\n')
+    if sequence:
+        # wrap the sequence by adding a column of line breaks to the (num_lines x line_width) matrix of nts
+        num_lines = -(-len(sequence) // line_width)
+        lines = np.full((num_lines, line_width + 1), ord('\n'), dtype=np.uint8)
+        lines[:, :line_width] = np.frombuffer(sequence.ljust(num_lines * line_width, b'\n'), dtype=np.uint8).reshape(num_lines, line_width)
+        last_line_len = len(sequence) - (num_lines - 1) * line_width
+        out.write(lines.tobytes()[:(num_lines - 1) * (line_width + 1) + last_line_len] + b'\n')
+
+
+# characters that are ignored within sequences when parsing FASTA files
+FASTA_WHITESPACE = b' \t\r\n'
     
 
 def process_cns_seqs(cns_data: Align.MultipleSeqAlignment, patient_zero: str,
@@ -521,31 +1410,54 @@ def process_cns_seqs(cns_data: Align.MultipleSeqAlignment, patient_zero: str,
     """Process aligned consensus sequences to prepare them for identifying deletions. 
     The reference sequence is used to identify insertion positions, 
     which are then removed and position numbers are updated."""
-    # sequence for patient zero (before removing pseudo deletions)
-    ref_seq = get_seq(cns_data, patient_zero)
-    # identify insertions (by identifyin 'fake' deletions in the aligned reference sequence)
-    insertion_positions = identify_insertion_positions(ref_seq)
-    # remove insertions from each sequence to consolidate correct nt positions
-    for rec in cns_data:
-        rec.seq = remove_insertions(str(rec.seq), insertion_positions)
-    # sanity check: ensure that there are no "fake" deletions in reference sequence
-    ref_seq = get_seq(cns_data, patient_zero)
-    assert not identify_insertion_positions(ref_seq)
-    # grab sequences from MSA
-    seqs = get_seqs(cns_data, start_pos, end_pos)
+    names, seq_arr, ref_seq = process_cns_array(cns_data, patient_zero, start_pos, end_pos)
+    seqs = dict(zip(names, (row.tobytes().decode('ascii') for row in seq_arr)))
     return seqs, ref_seq
 
 
+@traced
+def process_cns_array(cns_data, patient_zero: str,
+                      start_pos: int, end_pos: int) -> Tuple[list, np.ndarray, str]:
+    """Same as `process_cns_seqs` but returns the sample names along with the trimmed alignment 
+    as a (num_samples x num_positions) matrix of bytes. Insertions are removed by applying a 
+    single keep-mask (built from the gaps in the reference sequence) to the whole alignment, 
+    the input alignment is left untouched"""
+    cns_data = IndexedAlignment.from_records(cns_data)
+    names, aln = cns_data.ids, cns_data.seq_arr
+    # sequence for patient zero (before removing pseudo deletions)
+    ref_row = cns_data.get_row(patient_zero)
+    if ref_row >= 0:
+        # insertions are the 'fake' deletions in the aligned reference sequence
+        coords = CoordinateMapper(aln[ref_row])
+        ref_seq = aln[ref_row, coords.ref2aln].tobytes().decode('ascii')
+        cols = coords.ref2aln[start_pos:end_pos]
+    else:
+        print('WARNING: reference sequence not acquired. Something is off.')
+        ref_seq = ''
+        cols = np.arange(aln.shape[1])[start_pos:end_pos]
+    # one record per sample name (the last one wins, as when parsing the MSA into a dict)
+    rows = {}
+    for i, name in enumerate(names):
+        rows[name] = i
+    if len(rows) < len(names):
+        aln = aln[list(rows.values())]
+    # np.take keeps the rows of the trimmed alignment contiguous (unlike fancy indexing along columns)
+    return list(rows.keys()), np.take(aln, cols, axis=1), ref_seq
+
+
 def identify_insertion_positions(ref_seq: str) -> list:
     """helper function to identify positions where '-' was found in a sequence"""
-    return [m.start() for m in re.finditer('-', str(ref_seq))]
+    return CoordinateMapper(str(ref_seq)).insertion_positions.tolist()
 
 
 # support functions
 def get_seqs(bio_seqs: Align.MultipleSeqAlignment, min_pos: int=265, max_pos: int=29674) -> dict:
-    """Parse aligned sequences from Bio.Align.MultipleSeqAlignment to a dict object.
+    """Parse aligned sequences from Bio.Align.MultipleSeqAlignment (or `IndexedAlignment`) to a dict object.
     The keys are sample names and values are their consensus sequences. 
     Each sequence is trimmed from both ends using `min_pos` and `max_pos`"""
+    if isinstance(bio_seqs, IndexedAlignment):
+        return {sample_name: bio_seqs.get_row_seq(i)[min_pos:max_pos] 
+                for i, sample_name in enumerate(bio_seqs.ids)}
     seqs = {}
     for row in bio_seqs:
         sample_name = str(row.id)
@@ -597,25 +1509,297 @@ def get_alt_codon_old(x, seqs: dict, gene2pos: dict):
 
 def get_aa(codon: str):
     "Support function for mapping codon to amino acid/stop"
-    CODON2AA = { 
-        'ATA':'I', 'ATC':'I', 'ATT':'I', 'ATG':'M', 
-        'ACA':'T', 'ACC':'T', 'ACG':'T', 'ACT':'T', 
-        'AAC':'N', 'AAT':'N', 'AAA':'K', 'AAG':'K', 
-        'AGC':'S', 'AGT':'S', 'AGA':'R', 'AGG':'R',                  
-        'CTA':'L', 'CTC':'L', 'CTG':'L', 'CTT':'L', 
-        'CCA':'P', 'CCC':'P', 'CCG':'P', 'CCT':'P', 
-        'CAC':'H', 'CAT':'H', 'CAA':'Q', 'CAG':'Q', 
-        'CGA':'R', 'CGC':'R', 'CGG':'R', 'CGT':'R', 
-        'GTA':'V', 'GTC':'V', 'GTG':'V', 'GTT':'V', 
-        'GCA':'A', 'GCC':'A', 'GCG':'A', 'GCT':'A', 
-        'GAC':'D', 'GAT':'D', 'GAA':'E', 'GAG':'E', 
-        'GGA':'G', 'GGC':'G', 'GGG':'G', 'GGT':'G', 
-        'TCA':'S', 'TCC':'S', 'TCG':'S', 'TCT':'S', 
-        'TTC':'F', 'TTT':'F', 'TTA':'L', 'TTG':'L', 
-        'TAC':'Y', 'TAT':'Y', 'TAA':'*', 'TAG':'*', 
-        'TGC':'C', 'TGT':'C', 'TGA':'*', 'TGG':'W', 
-    } 
-    return CODON2AA.get(codon, 'nan')
+    return bd.CODON2AA.get(codon, 'nan')
+
+
+class AnnotationIndex:
+    """Precompiled index of the reference genome annotation, used to map whole arrays of mutations 
+    to genes (using sorted gene intervals), codon numbers and amino acids (using a 64-slot codon table) at once"""
+    NON_CODING = 'Non-coding region'
+    NTS = 'ACGT'
+
+    def __init__(self, gene2pos: dict=bd.GENE2POS, gene2interval: dict=bd.GENE2INTERVAL, 
+                 codon2aa: dict=bd.CODON2AA):
+        intervals = sorted(gene2interval.items(), key=lambda x: x[1]['start'])
+        # upper bound of each interval, followed by the gap (if any) separating it from the next interval
+        bounds, genes = [], []
+        for i, (gene, coords) in enumerate(intervals):
+            if i > 0 and coords['start'] > bounds[-1]:
+                bounds.append(coords['start'])
+                genes.append(self.NON_CODING)
+            bounds.append(coords['end'])
+            genes.append(gene)
+        # the first and last intervals are open-ended
+        self.bounds = np.array(bounds[:-1])
+        self.genes = np.array(genes, dtype=object)
+        self.gene_starts = np.array([gene2pos.get(gene, {}).get('start', np.nan) for gene in genes], dtype=float)
+        # codon table, indexed by 16*nt1 + 4*nt2 + nt3 (A=0, C=1, G=2, T=3)
+        self.nt_codes = np.full(256, -1, dtype=np.int16)
+        for i, nt in enumerate(self.NTS):
+            self.nt_codes[ord(nt)] = i
+        self.aas = np.array([codon2aa.get(n1+n2+n3, 'nan') 
+                             for n1 in self.NTS for n2 in self.NTS for n3 in self.NTS] + ['nan'], dtype=object)
+
+    def get_gene_codes(self, positions: np.ndarray) -> np.ndarray:
+        """Returns the index (in `genes`) of the gene that each position belongs to (see `bjorn_support.map_gene_to_pos`)"""
+        return np.searchsorted(self.bounds, positions, side='left')
+
+    def get_gene_starts(self, gene_codes: np.ndarray, default: int) -> np.ndarray:
+        """Returns the start position of each gene, or `default` for non-coding regions"""
+        starts = self.gene_starts[gene_codes]
+        return np.where(np.isnan(starts), default, starts).astype(int)
+
+    def translate(self, codons) -> np.ndarray:
+        """Returns the amino acid encoded by each codon, given as strings or as a (num_codons x 3) matrix of bytes. 
+        Incomplete codons and codons with ambiguous nucleotides are mapped to 'nan' (see `get_aa`)"""
+        codons = np.asarray(codons)
+        if codons.dtype.kind in 'OU':
+            codons = codons.astype('S3')
+        codons = np.ascontiguousarray(codons).view(np.uint8).reshape(-1, 3)
+        nt_codes = self.nt_codes[codons]
+        slots = 16*nt_codes[:, 0] + 4*nt_codes[:, 1] + nt_codes[:, 2]
+        slots[(nt_codes < 0).any(axis=1)] = 64
+        return self.aas[slots]
+
+
+class CoordinateMapper:
+    """Maps positions between alignment columns and reference coordinates, accounting for the insertions 
+    (i.e. gaps in the aligned reference sequence). Built once per alignment using a prefix-sum over the 
+    reference gaps, after which every lookup is O(1) and accepts scalars or arrays of positions"""
+
+    def __init__(self, ref_seq):
+        ref_arr = np.frombuffer(ref_seq.encode('ascii'), dtype=np.uint8) if isinstance(ref_seq, str) else np.asarray(ref_seq)
+        self.is_gap = ref_arr == ord('-')
+        # number of gaps found in the aligned reference before each alignment column (and at its end)
+        self.gaps_before = np.concatenate([[0], np.cumsum(self.is_gap)])
+        # alignment column of each reference nucleotide
+        self.ref2aln = np.flatnonzero(~self.is_gap)
+        self.insertion_positions = np.flatnonzero(self.is_gap)
+
+    def count_insertions(self, aln_pos):
+        """Returns the number of insertions found in the alignment before `aln_pos` 
+        i.e. `ref_seq.count('-', 0, aln_pos)`"""
+        return self.gaps_before[np.clip(np.asarray(aln_pos, dtype=int), 0, len(self.is_gap))]
+
+    def to_reference(self, aln_pos):
+        """Returns the reference coordinate of each alignment column"""
+        return aln_pos - self.count_insertions(aln_pos)
+
+    def to_alignment(self, ref_pos):
+        """Returns the alignment column of each reference coordinate"""
+        return self.ref2aln[ref_pos]
+
+
+class IndexedAlignment:
+    """Multiple sequence alignment stored as one contiguous (num_samples x num_positions) matrix of bytes, 
+    along with an index from sample name to row. Can be used in place of `Bio.Align.MultipleSeqAlignment` 
+    by all `identify_*` functions, with constant-time retrieval of the reference and any sample"""
+
+    def __init__(self, ids: list, seqs: list):
+        self.ids = list(ids)
+        self.seq_arr = seqs2array(seqs)
+        self.seq_lens = np.array([len(s) for s in seqs], dtype=int)
+        # first row of each sample name
+        self.index = {}
+        for i, name in enumerate(self.ids):
+            self.index.setdefault(name, i)
+
+    @classmethod
+    def from_records(cls, records):
+        """Builds the alignment from Bio records e.g. a `Bio.Align.MultipleSeqAlignment` (no-op if already indexed)"""
+        if isinstance(records, cls):
+            return records
+        ids, seqs = [], []
+        for rec in records:
+            ids.append(str(rec.id))
+            seqs.append(str(rec.seq))
+        return cls(ids, seqs)
+
+    @classmethod
+    def from_fasta(cls, fasta_filepath):
+        """Loads the alignment from a FASTA file"""
+        return cls.from_records(SeqIO.parse(fasta_filepath, 'fasta'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for i, name in enumerate(self.ids):
+            yield SeqRecord(Seq.Seq(self.get_row_seq(i)), id=name, name=name, description=name)
+
+    def get_alignment_length(self) -> int:
+        return self.seq_arr.shape[1]
+
+    def get_row(self, sample_name: str) -> int:
+        """Returns the row of a specific sample name. Names that are not found verbatim are matched 
+        against the first sample containing them (see `get_seq`), or -1 if none does"""
+        row = self.index.get(sample_name)
+        if row is None:
+            row = next((i for i, name in enumerate(self.ids) if sample_name in name), -1)
+        return row
+
+    def get_row_seq(self, row: int) -> str:
+        return self.seq_arr[row, :self.seq_lens[row]].tobytes().decode('ascii')
+
+    def get_seq(self, sample_name: str) -> str:
+        """Fetches the aligned sequence of a specific sample name"""
+        row = self.get_row(sample_name)
+        if row < 0:
+            print('WARNING: reference sequence not acquired. Something is off.')
+            return ''
+        return self.get_row_seq(row)
+
+
+class MutationMatrix:
+    """Sparse (CSR) sample x mutation incidence matrix, along with its sample and mutation dictionaries 
+    (the name of each row, sorted, and the attributes of each column). Alternative to the comma-joined `samples` 
+    column of aggregated mutation tables, which can be queried without any string splitting"""
+
+    def __init__(self, samples: np.ndarray, mutations: pd.DataFrame, indptr: np.ndarray, indices: np.ndarray):
+        self.samples = np.asarray(samples)
+        self.mutations = mutations.reset_index(drop=True)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    @classmethod
+    def from_mutations(cls, muts: pd.DataFrame, mutation_cols: list, sample_col: str='idx', sep: str=None):
+        """Builds the matrix from a table with a record for each mutation of each sample (see `identify_*_per_sample`). 
+        If `sep` is given, the sample column is expected to contain lists of samples joined by `sep`"""
+        if sep is not None:
+            muts = muts.assign(**{sample_col: muts[sample_col].str.split(sep)}).explode(sample_col)
+        mutations = muts.groupby(mutation_cols, sort=True, dropna=False).size().index.to_frame(index=False)
+        if muts.empty:
+            return cls(np.array([], dtype=str), mutations.assign(num_samples=0), np.zeros(1), np.array([]))
+        sample_codes, samples = pd.factorize(muts[sample_col], sort=True)
+        mutation_codes = muts.groupby(mutation_cols, sort=True, dropna=False).ngroup().values
+        # unique (sample, mutation) pairs, sorted by sample and then by mutation
+        num_mutations = mutations.shape[0]
+        pairs = np.unique(sample_codes.astype(np.int64) * num_mutations + mutation_codes)
+        rows, indices = pairs // num_mutations, pairs % num_mutations
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(samples)))])
+        mutations['num_samples'] = np.bincount(indices, minlength=num_mutations)
+        return cls(np.asarray(samples, dtype=str), mutations, indptr, indices)
+
+    @classmethod
+    def load(cls, fp: str):
+        """Loads a matrix saved using `save`"""
+        with np.load(fp) as data:
+            mutations = pd.DataFrame({str(col): data[f'mutation_{col}'] for col in data['mutation_columns']})
+            return cls(data['samples'], mutations, data['indptr'], data['indices'])
+
+    def save(self, fp: str):
+        """Saves the matrix and its dictionaries to a compressed binary (.npz) file"""
+        mutations = {f'mutation_{col}': self.mutations[col].to_numpy(dtype=str if self.mutations[col].dtype==object else None)
+                     for col in self.mutations.columns}
+        np.savez_compressed(fp, samples=self.samples.astype(str), indptr=self.indptr, indices=self.indices,
+                            mutation_columns=np.array(self.mutations.columns, dtype=str), **mutations)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.samples), self.mutations.shape[0]
+
+    def get_rows(self) -> np.ndarray:
+        """Returns the row (sample) of each non-zero entry of the matrix"""
+        return np.repeat(np.arange(len(self.samples)), np.diff(self.indptr))
+
+    def get_sample_mutations(self, sample: str) -> pd.DataFrame:
+        """Returns the mutations found in a specific sample"""
+        # samples are sorted
+        row = np.searchsorted(self.samples, sample)
+        if row == len(self.samples) or self.samples[row] != sample:
+            return self.mutations.iloc[[]]
+        return self.mutations.iloc[self.indices[self.indptr[row]:self.indptr[row+1]]]
+
+    def get_mutation_samples(self, mutation_mask) -> np.ndarray:
+        """Returns the (unique) samples that contain any of the selected mutations, 
+        given as a boolean mask over `mutations`"""
+        is_selected = np.asarray(mutation_mask, dtype=bool)[self.indices]
+        return np.unique(self.samples[self.get_rows()[is_selected]])
+
+
+class DeletionIndex:
+    """Index of the deletions found in each sample, hashed by their normalized coordinates (start:end), 
+    for finding samples that share deletions without any pairwise comparison between samples 
+    (as opposed to `cross_join` and `is_deletion_common`). Deletions are stored as a sample x deletion `MutationMatrix`, 
+    along with the transposed (deletion x sample) matrix and a hash of the set of deletions of each sample"""
+
+    def __init__(self, dels: pd.DataFrame, sample_col: str='idx', coords_col: str='absolute_coords'):
+        dels = dels.assign(**{coords_col: normalize_deletion_coords(dels[coords_col])})
+        self.coords_col = coords_col
+        self.matrix = MutationMatrix.from_mutations(dels, [coords_col], sample_col)
+        self.samples = self.matrix.samples
+        self.coords = self.matrix.mutations[coords_col].values
+        self.coords_index = {coords: col for col, coords in enumerate(self.coords)}
+        # samples with each deletion (transposed matrix)
+        rows = self.matrix.get_rows()
+        order = np.argsort(self.matrix.indices, kind='stable')
+        self.sample_rows = rows[order]
+        self.sample_ptr = np.concatenate([[0], np.cumsum(np.bincount(self.matrix.indices, minlength=len(self.coords)))])
+        # set of deletions of each sample (sorted deletion codes), hashed
+        indptr, indices = self.matrix.indptr, self.matrix.indices
+        set_keys = [indices[start:end].tobytes() for start, end in zip(indptr[:-1], indptr[1:])]
+        self.set_codes, _ = pd.factorize(pd.Series(set_keys, dtype=object))
+
+    def get_samples(self, coords: str) -> np.ndarray:
+        """Returns the samples with the given deletion (start:end)"""
+        col = self.coords_index.get(normalize_deletion_coords(pd.Series([coords]))[0])
+        if col is None:
+            return self.samples[[]]
+        return self.samples[self.sample_rows[self.sample_ptr[col]:self.sample_ptr[col+1]]]
+
+    def get_shared_deletions(self, min_samples: int=2) -> pd.DataFrame:
+        """Returns each deletion found in at least `min_samples` samples, along with the samples sharing it"""
+        num_samples = np.diff(self.sample_ptr)
+        cols = np.flatnonzero(num_samples >= min_samples)
+        samples = [self.samples[self.sample_rows[self.sample_ptr[col]:self.sample_ptr[col+1]]].tolist() for col in cols]
+        return pd.DataFrame({self.coords_col: self.coords[cols], 'samples': samples, 'num_samples': num_samples[cols]})
+
+    def get_cooccurring_deletions(self, min_samples: int=2) -> pd.DataFrame:
+        """Returns each set of deletions found (exactly) in at least `min_samples` samples, along with the samples sharing it, 
+        ordered by number of samples"""
+        num_samples = np.bincount(self.set_codes)
+        set_codes = np.flatnonzero(num_samples >= min_samples)
+        # samples with each set of deletions
+        order = np.argsort(self.set_codes, kind='stable')
+        set_ptr = np.concatenate([[0], np.cumsum(num_samples)])
+        deletions, samples = [], []
+        for code in set_codes:
+            rows = order[set_ptr[code]:set_ptr[code+1]]
+            deletions.append(self.coords[self.matrix.indices[self.matrix.indptr[rows[0]]:self.matrix.indptr[rows[0]+1]]].tolist())
+            samples.append(self.samples[rows].tolist())
+        cooccurring = pd.DataFrame({'deletions': deletions, 'samples': samples, 'num_samples': num_samples[set_codes]})
+        return cooccurring.sort_values('num_samples', ascending=False, kind='stable', ignore_index=True)
+
+
+def normalize_deletion_coords(coords: pd.Series) -> np.ndarray:
+    """helper function to normalize deletion coordinates (start:end) e.g. '21765 : 21770' -> '21765:21770', 
+    parsing each distinct value once"""
+    codes, uniques = pd.factorize(coords)
+    normalized = [':'.join(str(int(float(x))) for x in str(coords).split(':')) for coords in uniques]
+    return np.array(normalized + [''], dtype=object)[codes]
+
+
+def name_indels(genes: np.ndarray, codon_nums: np.ndarray, pos_in_codon: np.ndarray, 
+                indel_lens: np.ndarray, indel_type: str='DEL') -> np.ndarray:
+    """Support function for assigning the non-specific codon coordinates (integers) of each indel at once
+    e.g. S:DEL69/70 (see `assign_deletion_v2` and `assign_insertion_v2`)"""
+    names = pd.Series(genes, dtype=object) + f':{indel_type}' + pd.Series(codon_nums).astype(str).values
+    last_codon = pd.Series(codon_nums + (indel_lens//3) - 1).astype(str).values
+    multi_codon = (pos_in_codon + indel_lens) > 3
+    names[multi_codon] = names[multi_codon] + '/' + last_codon[multi_codon]
+    return names.values
+
+
+def name_deletion_codon_coords(genes: np.ndarray, codon_nums: np.ndarray, pos_in_codon: np.ndarray, 
+                               del_lens: np.ndarray) -> np.ndarray:
+    """Support function for assigning the specific codon coordinates (floats) of each deletion at once 
+    e.g. S:DEL69.0/70.0 (see `assign_deletion_codon_coords`)"""
+    first_codon = pd.Series(codon_nums + (pos_in_codon/3)).astype(str).values
+    last_codon = pd.Series(codon_nums + (1 + (pos_in_codon/3)) + (del_lens/3) - 1).astype(str).values
+    names = pd.Series(genes, dtype=object) + ':DEL' + first_codon
+    multi_codon = (pos_in_codon + del_lens) > 3
+    names[multi_codon] = names[multi_codon] + '/' + last_codon[multi_codon]
+    return names.values
 
 
 def find_deletions(x):
@@ -625,6 +1809,27 @@ def find_deletions(x):
     return deletions
 
 
+def find_deletions_in_array(seq_arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Support function for identifying contiguous deletions of all samples at once (see `find_deletions`)
+    Returns the row (sample) index, start and end positions (inclusive) of each run of gaps, 
+    ordered by sample and then by position"""
+    is_gap = (seq_arr==ord('-'))
+    # a run starts at a gap that is not preceded by a gap, and ends at a gap not followed by one
+    is_start = is_gap.copy()
+    is_start[:, 1:] &= ~is_gap[:, :-1]
+    is_end = is_gap
+    is_end[:, :-1] &= ~is_gap[:, 1:]
+    rows, del_starts = np.nonzero(is_start)
+    del is_start
+    _, del_ends = np.nonzero(is_end)
+    return rows, del_starts, del_ends
+
+
+def join_coords(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """helper function to format arrays of start and end positions as coordinates (start:end)"""
+    return starts.astype(str).astype(object) + ':' + ends.astype(str).astype(object)
+
+
 def find_insertions(x, insert_positions: list):
     """Support function for identifying contiguous insertions within a sequence"""
     ins_positions = [m for m in insert_positions if x[m]!='-' and x[m]!='n']
@@ -634,6 +1839,8 @@ def find_insertions(x, insert_positions: list):
 
 def get_seq(all_seqs: Align.MultipleSeqAlignment, sample_name: str) -> str:
     """Fetches the aligned sequence of a specific sample name"""
+    if isinstance(all_seqs, IndexedAlignment):
+        return all_seqs.get_seq(sample_name)
     seq = ''
     for rec in all_seqs:
         if sample_name in rec.id:
@@ -687,14 +1894,15 @@ def find_deletions_old(x):
 
 def cross_join(df1: pd.DataFrame, df2: pd.DataFrame) -> pd.DataFrame:
     """helper function to perform a cross-join between two dataframes
-    Useful for computing pairwise relationships...etc."""
+    Useful for computing pairwise relationships...etc. 
+    NOTE: the output grows quadratically, use `DeletionIndex` for finding shared deletions"""
     df1 = df1.assign(key=0)
     df2 = df2.assign(key=0)
     return pd.merge(df1, df2, on='key').drop(columns='key')
 
 
 def is_deletion_common(x):
-    """Support function for deciding whether two given deletions are common"""
+    """[DEPRECATED] Support function for deciding whether two given deletions are common (see `DeletionIndex`)"""
     return x['del_positions_x']==x['del_positions_y']
 
 
@@ -739,6 +1947,7 @@ def get_dels_separated(x):
         return c1
 
 
+@traced
 def identify_replacements(cns, 
                           meta_fp,
                           patient_zero: str='NC_045512.2', 
@@ -747,12 +1956,21 @@ def identify_replacements(cns,
                           data_src: str='alab'):
     """Returns dataframe of substitution-based mutations from a pre-loaded multiple sequence alignment (fasta),
     which contains the reference sequence (default: NC_045512.2)"""
-    print(f"Creating a dataframe...")
+    stage(f"Creating a dataframe...")
     seqsdf, _ = identify_replacements_per_sample(cns, 
                                                  meta_fp,  
                                                  gene2pos,
                                                  data_src=data_src,
                                                  patient_zero=patient_zero)
+    return summarize_replacements(seqsdf, location, data_src)
+
+
+@traced
+def summarize_replacements(seqsdf: pd.DataFrame, 
+                           location: str=None,
+                           data_src: str='alab') -> pd.DataFrame:
+    """Returns dataframe of substitution-based mutations aggregated from the per-sample records 
+    computed by `identify_replacements_per_sample`"""
     if location:
         seqsdf = seqsdf.loc[seqsdf['location'].str.contains(location)]
     # aggregate on each substitutions, compute number of samples and other attributes
@@ -808,6 +2026,7 @@ def identify_replacements(cns,
     return subs
 
 
+@traced
 def identify_deletions(cns, 
                        meta_fp=None,
                        patient_zero: str='NC_045512.2',
@@ -829,6 +2048,15 @@ def identify_deletions(cns,
                                            start_pos=start_pos,
                                            end_pos=end_pos,
                                            data_src=data_src)
+    return summarize_deletions(seqsdf, location, data_src)
+
+
+@traced
+def summarize_deletions(seqsdf: pd.DataFrame, 
+                        location: str=None,
+                        data_src: str='alab') -> pd.DataFrame:
+    """Returns dataframe of deletion-based mutations aggregated from the per-sample records 
+    computed by `identify_deletions_per_sample`"""
     seqsdf.rename(columns={'del_len': 'indel_len'}, inplace=True)
     seqsdf.rename(columns={'del_seq': 'indel_seq'}, inplace=True)
     if seqsdf.shape[0]==0:
@@ -877,6 +2105,7 @@ def identify_deletions(cns,
     return del_seqs#[cols]
 
 
+@traced
 def identify_insertions(cns,
                         meta_fp: str,
                         data_src: str='alab',
@@ -896,6 +2125,14 @@ def identify_insertions(cns,
     # insert_positions = identify_insertion_positions(ref_seq)
     # seqs = get_seqs(cns)
     seqsdf, _ = identify_insertions_per_sample(cns, meta_fp=meta_fp)
+    return summarize_insertions(seqsdf, data_src)
+
+
+@traced
+def summarize_insertions(seqsdf: pd.DataFrame, 
+                         data_src: str='alab') -> pd.DataFrame:
+    """Returns dataframe of insertion-based mutations aggregated from the per-sample records 
+    computed by `identify_insertions_per_sample`"""
     seqsdf.rename(columns={'ins_len': 'indel_len'}, inplace=True)
     # seqsdf.rename(columns={'ins_seq': 'indel_seq'}, inplace=True)
     # sequences with one or more deletions
@@ -936,4 +2173,40 @@ def identify_insertions(cns,
                             'pos', 'num_samples',
                             'prev_10nts', 'next_10nts', 'samples'
                         ]]
-    return seqsdf
\ No newline at end of file
+    return seqsdf
+
+
+@traced
+def identify_mutations(cns,
+                       meta_fp=None,
+                       data_src: str='alab',
+                       patient_zero: str='NC_045512.2',
+                       gene2pos: dict=bd.GENE2POS,
+                       location: str=None,
+                       min_del_len: int=2,
+                       min_ins_len: int=1,
+                       start_pos: int=265, 
+                       end_pos: int=29674,
+                       cache_fp: str=None) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Identify substitutions, deletions and insertions found in the aligned sequences, 
+    in a single pass over the alignment (see `identify_mutations_per_sample`).
+    Returns the same dataframes as `identify_replacements`, `identify_deletions` and `identify_insertions`
+    cns: pre-loaded multiple sequence alignment
+    patient_zero: name of the reference sequence in the alignment
+    min_del_len: minimum length of deletions to be identified
+    min_ins_len: minimum length of insertions to be identified
+    cache_fp: (optional) path to the cache of previously identified mutations (see `MutationCache`)"""
+    subs, dels, inss, _ = identify_mutations_per_sample(cns, 
+                                                        meta_fp, 
+                                                        gene2pos,
+                                                        data_src=data_src,
+                                                        min_del_len=min_del_len,
+                                                        min_ins_len=min_ins_len,
+                                                        start_pos=start_pos,
+                                                        end_pos=end_pos,
+                                                        patient_zero=patient_zero,
+                                                        cache_fp=cache_fp)
+    subs = summarize_replacements(subs, location, data_src)
+    dels = summarize_deletions(dels, location, data_src)
+    inss = summarize_insertions(inss, data_src)
+    return subs, dels, inss